@@ -0,0 +1,289 @@
+"""
+Benchmarks of the backup pipeline stages (compression, encryption, ...).
+
+Feeds dev/seed_prod_db.sql and synthetic dumps built from it through each
+stage, every case in its own subprocess so that the peak RSS and CPU time
+are measured per case. Results are saved as JSON and can be compared
+against a baseline:
+
+    python benchmarks/bench_pipeline.py --sizes seed,1GB,10GB --output results.json
+    python benchmarks/bench_pipeline.py --baseline results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+SEED_DUMP = os.path.join(ROOT_DIR, "dev", "seed_prod_db.sql")
+PASSWORD = "benchmark"
+UNITS = {"KB": 1000, "MB": 1000**2, "GB": 1000**3}
+
+
+def _compress(path):
+    from worker.compression import compress_file
+
+    return compress_file(path)
+
+
+def _decompress(path):
+    from worker.compression import decompress_file
+
+    return decompress_file(path)
+
+
+def _encrypt(path):
+    from worker.security import encrypt_file
+
+    return encrypt_file(path, PASSWORD)
+
+
+def _decrypt(path):
+    from worker.security import decrypt_file
+
+    return decrypt_file(path, PASSWORD)
+
+
+# name: (prepare, run), prepare turns the plain dump into the input of run
+CASES = {
+    "compress": (None, _compress),
+    "decompress": (_compress, _decompress),
+    "encrypt": (None, _encrypt),
+    "decrypt": (_encrypt, _decrypt),
+}
+
+
+def parse_size(size: str):
+    if size == "seed":
+        return None
+    match = re.fullmatch(r"(\d+(?:\.\d+)?)\s*(KB|MB|GB)", size.upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f"Invalid size: '{size}'")
+    return int(float(match.group(1)) * UNITS[match.group(2)])
+
+
+def generate_dump(size_name: str, work_dir: str) -> str:
+    """
+    Returns the path of a dump of the given size, generated from the seed dump.
+
+    The INSERT statements of the seed are repeated with their digits remapped by
+    a seeded permutation, so the data is deterministic but does not compress as
+    a trivial repetition.
+    """
+    size = parse_size(size_name)
+    if size is None:
+        return SEED_DUMP
+    path = os.path.join(work_dir, f"synthetic_{size_name}.sql")
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        return path
+
+    with open(SEED_DUMP, "rb") as file:
+        seed = file.read()
+    schema_end = seed.index(b"INSERT INTO")
+    schema, inserts = seed[:schema_end], seed[schema_end:]
+    digits = list(b"0123456789")
+    rng = random.Random(size)
+    with open(path + ".tmp", "wb") as file:
+        written = file.write(schema)
+        while written < size:
+            permutation = digits[:]
+            rng.shuffle(permutation)
+            table = bytes.maketrans(bytes(digits), bytes(permutation))
+            written += file.write(inserts.translate(table))
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def _run_worker(*args) -> tuple:
+    process = subprocess.Popen(
+        [sys.executable, __file__, "--worker", *args],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    output = process.stdout.read()
+    _pid, status, rusage = os.wait4(process.pid, 0)
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"Benchmark worker failed: {' '.join(args)}")
+    return json.loads(output.splitlines()[-1]), rusage
+
+
+def run_case(case: str, dump_path: str, work_dir: str) -> dict:
+    """
+    Runs a case in a subprocess and returns its wall time, cpu time and peak RSS.
+
+    The input of the case is prepared in another subprocess, so that it does not
+    count in the peak RSS.
+    """
+    case_dir = tempfile.mkdtemp(prefix=f"{case}_", dir=work_dir)
+    try:
+        input_path = os.path.join(case_dir, os.path.basename(dump_path))
+        os.symlink(dump_path, input_path)
+        if CASES[case][0]:
+            prepared, _rusage = _run_worker("prepare", case, input_path)
+            # the case may write back to the plain dump path, never through the symlink
+            os.remove(input_path)
+            input_path = prepared["path"]
+        result, rusage = _run_worker("run", case, input_path)
+        result["peak_rss"] = rusage.ru_maxrss * 1024
+        return result
+    finally:
+        shutil.rmtree(case_dir, ignore_errors=True)
+
+
+def _worker(mode: str, case: str, input_path: str):
+    sys.path.insert(0, SRC_DIR)
+    from loguru import logger
+
+    logger.remove()
+
+    prepare, run = CASES[case]
+    if mode == "prepare":
+        print(json.dumps({"path": prepare(input_path)}))
+        return
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    run(input_path)
+    print(
+        json.dumps(
+            {
+                "wall_time": time.perf_counter() - wall_start,
+                "cpu_time": time.process_time() - cpu_start,
+            }
+        )
+    )
+
+
+def benchmark(cases, sizes, work_dir, repeat) -> dict:
+    results = []
+    for size_name in sizes:
+        dump_path = generate_dump(size_name, work_dir)
+        size = os.path.getsize(dump_path)
+        for case in cases:
+            runs = [run_case(case, dump_path, work_dir) for _ in range(repeat)]
+            best = min(runs, key=lambda run: run["wall_time"])
+            result = {
+                "case": case,
+                "size": size_name,
+                "bytes": size,
+                "wall_time": best["wall_time"],
+                "cpu_time": best["cpu_time"],
+                "peak_rss": max(run["peak_rss"] for run in runs),
+                "throughput": size / best["wall_time"] / 1_000_000,
+            }
+            print(
+                f"{case:>12} {size_name:>8}: {result['throughput']:8.2f} MB/s,"
+                f" {result['wall_time']:8.3f}s wall, {result['cpu_time']:8.3f}s cpu,"
+                f" peak RSS {result['peak_rss'] / 1_000_000:8.1f} MB"
+            )
+            results.append(result)
+    return {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns the regressions of results against baseline: throughput lower or peak
+    RSS higher than the baseline by more than threshold.
+    """
+    baseline_results = {
+        (result["case"], result["size"]): result for result in baseline["results"]
+    }
+    regressions = []
+    for result in results["results"]:
+        previous = baseline_results.get((result["case"], result["size"]))
+        if not previous:
+            continue
+        name = f"{result['case']} {result['size']}"
+        if result["throughput"] < previous["throughput"] * (1 - threshold):
+            regressions.append(
+                f"{name}: throughput {result['throughput']:.2f} MB/s"
+                f" < baseline {previous['throughput']:.2f} MB/s"
+            )
+        if result["peak_rss"] > previous["peak_rss"] * (1 + threshold):
+            regressions.append(
+                f"{name}: peak RSS {result['peak_rss'] / 1_000_000:.1f} MB"
+                f" > baseline {previous['peak_rss'] / 1_000_000:.1f} MB"
+            )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--cases",
+        default=",".join(CASES),
+        help=f"Comma separated cases (default: all of {', '.join(CASES)}).",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="seed,10MB",
+        help="Comma separated dump sizes: 'seed' or e.g. 1GB, 10GB, 100GB.",
+    )
+    parser.add_argument(
+        "--work-dir",
+        default=os.path.join(tempfile.gettempdir(), "dbackup-bench"),
+        help="Directory of the generated dumps (kept between runs).",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Runs per case, the best is kept."
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against this results file.")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.15,
+        help="Allowed relative regression against the baseline (default: 0.15).",
+    )
+    parser.add_argument("--worker", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        _worker(*args.worker)
+        return 0
+
+    cases = args.cases.split(",")
+    unknown_cases = [case for case in cases if case not in CASES]
+    if unknown_cases:
+        parser.error(f"Unknown case(s): {', '.join(unknown_cases)}")
+    sizes = args.sizes.split(",")
+    for size in sizes:
+        parse_size(size)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    results = benchmark(cases, sizes, args.work_dir, args.repeat)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regression against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+Benchmarks of the transfer clients against in-process SSH/SFTP/FTP servers.
+
+Measures upload throughput for each client and file size, and the speed of
+listing and deleting files, optionally through a proxy adding latency and a
+bandwidth limit:
+
+    python benchmarks/bench_transfer.py --sizes 1MB,100MB --latency 0.02 --bandwidth 100MB
+    python benchmarks/bench_transfer.py --baseline results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_DIR, "..", "src"))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from bench_pipeline import compare, parse_size
+from transfer_servers import (
+    PASSWORD,
+    USERNAME,
+    FTPServer,
+    SSHServer,
+    ThrottledProxy,
+)
+
+PROTOCOLS = ["local", "scp", "sftp", "ftp"]
+
+
+def start_servers(protocols, root_dir, latency, bandwidth) -> tuple:
+    """
+    Starts the servers needed by the protocols and returns their ports by
+    protocol and a list of the objects to stop.
+    """
+    ports, running = {}, []
+    if {"scp", "sftp"} & set(protocols):
+        ssh_server = SSHServer()
+        running.append(ssh_server)
+        ports["scp"] = ports["sftp"] = ssh_server.port
+    if "ftp" in protocols:
+        ftp_server = FTPServer(root_dir, bandwidth)
+        running.append(ftp_server)
+        ports["ftp"] = ftp_server.port
+
+    if latency or bandwidth:
+        for protocol, port in list(ports.items()):
+            proxy = ThrottledProxy(
+                port, latency, None if protocol == "ftp" else bandwidth
+            )
+            running.append(proxy)
+            ports[protocol] = proxy.port
+    return ports, running
+
+
+def get_host(protocol: str, port: int):
+    from config import Host
+
+    return Host(
+        id=f"bench-{protocol}",
+        hostname="127.0.0.1",
+        username=USERNAME,
+        password=PASSWORD,
+        port=port,
+        protocol=protocol,
+    )
+
+
+def get_remote_dir(protocol: str, root_dir: str) -> str:
+    # the ftp server is chrooted in root_dir, the other clients see the real path
+    if protocol == "ftp":
+        return f"/{protocol}"
+    return os.path.join(root_dir, protocol)
+
+
+def benchmark_protocol(protocol, port, root_dir, sizes, files, work_dir) -> list:
+    from worker.transfer_client.transfer_manager import get_client
+
+    host = get_host(protocol, port) if protocol != "local" else None
+    remote_dir = get_remote_dir(protocol, root_dir)
+    results = []
+
+    client = get_client(protocol, host)
+    start = time.perf_counter()
+    client.connect()
+    connect_time = time.perf_counter() - start
+    try:
+        client.mkdir(remote_dir)
+        for size_name in sizes:
+            local_path = os.path.join(work_dir, f"upload_{size_name}.bin")
+            size = os.path.getsize(local_path)
+            start = time.perf_counter()
+            client.upload_file(local_path, f"{remote_dir}/upload_{size_name}.bin")
+            wall_time = time.perf_counter() - start
+            results.append(
+                {
+                    "case": f"{protocol}-upload",
+                    "size": size_name,
+                    "bytes": size,
+                    "wall_time": wall_time,
+                    "throughput": size / wall_time / 1_000_000,
+                }
+            )
+
+        small_file = os.path.join(work_dir, "small.bin")
+        for index in range(files):
+            client.upload_file(small_file, f"{remote_dir}/small_{index}.bin")
+
+        start = time.perf_counter()
+        listed = client.list_files(remote_dir)
+        results.append(_ops_result(protocol, "list", len(listed), start))
+
+        start = time.perf_counter()
+        for index in range(files):
+            client.delete_file(f"{remote_dir}/small_{index}.bin")
+        results.append(_ops_result(protocol, "delete", files, start))
+    finally:
+        client.disconnect()
+
+    results.append(
+        {
+            "case": f"{protocol}-connect",
+            "size": "-",
+            "wall_time": connect_time,
+            "throughput": 1 / connect_time,
+        }
+    )
+    return results
+
+
+def _ops_result(protocol: str, operation: str, count: int, start: float) -> dict:
+    wall_time = time.perf_counter() - start
+    # throughput of list/delete is in operations (files) per second
+    return {
+        "case": f"{protocol}-{operation}",
+        "size": str(count),
+        "wall_time": wall_time,
+        "throughput": count / wall_time,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--protocols", default=",".join(PROTOCOLS))
+    parser.add_argument("--sizes", default="1MB,10MB,100MB")
+    parser.add_argument(
+        "--files", type=int, default=100, help="Files to list and delete."
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0, help="One way latency in seconds."
+    )
+    parser.add_argument("--bandwidth", help="Bandwidth limit, e.g. 10MB (per second).")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare against this results file.")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    args = parser.parse_args(argv)
+
+    from loguru import logger
+
+    logger.remove()
+
+    protocols = args.protocols.split(",")
+    unknown = [protocol for protocol in protocols if protocol not in PROTOCOLS]
+    if unknown:
+        parser.error(f"Unknown protocol(s): {', '.join(unknown)}")
+    sizes = args.sizes.split(",")
+    bandwidth = parse_size(args.bandwidth) if args.bandwidth else None
+
+    work_dir = tempfile.mkdtemp(prefix="dbackup-bench-transfer-")
+    running = []
+    try:
+        root_dir = os.path.join(work_dir, "remote")
+        os.makedirs(root_dir)
+        for size_name in sizes:
+            with open(os.path.join(work_dir, f"upload_{size_name}.bin"), "wb") as file:
+                remaining = parse_size(size_name)
+                while remaining > 0:
+                    remaining -= file.write(os.urandom(min(remaining, 1024 * 1024)))
+        with open(os.path.join(work_dir, "small.bin"), "wb") as file:
+            file.write(os.urandom(1024))
+
+        ports, running = start_servers(protocols, root_dir, args.latency, bandwidth)
+        results = []
+        for protocol in protocols:
+            for result in benchmark_protocol(
+                protocol, ports.get(protocol), root_dir, sizes, args.files, work_dir
+            ):
+                unit = "MB/s" if result["case"].endswith("upload") else "ops/s"
+                print(
+                    f"{result['case']:>16} {result['size']:>8}:"
+                    f" {result['throughput']:10.2f} {unit}, {result['wall_time']:8.3f}s"
+                )
+                results.append(result)
+    finally:
+        for server in running:
+            server.stop()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        "meta": {
+            "date": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "latency": args.latency,
+            "bandwidth": bandwidth,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        # peak RSS is not measured here
+        for result in results["results"] + baseline["results"]:
+            result.setdefault("peak_rss", 0)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print("No regression against the baseline")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
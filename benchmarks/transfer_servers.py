@@ -0,0 +1,329 @@
+"""
+In-process stand-ins for the remote hosts of the transfer clients.
+
+- SSHServer: paramiko SSH server with an SFTP subsystem and exec support (exec
+  runs the command locally, which is enough for `scp -t`, `mkdir -p`, `ls`, `rm`).
+- FTPServer: pyftpdlib FTP server (optional dependency).
+- ThrottledProxy: TCP proxy that adds latency and a bandwidth limit in front
+  of a server.
+
+The "remote" file system is the local one, so remote paths should point into a
+temporary directory. Everything listens on 127.0.0.1 only.
+"""
+
+import heapq
+import logging
+import os
+import socket
+import subprocess
+import threading
+import time
+
+import paramiko
+
+logging.getLogger("transfer_servers.ssh").setLevel(logging.CRITICAL)
+
+USERNAME = "dbackup"
+PASSWORD = "dbackup"
+CHUNK_SIZE = 64 * 1024
+
+
+def _listen() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(16)
+    return sock
+
+
+class _SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        return paramiko.sftp.SFTP_OK
+
+
+class _SFTPServer(paramiko.SFTPServerInterface):
+    def list_folder(self, path):
+        try:
+            result = []
+            for filename in os.listdir(path):
+                attr = paramiko.SFTPAttributes.from_stat(
+                    os.stat(os.path.join(path, filename))
+                )
+                attr.filename = filename
+                result.append(attr)
+            return result
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        try:
+            fd = os.open(path, flags, 0o644)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = _SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._call(os.remove, path)
+
+    def rename(self, oldpath, newpath):
+        return self._call(os.rename, oldpath, newpath)
+
+    def mkdir(self, path, attr):
+        return self._call(os.mkdir, path)
+
+    def rmdir(self, path):
+        return self._call(os.rmdir, path)
+
+    def chattr(self, path, attr):
+        return paramiko.sftp.SFTP_OK
+
+    def _call(self, function, *args):
+        try:
+            function(*args)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.sftp.SFTP_OK
+
+
+class _SSHServerInterface(paramiko.ServerInterface):
+    def check_auth_password(self, username, password):
+        if username == USERNAME and password == PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(
+            target=_run_exec, args=(channel, command.decode()), daemon=True
+        ).start()
+        return True
+
+
+def _run_exec(channel: paramiko.Channel, command: str):
+    process = subprocess.Popen(
+        command,
+        shell=True,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    def forward_stdin():
+        try:
+            while data := channel.recv(CHUNK_SIZE):
+                process.stdin.write(data)
+                process.stdin.flush()
+        except (OSError, ValueError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    threading.Thread(target=forward_stdin, daemon=True).start()
+    while data := process.stdout.read1(CHUNK_SIZE):
+        channel.sendall(data)
+    channel.sendall_stderr(process.stderr.read())
+    channel.send_exit_status(process.wait())
+    channel.close()
+
+
+class SSHServer:
+    """
+    SSH server with SFTP and exec (for SCP) support, accepting USERNAME/PASSWORD.
+    """
+
+    _host_key = None
+
+    def __init__(self):
+        if SSHServer._host_key is None:
+            SSHServer._host_key = paramiko.RSAKey.generate(2048)
+        self._sock = _listen()
+        self.port = self._sock.getsockname()[1]
+        self._transports = []
+        self._running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                client, _address = self._sock.accept()
+            except OSError:
+                return
+            transport = paramiko.Transport(client)
+            # clients closing their connection are expected, keep the output clean
+            transport.set_log_channel("transfer_servers.ssh")
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, _SFTPServer)
+            transport.start_server(server=_SSHServerInterface())
+            self._transports.append(transport)
+
+    def stop(self):
+        self._running = False
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+
+class FTPServer:
+    """
+    pyftpdlib FTP server accepting USERNAME/PASSWORD with full rights on root_dir.
+
+    :param bandwidth: Optional limit of the data connections in bytes per second.
+    """
+
+    def __init__(self, root_dir: str, bandwidth: int = None):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+        from pyftpdlib.log import config_logging
+        from pyftpdlib.servers import ThreadedFTPServer
+
+        config_logging(level=logging.WARNING)
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USERNAME, PASSWORD, root_dir, perm="elradfmwMT")
+
+        # the handler is configured through class attributes, use fresh subclasses
+        handler = type("Handler", (FTPHandler,), {"authorizer": authorizer})
+        if bandwidth:
+            handler.dtp_handler = type(
+                "DTPHandler",
+                (ThrottledDTPHandler,),
+                {"read_limit": bandwidth, "write_limit": bandwidth},
+            )
+        handler.banner = "dbackup test server"
+
+        self._server = ThreadedFTPServer(("127.0.0.1", 0), handler)
+        self.port = self._server.address[1]
+        threading.Thread(
+            target=self._server.serve_forever,
+            kwargs={"timeout": 0.1, "handle_exit": False},
+            daemon=True,
+        ).start()
+
+    def stop(self):
+        self._server.close_all()
+
+
+class ThrottledProxy:
+    """
+    TCP proxy adding a one way latency (seconds) and a bandwidth limit (bytes per
+    second, per direction) to the connections to target_port.
+
+    Only the connections that go through the proxy are throttled, for FTP this is
+    the control connection (use the bandwidth option of FTPServer for the data).
+    """
+
+    def __init__(self, target_port: int, latency: float = 0, bandwidth: int = None):
+        self.target_port = target_port
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._sock = _listen()
+        self.port = self._sock.getsockname()[1]
+        self._running = True
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                client, _address = self._sock.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            for source, target in ((client, upstream), (upstream, client)):
+                _ThrottledPipe(source, target, self.latency, self.bandwidth)
+
+    def stop(self):
+        self._running = False
+        self._sock.close()
+
+
+class _ThrottledPipe:
+    """
+    Forwards one direction of a connection. The reader timestamps the chunks and
+    the writer sends them once their latency has passed, so latency does not
+    lower the throughput, then paces them to the bandwidth.
+    """
+
+    def __init__(self, source, target, latency, bandwidth):
+        self.source = source
+        self.target = target
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._chunks = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def _read_loop(self):
+        try:
+            while data := self.source.recv(CHUNK_SIZE):
+                with self._condition:
+                    self._sequence += 1
+                    heapq.heappush(
+                        self._chunks,
+                        (time.monotonic() + self.latency, self._sequence, data),
+                    )
+                    self._condition.notify()
+        except OSError:
+            pass
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+
+    def _write_loop(self):
+        next_send = time.monotonic()
+        try:
+            while True:
+                with self._condition:
+                    while not self._chunks and not self._closed:
+                        self._condition.wait()
+                    if not self._chunks:
+                        break
+                    due, _sequence, data = heapq.heappop(self._chunks)
+                next_send = max(next_send, due)
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                self.target.sendall(data)
+                if self.bandwidth:
+                    next_send += len(data) / self.bandwidth
+        except OSError:
+            pass
+        finally:
+            try:
+                self.target.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
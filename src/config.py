@@ -1,7 +1,7 @@
 import os
 import yaml
 from pydantic import BaseModel, Field, field_validator, model_validator, ValidationError
-from typing import List, Optional
+from typing import List, Optional, Tuple
 from croniter import croniter
 from loguru import logger
 from enum import Enum
@@ -19,6 +19,43 @@ class Protocol(str, Enum):
     FTP = "ftp"
 
 
+class CompressionCodec(str, Enum):
+    XZ = "xz"
+    GZIP = "gzip"
+    ZSTD = "zstd"
+    AUTO = "auto"  # picked for each run, see compression.choose_codec
+
+
+class ProtocolCompression(str, Enum):
+    ZLIB = "zlib"
+    ZSTD = "zstd"  # MySQL 8.0.18+ clients and servers only
+
+
+class DatabaseType(str, Enum):
+    MYSQL = "mysql"  # and MariaDB
+    POSTGRESQL = "postgresql"
+
+
+class BackupEngine(str, Enum):
+    MYSQLDUMP = "mysqldump"
+    # physical hot backups of the whole server, see worker/engines/physical.py
+    XTRABACKUP = "xtrabackup"
+    MARIABACKUP = "mariabackup"
+    PG_DUMP = "pg_dump"
+
+
+# engines of each database type, the first one is the default
+DATABASE_ENGINES = {
+    DatabaseType.MYSQL: [
+        BackupEngine.MYSQLDUMP,
+        BackupEngine.XTRABACKUP,
+        BackupEngine.MARIABACKUP,
+    ],
+    DatabaseType.POSTGRESQL: [BackupEngine.PG_DUMP],
+}
+DEFAULT_PORTS = {DatabaseType.MYSQL: 3306, DatabaseType.POSTGRESQL: 5432}
+
+
 class LogLevel(str, Enum):
     DEBUG = "DEBUG"
     INFO = "INFO"
@@ -27,13 +64,63 @@ class LogLevel(str, Enum):
     CRITICAL = "CRITICAL"
 
 
+class Replica(BaseModel):
+    hostname: str
+    port: int = Field(default=3306)
+    # default: the credentials of the connection
+    username: Optional[str] = None
+    password: Optional[str] = None
+
+
 class DBConnection(BaseModel):
     id: str
+    type: DatabaseType = Field(default=DatabaseType.MYSQL)
     hostname: str
-    port: int = Field(default=3306)
+    port: Optional[int] = None  # default: 3306 for MySQL, 5432 for PostgreSQL
     username: str
     password: str
-    database: str
+    database: Optional[str] = None
+    # several databases: names or glob patterns, "*" for all but the system ones
+    databases: Optional[List[str]] = None
+    # compression of the client/server protocol, for databases far from dbackup
+    protocol_compression: Optional[ProtocolCompression] = None
+    # runs mysqldump on this host over SSH and streams its compressed output back
+    ssh_host_id: Optional[str] = None
+    ssh_host_obj: Optional["Host"] = None
+    ssh_compression: CompressionCodec = Field(default=CompressionCodec.GZIP)
+    # hostname of the database seen from the SSH host (default: hostname)
+    ssh_db_hostname: Optional[str] = None
+    # read replicas dumped instead of the primary, see db.choose_dump_source
+    replicas: Optional[List[Replica]] = Field(default_factory=list)
+    max_replication_lag_seconds: int = Field(default=300)
+    replica_fallback_to_primary: bool = Field(default=False)
+
+    @property
+    def servers(self) -> List[Tuple[str, int]]:
+        """
+        Returns the hostname and port of the server and of its replicas.
+        """
+        return [(self.hostname, self.port)] + [
+            (replica.hostname, replica.port) for replica in self.replicas or []
+        ]
+
+    @field_validator("ssh_compression")
+    def validate_ssh_compression(cls, value):
+        if value not in (CompressionCodec.GZIP, CompressionCodec.ZSTD):
+            raise ValueError("ssh_compression must be 'gzip' or 'zstd'.")
+        return value
+
+    @model_validator(mode="after")
+    def validate_db_connection(cls, model):
+        if model.port is None:
+            model.port = DEFAULT_PORTS[model.type]
+        if model.type != DatabaseType.MYSQL:
+            for field_name in ("protocol_compression", "ssh_host_id", "replicas"):
+                if getattr(model, field_name):
+                    raise ValueError(
+                        f"DB connection '{model.id}': {field_name} is only supported for MySQL."
+                    )
+        return model
 
 
 class Host(BaseModel):
@@ -74,6 +161,12 @@ class Notification(BaseModel):
     smtp_recipients: Optional[List[str]] = Field(default_factory=list)
     smtp_use_tls: Optional[bool] = Field(default=True)
     smtp_use_ssl: Optional[bool] = Field(default=False)
+    # collect the runs and send one message for all the runs of digest_window
+    # seconds, see worker/notification.py
+    digest: Optional[bool] = Field(default=False)
+    digest_window: Optional[int] = Field(default=3600, ge=1)
+    # send the failed runs of a digest right away too
+    digest_failures_immediately: Optional[bool] = Field(default=True)
 
     @model_validator(mode="after")
     def validate_notification(cls, model):
@@ -100,6 +193,20 @@ class Notification(BaseModel):
         return model
 
 
+class LifecycleRule(BaseModel):
+    # age in days of the backup files moved by the rule, from the date in their name
+    after_days: int = Field(ge=0)
+    # tier the files are moved to, they are deleted without host_id and local
+    host_id: Optional[str] = None
+    local: bool = Field(default=False)
+    path: Optional[str] = None
+    host_obj: Optional[Host] = None
+
+    @property
+    def deletes(self) -> bool:
+        return not self.host_id and not self.local
+
+
 class Backup(BaseModel):
     id: str
     host_id: Optional[str] = None
@@ -110,17 +217,49 @@ class Backup(BaseModel):
     notification_objs: Optional[List[Notification]] = None
     local: bool = Field(default=False)
     path: str  # path to the backup directory (remote or local)
+    engine: Optional[BackupEngine] = None  # default: the first of DATABASE_ENGINES
+    # copy threads of xtrabackup/mariabackup, jobs of pg_dump
+    dump_parallel: Optional[int] = None
+    # default: the databases of the connection, see worker/databases.py
+    databases: Optional[List[str]] = None
+    exclude_databases: Optional[List[str]] = None
+    database_parallel: Optional[int] = None  # databases dumped at the same time
     filename: Optional[str] = None
     date_format: Optional[str] = None
     encryption_enabled: Optional[bool] = None
     encryption_password: Optional[str] = None
     compression_enabled: Optional[bool] = None
+    compression_codec: Optional[CompressionCodec] = None
+    compression_level: Optional[int] = None
+    time_budget_seconds: Optional[int] = None  # target of the auto codec
+    compression_dictionary: Optional[bool] = None  # zstd only
+    dictionary_max_age_days: Optional[int] = None
+    repository: Optional[bool] = None  # deduplicated chunks, see worker/repository.py
+    # admission check, see worker/admission.py
+    load_max_threads_running: Optional[int] = None
+    load_max_qps: Optional[int] = None
+    load_max_replication_lag_seconds: Optional[int] = None
+    load_defer_max_seconds: Optional[int] = None
     skip_tables: Optional[List[str]] = None
     dump_options: Optional[List[str]] = None
     max_backup_files: Optional[int] = None
+    # tiers the aging backup files are moved to, see worker/lifecycle.py
+    lifecycle: Optional[List[LifecycleRule]] = None
+    lifecycle_schedule: Optional[str] = None  # runs of the lifecycle rules
+    # retries of a failed upload, store or retention stage, after
+    # stage_retry_delay seconds doubled at each attempt
+    stage_retries: Optional[int] = None
+    stage_retry_delay: Optional[float] = None
+    # retries of a failed dump, which queries the database again
+    dump_retries: Optional[int] = None
     notify_on_fail: bool = Field(default=True)
     notify_on_success: bool = Field(default=False)
     schedule: Optional[str] = None
+    profile: Optional[bool] = None
+    verify_schedule: Optional[str] = None  # restore drills, see tasks.drill_task
+    verify_db_connection_id: Optional[str] = None
+    verify_db_connection_obj: Optional[DBConnection] = None
+    rto_seconds: Optional[int] = None
 
     @field_validator("host_id")
     def validate_host_id(cls, value, info):
@@ -135,7 +274,7 @@ class Backup(BaseModel):
             )
         return value
 
-    @field_validator("schedule")
+    @field_validator("schedule", "verify_schedule", "lifecycle_schedule")
     def validate_schedule(cls, value):
         if value and not croniter.is_valid(value):
             raise ValueError(f"Invalid cron syntax: '{value}'.")
@@ -144,18 +283,38 @@ class Backup(BaseModel):
 
 class GlobalConfig(BaseModel):
     date_format: Optional[str] = Field(default="%Y-%m-%d_%H-%M-%S")
+    dump_parallel: Optional[int] = Field(default=4)
+    exclude_databases: Optional[List[str]] = Field(default_factory=list)
+    database_parallel: Optional[int] = Field(default=2)
     encryption_enabled: Optional[bool] = Field(default=False)
     encryption_password: Optional[str] = Field(default="")
     compression_enabled: Optional[bool] = Field(default=True)
+    compression_codec: Optional[CompressionCodec] = Field(default=CompressionCodec.XZ)
+    compression_level: Optional[int] = Field(default=None)
+    time_budget_seconds: Optional[int] = Field(default=None)
+    compression_dictionary: Optional[bool] = Field(default=False)
+    dictionary_max_age_days: Optional[int] = Field(default=30)
+    repository: Optional[bool] = Field(default=False)
+    load_max_threads_running: Optional[int] = Field(default=None)
+    load_max_qps: Optional[int] = Field(default=None)
+    load_max_replication_lag_seconds: Optional[int] = Field(default=None)
+    load_defer_max_seconds: Optional[int] = Field(default=3600)
     skip_tables: Optional[List[str]] = Field(default_factory=list)
     dump_options: Optional[List[str]] = Field(default_factory=list)
     max_backup_files: Optional[int] = Field(default=100)
+    stage_retries: Optional[int] = Field(default=0)
+    stage_retry_delay: Optional[float] = Field(default=30)
+    dump_retries: Optional[int] = Field(default=0)
     schedule: Optional[str] = Field(default="0 0 * * *")
+    lifecycle_schedule: Optional[str] = Field(default="30 * * * *")
     notify_on_fail: bool = Field(default=True)
     notify_on_success: bool = Field(default=False)
     notification_ids: Optional[List[str]] = Field(default_factory=list)
+    profile: Optional[bool] = Field(default=False)
+    verify_db_connection_id: Optional[str] = Field(default=None)
+    rto_seconds: Optional[int] = Field(default=None)
 
-    @field_validator("schedule")
+    @field_validator("schedule", "lifecycle_schedule")
     def validate_schedule(cls, value):
         if value and not croniter.is_valid(value):
             raise ValueError(f"Invalid cron syntax: '{value}'.")
@@ -167,18 +326,63 @@ class Log(BaseModel):
     filename: Optional[str] = Field(default="/dbackup/storage/logs/dbackup.log")
     rotation_interval: Optional[str] = Field(default="1 day")
     retention_period: Optional[str] = Field(default="7 days")
+    # seconds between two progress lines of a running stage
+    progress_interval: Optional[int] = Field(default=30)
     format: Optional[str] = Field(
         default="<green>{time:DD.MM.YYYY HH:mm:ss.SSS}</green> | <level>{level}</level> | <level>{message}</level>"
     )
 
 
+class History(BaseModel):
+    enabled: bool = Field(default=True)
+    filename: str = Field(default="/dbackup/storage/history.db")
+
+
+class HttpServer(BaseModel):
+    enabled: bool = Field(default=False)
+    host: str = Field(default="127.0.0.1")
+    port: int = Field(default=9100)
+    # bearer token required by POST /run/<backup_id>, without it only requests
+    # from the local host are accepted
+    token: Optional[str] = Field(default=None)
+
+
+class NotificationDelivery(BaseModel):
+    # threads sending the notifications in the background
+    workers: int = Field(default=2, ge=1)
+    max_attempts: int = Field(default=5, ge=1)
+    # seconds before the first retry, doubled after each failed attempt
+    retry_delay: float = Field(default=2, ge=0)
+    # seconds an unused SMTP connection or HTTP session is kept open
+    idle_timeout: int = Field(default=60, ge=1)
+    # seconds the queued notifications are given to be sent when dbackup exits
+    shutdown_timeout: int = Field(default=60, ge=0)
+
+
+class Spool(BaseModel):
+    # keep the backup files that could not be uploaded, see worker/spool.py
+    enabled: bool = Field(default=False)
+    directory: str = Field(default="/dbackup/storage/spool")
+    # disk quota, the oldest spooled files are evicted to stay under it
+    max_size_mb: int = Field(default=10240, ge=1)
+    # seconds between two uploads of the spooled files by the scheduler
+    drain_interval: int = Field(default=300, ge=1)
+    drain_parallel: int = Field(default=2, ge=1)
+
+
 class Config(BaseModel):
     global_config: GlobalConfig
     db_connections: List[DBConnection]
     hosts: Optional[List[Host]] = Field(default_factory=list)
     backups: List[Backup]
     notifications: Optional[List[Notification]] = Field(default_factory=list)
+    notification_delivery: Optional[NotificationDelivery] = Field(
+        default_factory=NotificationDelivery
+    )
     log: Optional[Log] = Field(default_factory=Log)
+    http_server: Optional[HttpServer] = Field(default_factory=HttpServer)
+    history: Optional[History] = Field(default_factory=History)
+    spool: Optional[Spool] = Field(default_factory=Spool)
 
     @model_validator(mode="after")
     def validate_backups(cls, model):
@@ -208,6 +412,24 @@ class Config(BaseModel):
         db_connection_id_set = set(db_ids)
         host_id_set = set(host_ids)
 
+        for db_connection in model.db_connections:
+            if not db_connection.ssh_host_id:
+                continue
+            db_connection.ssh_host_obj = next(
+                (host for host in model.hosts if host.id == db_connection.ssh_host_id),
+                None,
+            )
+            if not db_connection.ssh_host_obj:
+                raise ValueError(
+                    f"DB connection '{db_connection.id}': ssh_host_id '{db_connection.ssh_host_id}' is not defined in hosts."
+                )
+            if db_connection.ssh_host_obj.protocol == Protocol.FTP:
+                raise ValueError(
+                    f"DB connection '{db_connection.id}': ssh_host_id '{db_connection.ssh_host_id}' must be an scp or sftp host."
+                )
+
+        # repository backups by destination: a repository has a single writer
+        repository_backups = {}
         for backup in model.backups:
             if not backup.local and backup.host_id not in host_id_set:
                 raise ValueError(
@@ -222,22 +444,144 @@ class Config(BaseModel):
             # set defaults from global_config if not set in backup
             for field_name in [
                 "date_format",
+                "dump_parallel",
+                "exclude_databases",
+                "database_parallel",
                 "encryption_enabled",
                 "encryption_password",
                 "compression_enabled",
+                "compression_codec",
+                "compression_level",
+                "time_budget_seconds",
+                "compression_dictionary",
+                "dictionary_max_age_days",
+                "repository",
+                "load_max_threads_running",
+                "load_max_qps",
+                "load_max_replication_lag_seconds",
+                "load_defer_max_seconds",
                 "skip_tables",
                 "dump_options",
                 "max_backup_files",
+                "stage_retries",
+                "stage_retry_delay",
+                "dump_retries",
                 "schedule",
+                "lifecycle_schedule",
                 "notify_on_fail",
                 "notify_on_success",
                 "notification_ids",
+                "profile",
+                "verify_db_connection_id",
+                "rto_seconds",
             ]:
                 if getattr(backup, field_name) is None:
                     setattr(
                         backup, field_name, getattr(model.global_config, field_name)
                     )
 
+            if backup.compression_dictionary and backup.compression_codec not in (
+                CompressionCodec.ZSTD,
+                CompressionCodec.AUTO,
+            ):
+                raise ValueError(
+                    f"Backup '{backup.id}': compression_dictionary requires the zstd or auto compression_codec."
+                )
+
+            db_connection = next(
+                db for db in model.db_connections if db.id == backup.db_connection_id
+            )
+            db_type = db_connection.type
+            if backup.databases is None:
+                backup.databases = db_connection.databases
+            if backup.engine is None:
+                backup.engine = DATABASE_ENGINES[db_type][0]
+            if backup.engine not in DATABASE_ENGINES[db_type]:
+                raise ValueError(
+                    f"Backup '{backup.id}': the {backup.engine.value} engine cannot back up a {db_type.value} database."
+                )
+            physical = backup.engine in (
+                BackupEngine.XTRABACKUP,
+                BackupEngine.MARIABACKUP,
+            )
+            if physical and backup.databases:
+                raise ValueError(
+                    f"Backup '{backup.id}': the {backup.engine.value} engine backs up the whole server, databases cannot be selected."
+                )
+            # physical backups copy the whole server
+            if not physical and not backup.databases and not db_connection.database:
+                raise ValueError(
+                    f"Backup '{backup.id}': db_connection_id '{backup.db_connection_id}' has no database, set databases."
+                )
+            if physical and backup.skip_tables:
+                raise ValueError(
+                    f"Backup '{backup.id}': skip_tables is not supported by the {backup.engine.value} engine."
+                )
+            if db_type != DatabaseType.MYSQL and any(
+                getattr(backup, field_name) is not None
+                for field_name in (
+                    "load_max_threads_running",
+                    "load_max_qps",
+                    "load_max_replication_lag_seconds",
+                )
+            ):
+                raise ValueError(
+                    f"Backup '{backup.id}': load thresholds are only supported for MySQL."
+                )
+
+            # physical drills are prepared in a local directory, without a server
+            if (
+                backup.verify_schedule
+                and not backup.verify_db_connection_id
+                and not physical
+            ):
+                raise ValueError(
+                    f"Backup '{backup.id}': verify_schedule requires a verify_db_connection_id."
+                )
+            if (
+                backup.verify_db_connection_id
+                and backup.verify_db_connection_id not in db_connection_id_set
+            ):
+                raise ValueError(
+                    f"Backup '{backup.id}': verify_db_connection_id '{backup.verify_db_connection_id}' is not defined in db_connections."
+                )
+
+            if backup.repository:
+                destination = (
+                    "local" if backup.local else backup.host_id,
+                    os.path.normpath(backup.path),
+                )
+                if destination in repository_backups:
+                    raise ValueError(
+                        f"Backup '{backup.id}': the repository in '{backup.path}' is already used by backup '{repository_backups[destination]}'."
+                    )
+                repository_backups[destination] = backup.id
+            if backup.lifecycle and backup.repository:
+                raise ValueError(
+                    f"Backup '{backup.id}': lifecycle is not supported for repository backups."
+                )
+            for index, rule in enumerate(backup.lifecycle or []):
+                if index and rule.after_days <= backup.lifecycle[index - 1].after_days:
+                    raise ValueError(
+                        f"Backup '{backup.id}': the after_days of the lifecycle rules must increase."
+                    )
+                if rule.deletes and index != len(backup.lifecycle) - 1:
+                    raise ValueError(
+                        f"Backup '{backup.id}': only the last lifecycle rule can delete the backup files."
+                    )
+                if not rule.deletes and not rule.path:
+                    raise ValueError(
+                        f"Backup '{backup.id}': lifecycle rule {index + 1} requires a path."
+                    )
+                if not rule.local and rule.host_id:
+                    if rule.host_id not in host_id_set:
+                        raise ValueError(
+                            f"Backup '{backup.id}': lifecycle host_id '{rule.host_id}' is not defined in hosts."
+                        )
+                    rule.host_obj = next(
+                        host for host in model.hosts if host.id == rule.host_id
+                    )
+
             # set host_obj, db_connection_obj, and notification_objs
             backup.host_obj = next(
                 (host for host in model.hosts if host.id == backup.host_id), None
@@ -247,6 +591,36 @@ class Config(BaseModel):
                 None,
             )
 
+            backup.verify_db_connection_obj = next(
+                (
+                    db
+                    for db in model.db_connections
+                    if db.id == backup.verify_db_connection_id
+                ),
+                None,
+            )
+            if (
+                backup.verify_db_connection_obj
+                and backup.verify_db_connection_obj.type != db_type
+            ):
+                raise ValueError(
+                    f"Backup '{backup.id}': verify_db_connection_id '{backup.verify_db_connection_id}' is not a {db_type.value} connection."
+                )
+            if (
+                backup.verify_db_connection_obj
+                and not backup.verify_db_connection_obj.database
+            ):
+                raise ValueError(
+                    f"Backup '{backup.id}': verify_db_connection_id '{backup.verify_db_connection_id}' must have a database."
+                )
+            # the drills drop and restore databases on the scratch server
+            if backup.verify_db_connection_obj and set(
+                backup.verify_db_connection_obj.servers
+            ) & set(backup.db_connection_obj.servers):
+                raise ValueError(
+                    f"Backup '{backup.id}': verify_db_connection_id '{backup.verify_db_connection_id}' must not be the backed up server or one of its replicas."
+                )
+
             backup.notification_objs = [
                 notification
                 for notification in model.notifications
@@ -1,4 +1,8 @@
+from contextlib import contextmanager
 from datetime import datetime
+from typing import Dict, List, Optional
+
+from data.StageData import StageData
 
 
 class BackupData:
@@ -10,6 +14,7 @@ class BackupData:
         protocol: str,
         compress: bool,
         encrypt: bool,
+        kind: str = "backup",
     ):
         self.id = id
         self.database = database
@@ -17,6 +22,7 @@ class BackupData:
         self.protocol = protocol
         self.compress = compress
         self.encrypt = encrypt
+        self.kind = kind  # "backup", or "drill" for a restore drill
         self.success = False
         self.status_short = None
         self.status = None
@@ -24,6 +30,47 @@ class BackupData:
         self.start_time = datetime.now()
         self.end_time = None
         self.duration_in_seconds = None
+        self.stages: List[StageData] = []
+        self.artifact: Optional[str] = None
+        self.artifact_size: Optional[int] = None
+        self.checksum: Optional[str] = None  # SHA-256 of the artifact
+        self.row_counts: Optional[Dict[str, int]] = None
+        self.engine: Optional[str] = None  # mysqldump, xtrabackup or mariabackup
+        # size, dump time and number of tables of each database of a multi-database run
+        self.databases: Optional[Dict[str, dict]] = None
+        self.codec: Optional[str] = None
+        self.codec_level: Optional[int] = None
+        # measures behind the codec picked by the auto compression mode
+        self.codec_choice: Optional[dict] = None
+        self.dictionary: Optional[str] = None
+        # server dumped: "primary" or the host:port of a replica, and its lag
+        self.source: Optional[str] = None
+        self.source_lag: Optional[int] = None
+        # time waited for a quiet database by the admission check
+        self.deferred_seconds: Optional[float] = None
+        self.admission: Optional[dict] = None
+        # kept in the spool after a failed upload, see worker/spool.py
+        self.spooled = False
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measures a stage of the backup task, the yielded StageData can be used to
+        record the bytes read and written by the stage.
+        """
+        stage = StageData(name)
+        self.stages.append(stage)
+        stage.start()
+        try:
+            yield stage
+        finally:
+            stage.stop()
+
+    def get_stage(self, name: str) -> Optional[StageData]:
+        return next((stage for stage in self.stages if stage.name == name), None)
+
+    def get_stages_summary(self) -> str:
+        return "\n".join(str(stage) for stage in self.stages)
 
     def _get_backup_data_succes_status(self) -> str:
         return f"[{self.id}] Backup task completed successfully!"
@@ -32,10 +79,11 @@ class BackupData:
         return f"[{self.id}] Backup task failed: {error}"
 
     def set_status(self, success, error=None):
+        name = "Restore drill" if self.kind == "drill" else "Backup"
         self.status_short = (
-            f"✅ Backup [{self.id}] successful ✅"
+            f"✅ {name} [{self.id}] successful ✅"
             if success
-            else f"❌ Backup [{self.id}] failed ❌"
+            else f"❌ {name} [{self.id}] failed ❌"
         )
         self.status = "Operational" if success else f"Error - {error}"
         self.success = success
@@ -44,3 +92,40 @@ class BackupData:
         self.duration_in_seconds = (
             f"{round((self.end_time - self.start_time).total_seconds(), 3)}s"
         )
+
+    def get_duration(self) -> Optional[float]:
+        if not self.end_time:
+            return None
+        return (self.end_time - self.start_time).total_seconds()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "database": self.database,
+            "host": self.host,
+            "protocol": self.protocol,
+            "compress": self.compress,
+            "encrypt": self.encrypt,
+            "success": self.success,
+            "error": self.error,
+            "start_time": self.start_time.isoformat(),
+            "end_time": self.end_time.isoformat() if self.end_time else None,
+            "duration": self.get_duration(),
+            "artifact": self.artifact,
+            "artifact_size": self.artifact_size,
+            "checksum": self.checksum,
+            "row_counts": self.row_counts,
+            "engine": self.engine,
+            "databases": self.databases,
+            "codec": self.codec,
+            "codec_level": self.codec_level,
+            "codec_choice": self.codec_choice,
+            "dictionary": self.dictionary,
+            "source": self.source,
+            "source_lag": self.source_lag,
+            "deferred_seconds": self.deferred_seconds,
+            "admission": self.admission,
+            "spooled": self.spooled,
+            "stages": [stage.to_dict() for stage in self.stages],
+        }
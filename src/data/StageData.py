@@ -0,0 +1,79 @@
+import time
+from typing import Optional
+
+from worker.utils import format_bytes
+
+
+class StageData:
+    """
+    Timing and size measurements of a single stage of a backup task
+    (dump, compression, encryption, upload, retention).
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.bytes_in: Optional[int] = None
+        self.bytes_out: Optional[int] = None
+        self.wall_time: Optional[float] = None
+        # cpu time of the worker thread, work done by subprocesses (e.g. mysqldump) is not included
+        self.cpu_time: Optional[float] = None
+        # SHA-256 of the file written by the stage, hashed while it is written
+        self.sha256: Optional[str] = None
+        # runs of the stage, more than 1 when it was retried
+        self.attempts = 1
+        self._wall_start = None
+        self._cpu_start = None
+
+    def start(self):
+        self._wall_start = time.perf_counter()
+        self._cpu_start = time.thread_time()
+
+    def stop(self):
+        self.wall_time = time.perf_counter() - self._wall_start
+        self.cpu_time = time.thread_time() - self._cpu_start
+
+    @property
+    def compression_ratio(self) -> Optional[float]:
+        if not self.bytes_in or not self.bytes_out:
+            return None
+        return self.bytes_in / self.bytes_out
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """
+        Throughput in MB/s, based on the bytes read by the stage (or written if
+        the stage has no input file, like the dump).
+        """
+        size = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        if size is None or not self.wall_time:
+            return None
+        return size / self.wall_time / 1_000_000
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "wall_time": self.wall_time,
+            "cpu_time": self.cpu_time,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "compression_ratio": self.compression_ratio,
+            "throughput": self.throughput,
+            "sha256": self.sha256,
+            "attempts": self.attempts,
+        }
+
+    def __str__(self) -> str:
+        parts = [f"{self.wall_time or 0:.3f}s wall", f"{self.cpu_time or 0:.3f}s cpu"]
+        if self.bytes_in is not None and self.bytes_out is not None:
+            parts.append(
+                f"{format_bytes(self.bytes_in)} -> {format_bytes(self.bytes_out)}"
+            )
+        elif self.bytes_in is not None or self.bytes_out is not None:
+            parts.append(format_bytes(self.bytes_in or self.bytes_out))
+        if self.compression_ratio and abs(self.compression_ratio - 1) > 0.01:
+            parts.append(f"ratio {self.compression_ratio:.2f}")
+        if self.throughput is not None:
+            parts.append(f"{self.throughput:.2f} MB/s")
+        if self.attempts > 1:
+            parts.append(f"{self.attempts} attempts")
+        return f"{self.name}: {', '.join(parts)}"
@@ -1,13 +1,425 @@
+import argparse
+import os
 import sys
+from functools import partial
+
+from loguru import logger
 
 from config import get_config
 from logger import setup_logger
-from scheduler import start_scheduler
-from worker import tasks
+from worker import profiling, progress
 
-if __name__ == "__main__":
-    config = get_config("/dbackup/config/config.yaml")
+DEFAULT_CONFIG_PATH = "/dbackup/config/config.yaml"
+
+# exit codes, so that one-shot runs (e.g. Kubernetes CronJobs) can be monitored
+EXIT_SUCCESS = 0
+EXIT_CONFIG_ERROR = 1
+EXIT_USAGE_ERROR = 2  # raised by argparse
+EXIT_BACKUP_FAILED = 3
+EXIT_UNKNOWN_BACKUP = 4
+EXIT_RESTORE_FAILED = 5
+EXIT_VERIFY_FAILED = 6
+EXIT_LIFECYCLE_FAILED = 7
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog="dbackup")
+    parser.add_argument(
+        "--config", default=DEFAULT_CONFIG_PATH, help="Path to the config file."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    subparsers.add_parser("schedule", help="Run the scheduler daemon (default).")
+
+    run_parser = subparsers.add_parser("run", help="Run backups once and exit.")
+    run_parser.add_argument("backup_ids", nargs="*", help="Ids of the backups to run.")
+    run_parser.add_argument(
+        "--all", action="store_true", help="Run all the configured backups."
+    )
+    run_parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Maximum number of backups to run at the same time.",
+    )
+    run_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile each stage with cProfile and tracemalloc.",
+    )
+
+    history_parser = subparsers.add_parser(
+        "history", help="Show duration and size trends from the run history."
+    )
+    history_parser.add_argument(
+        "backup_ids", nargs="*", help="Ids of the backups (default: all)."
+    )
+    history_parser.add_argument(
+        "--days", type=int, default=30, help="Number of days to look back."
+    )
+    history_parser.add_argument(
+        "--runs", type=int, help="List the last N runs instead of the trends."
+    )
+    history_parser.add_argument(
+        "--json", action="store_true", help="Print the result as JSON."
+    )
+
+    restore_parser = subparsers.add_parser(
+        "restore", help="Restore a backup from its destination."
+    )
+    restore_parser.add_argument("backup_id", help="Id of the backup to restore.")
+    restore_parser.add_argument(
+        "--file", help="Backup file to restore (default: the latest one)."
+    )
+    restore_parser.add_argument(
+        "--database",
+        help="Database to restore into (default: the backed up database).",
+    )
+    restore_parser.add_argument(
+        "--databases",
+        type=lambda value: [name for name in value.split(",") if name],
+        help="Comma-separated databases to restore from a backup of several"
+        " databases (default: all of them).",
+    )
+    restore_parser.add_argument(
+        "--prefix",
+        default="",
+        help="Prefix of the names of the databases restored from a backup of"
+        " several databases.",
+    )
+    restore_parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Number of tables restored at the same time, or of threads"
+        " extracting a physical backup.",
+    )
+    restore_parser.add_argument(
+        "--target-dir",
+        help="Directory to extract and prepare a physical backup into (required"
+        " for xtrabackup and mariabackup backups).",
+    )
+    restore_parser.add_argument(
+        "--datadir",
+        help="Empty data directory of a stopped server to copy the prepared"
+        " physical backup back into.",
+    )
+    restore_parser.add_argument(
+        "--list", action="store_true", help="List the backup files and exit."
+    )
+
+    drill_parser = subparsers.add_parser(
+        "drill",
+        help="Restore the latest backups into their scratch database and check them.",
+    )
+    drill_parser.add_argument("backup_ids", nargs="+", help="Ids of the backups.")
+    drill_parser.add_argument(
+        "--parallel",
+        type=int,
+        default=1,
+        help="Number of tables restored at the same time.",
+    )
+
+    verify_parser = subparsers.add_parser(
+        "verify", help="Check backup files against their manifests."
+    )
+    verify_parser.add_argument("backup_id", help="Id of the backup to check.")
+    verify_parser.add_argument(
+        "--file", help="Backup file to check (default: the latest one)."
+    )
+    verify_parser.add_argument(
+        "--all", action="store_true", help="Check all the backup files."
+    )
+    verify_parser.add_argument(
+        "--download",
+        action="store_true",
+        help="Download the files to hash them when the protocol cannot hash remotely.",
+    )
+
+    lifecycle_parser = subparsers.add_parser(
+        "lifecycle", help="Move the aging backup files to their next storage tier."
+    )
+    lifecycle_parser.add_argument("backup_ids", nargs="*", help="Ids of the backups.")
+    lifecycle_parser.add_argument(
+        "--all", action="store_true", help="Apply the lifecycle of all the backups."
+    )
+
+    args = parser.parse_args(argv)
+    if args.command in ("restore", "drill") and args.parallel < 1:
+        parser.error(f"{args.command}: --parallel must be at least 1")
+    if args.command == "restore" and args.datadir and not args.target_dir:
+        parser.error("restore: --datadir requires --target-dir")
+    if args.command == "lifecycle" and args.all == bool(args.backup_ids):
+        parser.error("lifecycle: specify either backup ids or --all")
+    if args.command == "run":
+        if args.all == bool(args.backup_ids):
+            parser.error("run: specify either backup ids or --all")
+        if args.parallel < 1:
+            parser.error("run: --parallel must be at least 1")
+    return args
+
+
+def _run(config, args) -> int:
+    from runner import run_backups
+    from worker import tasks
+    from worker.spool import get_spool
+
+    if args.all:
+        backups = config.backups
+    else:
+        backups_by_id = {backup.id: backup for backup in config.backups}
+        unknown_ids = [id for id in args.backup_ids if id not in backups_by_id]
+        if unknown_ids:
+            logger.error(f"Unknown backup id(s): {', '.join(unknown_ids)}")
+            return EXIT_UNKNOWN_BACKUP
+        backups = [backups_by_id[id] for id in args.backup_ids]
+
+    backup_task = tasks.backup_task
+    if args.profile:
+        backup_task = partial(tasks.backup_task, profile=True)
+
+    results = run_backups(backup_task, backups, args.parallel)
+    spool = get_spool()
+    if spool:
+        # the backup files spooled by this run or the previous ones
+        left = spool.drain()
+        if left:
+            logger.warning(f"{left} backup file(s) left in the spool")
+    failed = [backup_data.id for backup_data in results if not backup_data.success]
+    if failed:
+        logger.error(
+            f"{len(failed)}/{len(results)} backup(s) failed: {', '.join(failed)}"
+        )
+        return EXIT_BACKUP_FAILED
+    return EXIT_SUCCESS
+
+
+def _history(args) -> int:
+    import json
+
+    from worker.history import get_store
+    from worker.utils import format_bytes
+
+    store = get_store()
+    if not store:
+        logger.error("The run history is disabled or could not be opened")
+        return EXIT_CONFIG_ERROR
+    backup_ids = args.backup_ids or store.get_backup_ids()
+
+    if args.runs:
+        result = [
+            run for id in backup_ids for run in store.get_runs(id, limit=args.runs)
+        ]
+        if args.json:
+            print(json.dumps(result, indent=2))
+            return EXIT_SUCCESS
+        for run in result:
+            status = "ok" if run["success"] else f"failed ({run['error']})"
+            print(
+                f"{run['start_time']}  {run['backup_id']}  {run['kind']}"
+                f"  {run['duration'] or 0:.1f}s"
+                f"  {format_bytes(run['artifact_size'] or 0)}  {status}"
+            )
+        return EXIT_SUCCESS
+
+    result = [store.get_stats(id, args.days) for id in backup_ids]
+    if args.json:
+        print(json.dumps(result, indent=2))
+        return EXIT_SUCCESS
+    print(f"Last {args.days} days:")
+    for stats in result:
+        growth = stats["size_growth"]
+        print(
+            f"{stats['backup_id']}: {stats['runs']} runs, {stats['failures']} failed,"
+            f" p50 {stats['duration_p50'] or 0:.1f}s, p95 {stats['duration_p95'] or 0:.1f}s,"
+            f" last size {format_bytes(stats['last_size'] or 0)},"
+            f" size growth {'-' if growth is None else f'{growth:+.1%}'}"
+        )
+        for stage, p95 in stats["stage_p95"].items():
+            print(f"  {stage}: p95 {p95:.1f}s")
+        if stats["drills"]:
+            print(
+                f"  restore drills: {stats['drills']} runs,"
+                f" {stats['drill_failures']} failed,"
+                f" last restore {stats['last_restore'] or 0:.1f}s,"
+                f" p95 {stats['restore_p95'] or 0:.1f}s"
+            )
+    return EXIT_SUCCESS
+
+
+def _restore(config, args) -> int:
+    from worker import restore
+    from worker.lifecycle import connect_tier, get_tiers
+
+    backup = next(
+        (backup for backup in config.backups if backup.id == args.backup_id), None
+    )
+    if not backup:
+        logger.error(f"Unknown backup id: {args.backup_id}")
+        return EXIT_UNKNOWN_BACKUP
+
+    if args.list:
+        # the last tiers hold the oldest files
+        for tier in reversed(get_tiers(backup)):
+            client = connect_tier(tier)
+            try:
+                for filename in restore.list_backup_files(tier, client):
+                    print(filename)
+            finally:
+                client.disconnect()
+        return EXIT_SUCCESS
+
+    try:
+        if args.target_dir:
+            from worker.engines.physical import restore_physical_backup
+
+            restore_physical_backup(
+                backup, args.target_dir, args.file, args.datadir, args.parallel
+            )
+        else:
+            restore.restore_backup(
+                backup,
+                args.file,
+                args.database,
+                args.parallel,
+                databases=args.databases,
+                prefix=args.prefix,
+            )
+    except Exception as e:
+        logger.error(f"[{backup.id}] Restore failed: {e}")
+        return EXIT_RESTORE_FAILED
+    return EXIT_SUCCESS
+
+
+def _drill(config, args) -> int:
+    from worker import tasks
+
+    backups_by_id = {backup.id: backup for backup in config.backups}
+    unknown_ids = [id for id in args.backup_ids if id not in backups_by_id]
+    if unknown_ids:
+        logger.error(f"Unknown backup id(s): {', '.join(unknown_ids)}")
+        return EXIT_UNKNOWN_BACKUP
+
+    results = [
+        tasks.drill_task(backups_by_id[id], args.parallel) for id in args.backup_ids
+    ]
+    if not all(backup_data.success for backup_data in results):
+        return EXIT_RESTORE_FAILED
+    return EXIT_SUCCESS
+
+
+def _verify(config, args) -> int:
+    from worker.manifest import verify_backup
+
+    backup = next(
+        (backup for backup in config.backups if backup.id == args.backup_id), None
+    )
+    if not backup:
+        logger.error(f"Unknown backup id: {args.backup_id}")
+        return EXIT_UNKNOWN_BACKUP
+
+    try:
+        results = verify_backup(backup, args.file, args.all, args.download)
+    except Exception as e:
+        logger.error(f"[{backup.id}] Verification failed: {e}")
+        return EXIT_VERIFY_FAILED
+    if not results:
+        logger.error(f"[{backup.id}] No backup file found in {backup.path}")
+        return EXIT_VERIFY_FAILED
+    if any(result["errors"] for result in results):
+        return EXIT_VERIFY_FAILED
+    return EXIT_SUCCESS
+
+
+def _lifecycle(config, args) -> int:
+    from worker.lifecycle import apply_lifecycle
+
+    if args.all:
+        backups = [backup for backup in config.backups if backup.lifecycle]
+    else:
+        backups_by_id = {backup.id: backup for backup in config.backups}
+        unknown_ids = [id for id in args.backup_ids if id not in backups_by_id]
+        if unknown_ids:
+            logger.error(f"Unknown backup id(s): {', '.join(unknown_ids)}")
+            return EXIT_UNKNOWN_BACKUP
+        backups = [backups_by_id[id] for id in args.backup_ids]
+
+    failed = 0
+    for backup in backups:
+        if not backup.lifecycle:
+            logger.warning(f"[{backup.id}] No lifecycle configured")
+            continue
+        stats = apply_lifecycle(backup)
+        logger.info(
+            f"[{backup.id}] Lifecycle: {stats['moved']} file(s) moved,"
+            f" {stats['deleted']} deleted, {stats['failed']} failed"
+        )
+        failed += stats["failed"]
+    return EXIT_LIFECYCLE_FAILED if failed else EXIT_SUCCESS
+
+
+def _schedule(config) -> int:
+    from scheduler import start_scheduler
+    from worker import tasks
+
+    start_scheduler(tasks.backup_task, config, tasks.drill_task)
+    return EXIT_SUCCESS
+
+
+def main(argv=None) -> int:
+    args = _parse_args(argv)
+    config = get_config(args.config)
     if not config:
-        sys.exit(1)
+        return EXIT_CONFIG_ERROR
     setup_logger(config.log)
-    start_scheduler(tasks.backup_task, config)
+    progress.set_log_interval(config.log.progress_interval)
+    profiling.set_report_dir(
+        os.path.join(os.path.dirname(config.log.filename), "profiles")
+    )
+    if config.history.enabled:
+        from worker.history import init_history
+
+        init_history(config.history.filename)
+    if config.spool.enabled:
+        from worker.spool import init_spool
+
+        init_spool(config.spool, config.backups)
+    # the other commands send no notification, and must not load their clients
+    notify = bool(config.notifications) and args.command in (
+        None,
+        "schedule",
+        "run",
+        "drill",
+    )
+    if notify:
+        from worker.notification import start_dispatcher
+
+        start_dispatcher(config.notification_delivery)
+
+    try:
+        if args.command == "run":
+            return _run(config, args)
+        if args.command == "history":
+            return _history(args)
+        if args.command == "restore":
+            return _restore(config, args)
+        if args.command == "drill":
+            return _drill(config, args)
+        if args.command == "verify":
+            return _verify(config, args)
+        if args.command == "lifecycle":
+            return _lifecycle(config, args)
+        return _schedule(config)
+    finally:
+        if notify:
+            from worker.notification import stop_dispatcher
+
+            stop_dispatcher()
+
+        from worker.history import close_history
+
+        close_history()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
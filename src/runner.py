@@ -0,0 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from loguru import logger
+
+from config import Backup
+from data.BackupData import BackupData
+
+
+def run_backups(
+    backup_task, backups: List[Backup], parallel: int = 1
+) -> List[BackupData]:
+    """
+    Runs the given backups once, outside of the scheduler.
+
+    :param backup_task: The task to run for each backup.
+    :param backups: The backups to run.
+    :param parallel: The maximum number of backups to run at the same time.
+    :return: The BackupData of every run, in the order of the backups.
+    """
+    logger.info(f"Running {len(backups)} backup(s) with parallelism {parallel}...")
+    if parallel <= 1 or len(backups) <= 1:
+        return [backup_task(backup) for backup in backups]
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        return list(executor.map(backup_task, backups))
@@ -1,19 +1,122 @@
+import threading
 import time
 from config import Config
+from apscheduler.events import EVENT_JOB_SUBMITTED
+from apscheduler.jobstores.base import ConflictingIdError
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 from loguru import logger
+from worker import metrics
+from worker.spool import get_spool
 
+# ids of the running backups, a scheduled and a manual run of one backup never overlap
+_running_backups = set()
+_running_lock = threading.Lock()
 
-def start_scheduler(backup_task, config: Config):
+
+def _is_running(backup_id: str) -> bool:
+    with _running_lock:
+        return backup_id in _running_backups
+
+
+def _run_backup_job(backup_task, backup, profile=None):
+    metrics.job_started()
+    with _running_lock:
+        skip = backup.id in _running_backups
+        _running_backups.add(backup.id)
+    if skip:
+        metrics.job_finished()
+        logger.warning(f"[{backup.id}] Skipping the run, the backup is already running")
+        return
+    try:
+        backup_data = backup_task(backup, profile=profile)
+    finally:
+        metrics.job_finished()
+        with _running_lock:
+            _running_backups.discard(backup.id)
+    metrics.observe_backup(backup_data)
+
+
+def _run_drill_job(drill_task, backup):
+    metrics.job_started()
+    try:
+        backup_data = drill_task(backup)
+    finally:
+        metrics.job_finished()
+    metrics.observe_drill(backup_data)
+
+
+def _run_lifecycle_job(backup):
+    from worker.lifecycle import apply_lifecycle
+
+    metrics.job_started()
+    try:
+        apply_lifecycle(backup)
+    finally:
+        metrics.job_finished()
+
+
+def start_scheduler(backup_task, config: Config, drill_task=None):
     logger.info("Starting scheduler...")
     scheduler = BackgroundScheduler()
+    backups_by_id = {backup.id: backup for backup in config.backups}
+
+    def run_backup_now(backup_id: str, profile: bool = None) -> str:
+        backup = backups_by_id.get(backup_id)
+        if not backup:
+            return "unknown"
+        if _is_running(backup_id):
+            return "running"
+        # a job without trigger runs once, as soon as a worker is free; its id
+        # refuses a second manual run while the first one is still pending
+        try:
+            scheduler.add_job(
+                _run_backup_job,
+                args=[backup_task, backup, profile],
+                id=f"{backup_id}-manual",
+                name=f"{backup_id} (manual)",
+            )
+        except ConflictingIdError:
+            return "running"
+        logger.info(f"[{backup_id}] Manual run requested (profile: {bool(profile)})")
+        return "queued"
+
+    if config.http_server.enabled:
+        from server import start_http_server
+
+        start_http_server(config.http_server, run_backup_now)
+
+    scheduler.add_listener(lambda _event: metrics.job_submitted(), EVENT_JOB_SUBMITTED)
     for backup in config.backups:
         trigger = CronTrigger.from_crontab(backup.schedule)
-        scheduler.add_job(backup_task, trigger=trigger, args=[backup], id=backup.id)
+        scheduler.add_job(
+            _run_backup_job,
+            trigger=trigger,
+            args=[backup_task, backup],
+            id=backup.id,
+        )
+        if backup.verify_schedule and drill_task:
+            scheduler.add_job(
+                _run_drill_job,
+                trigger=CronTrigger.from_crontab(backup.verify_schedule),
+                args=[drill_task, backup],
+                id=f"{backup.id}-drill",
+            )
+        if backup.lifecycle:
+            scheduler.add_job(
+                _run_lifecycle_job,
+                trigger=CronTrigger.from_crontab(backup.lifecycle_schedule),
+                args=[backup],
+                id=f"{backup.id}-lifecycle",
+            )
+    spool = get_spool()
+    if spool:
+        spool.start_drainer()
     scheduler.start()
     try:
         while True:
             time.sleep(60)
     except (KeyboardInterrupt, SystemExit):
         scheduler.shutdown()
+        if spool:
+            spool.stop_drainer()
@@ -0,0 +1,132 @@
+import hmac
+import ipaddress
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
+from loguru import logger
+
+from config import HttpServer
+from worker import history, metrics, progress
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path == "/metrics":
+            self._send(200, metrics.render(), "text/plain; version=0.0.4")
+        elif url.path == "/status":
+            self._send_json(200, {"running": progress.get_status()})
+        elif url.path == "/history":
+            self._send_history_stats(query)
+        elif url.path == "/history/runs":
+            self._send_history_runs(query)
+        else:
+            self._send(404, b"Not found\n", "text/plain")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        if url.path.startswith("/run/") and self.server.run_backup:
+            if not self._is_authorized():
+                return self._send_json(401, {"error": "unauthorized"})
+            backup_id = url.path[len("/run/") :]
+            profile = query.get("profile", "").lower() in ("1", "true", "yes")
+            status = self.server.run_backup(backup_id, profile=profile or None)
+            if status == "queued":
+                self._send_json(202, {"backup_id": backup_id, "profile": profile})
+            elif status == "running":
+                self._send_json(
+                    409, {"error": f"backup '{backup_id}' is already running"}
+                )
+            else:
+                self._send_json(404, {"error": f"unknown backup id '{backup_id}'"})
+        else:
+            self._send(404, b"Not found\n", "text/plain")
+
+    def _is_authorized(self) -> bool:
+        token = self.server.token
+        if not token:
+            # without a token, only the local host may trigger runs
+            return _is_loopback(self.client_address[0])
+        header = self.headers.get("Authorization", "")
+        return hmac.compare_digest(header.encode(), f"Bearer {token}".encode())
+
+    def _send_history_stats(self, query: dict):
+        store = history.get_store()
+        if not store:
+            return self._send_json(503, {"error": "run history is disabled"})
+        backup_ids = [query["backup_id"]] if "backup_id" in query else None
+        days = _get_int(query, "days", 30)
+        if days is None:
+            return self._send_json(400, {"error": "days must be a positive integer"})
+        self._send_json(
+            200,
+            [store.get_stats(id, days) for id in backup_ids or store.get_backup_ids()],
+        )
+
+    def _send_history_runs(self, query: dict):
+        store = history.get_store()
+        if not store:
+            return self._send_json(503, {"error": "run history is disabled"})
+        limit = _get_int(query, "limit", 50)
+        if limit is None:
+            return self._send_json(400, {"error": "limit must be a positive integer"})
+        self._send_json(200, store.get_runs(query.get("backup_id"), limit=limit))
+
+    def _send_json(self, status: int, data):
+        self._send(status, json.dumps(data).encode(), "application/json")
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"HTTP {self.address_string()} - {format % args}")
+
+
+def _get_int(query: dict, name: str, default: int) -> Optional[int]:
+    """
+    Returns a positive integer parameter of a query, or None if it is not one.
+    """
+    try:
+        value = int(query.get(name, default))
+    except ValueError:
+        return None
+    return value if value > 0 else None
+
+
+def _is_loopback(host: str) -> bool:
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == "localhost"
+
+
+def start_http_server(config: HttpServer, run_backup=None) -> ThreadingHTTPServer:
+    """
+    Starts the HTTP server in a background thread.
+
+    :param config: The HTTP server config.
+    :param run_backup: Optional callable (backup_id, profile) that queues a backup
+        run and returns "queued", "running" or "unknown", exposed as
+        POST /run/<backup_id>.
+    """
+    metrics.init_metrics()
+    server = ThreadingHTTPServer((config.host, config.port), RequestHandler)
+    server.run_backup = run_backup
+    server.token = config.token
+    if run_backup and not config.token and not _is_loopback(config.host):
+        logger.warning(
+            "HTTP server: no token configured, POST /run is only allowed from the local host"
+        )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    logger.info(f"HTTP server listening on {config.host}:{config.port}")
+    return server
@@ -0,0 +1,139 @@
+"""
+Admission check of the backups: delays a dump while the database is busy.
+
+The load of the server about to be dumped (threads running, queries per second
+and, for a replica, replication lag) is sampled and compared with the thresholds
+of the backup. While one is exceeded, the dump waits with an exponential backoff
+until load_defer_max_seconds, then runs anyway.
+"""
+
+import time
+from typing import List, Optional
+
+from loguru import logger
+
+from config import Backup, DBConnection
+from worker.db import get_replication_lag, run_query
+from worker.progress import format_duration
+
+# seconds between the two samples of the Questions counter giving the QPS
+QPS_SAMPLE_SECONDS = 5
+FIRST_DELAY_SECONDS = 30
+MAX_DELAY_SECONDS = 600
+
+
+def has_load_thresholds(backup: Backup) -> bool:
+    return any(
+        threshold is not None
+        for threshold in (
+            backup.load_max_threads_running,
+            backup.load_max_qps,
+            backup.load_max_replication_lag_seconds,
+        )
+    )
+
+
+def _get_status(db_connection: DBConnection) -> dict:
+    rows = run_query(
+        db_connection,
+        "SHOW GLOBAL STATUS WHERE Variable_name IN ('Threads_running', 'Questions')",
+    )
+    return {name.lower(): int(value) for name, value in rows}
+
+
+def get_load(backup: Backup, db_connection: DBConnection, replica: bool) -> dict:
+    """
+    Samples the load of a server, only the values that the backup has a
+    threshold for.
+
+    :param replica: Whether the server is a replica, to sample its lag.
+    """
+    load = {}
+    if backup.load_max_threads_running is not None or backup.load_max_qps is not None:
+        start = time.monotonic()
+        status = _get_status(db_connection)
+        load["threads_running"] = status["threads_running"]
+        if backup.load_max_qps is not None:
+            time.sleep(QPS_SAMPLE_SECONDS)
+            questions = _get_status(db_connection)["questions"] - status["questions"]
+            load["qps"] = round(questions / (time.monotonic() - start), 1)
+    if backup.load_max_replication_lag_seconds is not None and replica:
+        load["replication_lag"] = get_replication_lag(db_connection)
+    return load
+
+
+def get_overloads(backup: Backup, load: dict) -> List[str]:
+    """
+    Returns the load values over the thresholds of the backup.
+    """
+    thresholds = {
+        "threads_running": backup.load_max_threads_running,
+        "qps": backup.load_max_qps,
+        "replication_lag": backup.load_max_replication_lag_seconds,
+    }
+    return [
+        f"{name} {load[name]} > {thresholds[name]}"
+        for name in thresholds
+        if name in load
+        and thresholds[name] is not None
+        and load[name] > thresholds[name]
+    ]
+
+
+def wait_for_quiet_database(
+    backup: Backup, db_connection: DBConnection, replica: bool = False
+) -> dict:
+    """
+    Waits until the load of a server is under the thresholds of the backup,
+    checking again after 30 seconds, then twice as long each time up to 10
+    minutes, for at most load_defer_max_seconds.
+
+    A load that cannot be sampled does not delay the backup.
+
+    :return: The admission: deferred_seconds, checks, forced (the deadline was
+        reached) and the last sampled load.
+    """
+    start = time.monotonic()
+    deadline = start + (backup.load_defer_max_seconds or 0)
+    delay = FIRST_DELAY_SECONDS
+    checks = 0
+    load: Optional[dict] = None
+    forced = False
+    while True:
+        checks += 1
+        try:
+            load = get_load(backup, db_connection, replica)
+        except Exception as e:
+            logger.warning(f"[{backup.id}] Cannot sample the database load: {e}")
+            break
+        overloads = get_overloads(backup, load)
+        if not overloads:
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            forced = True
+            logger.warning(
+                f"[{backup.id}] Database still busy ({', '.join(overloads)}) after"
+                f" {format_duration(time.monotonic() - start)}, starting the dump"
+            )
+            break
+        wait = min(delay, remaining)
+        logger.info(
+            f"[{backup.id}] Database busy ({', '.join(overloads)}),"
+            f" deferring the dump by {format_duration(wait)}"
+        )
+        time.sleep(wait)
+        delay = min(delay * 2, MAX_DELAY_SECONDS)
+
+    deferred_seconds = 0.0
+    if checks > 1:
+        deferred_seconds = round(time.monotonic() - start, 1)
+        logger.info(
+            f"[{backup.id}] Dump deferred by {format_duration(deferred_seconds)}"
+        )
+    return {
+        "deferred_seconds": deferred_seconds,
+        "checks": checks,
+        "forced": forced,
+        "load": load,
+    }
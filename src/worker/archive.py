@@ -0,0 +1,81 @@
+"""
+Tar archives of the dumps of several databases.
+
+A backup of several databases packs their dumps into one tar, the backup file,
+with one member per database named after it:
+
+    <prefix><date>.sql.tar[.xz|.gz|.zst][.enc]
+        app.sql
+        tenant_1.sql
+        ...
+
+Restores read the members from the decompressed stream, one after the other.
+"""
+
+import os
+import tarfile
+from contextlib import contextmanager
+from typing import Iterator, Tuple
+
+from worker.file import MeteredFile
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ChunksReader:
+    """
+    A binary file object reading from an iterator of chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+        self.position = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) - self.position < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.buffer = self.buffer[self.position :] + chunk
+            self.position = 0
+        end = (
+            len(self.buffer)
+            if size < 0
+            else min(self.position + size, len(self.buffer))
+        )
+        data = self.buffer[self.position : end]
+        self.position = end
+        return data
+
+
+@contextmanager
+def pack_files(filepath: str, digest=None):
+    """
+    Writes a tar of files, digest is updated with the written bytes.
+
+    Yields a function (name, path) adding a file to the tar under name, then
+    deleting it, so that the files can be packed as soon as they are written.
+    """
+    with open(filepath, "wb") as file, tarfile.open(
+        fileobj=MeteredFile(file, digest), mode="w|"
+    ) as tar:
+
+        def add(name: str, path: str):
+            tar.add(path, arcname=name)
+            os.remove(path)
+
+        yield add
+
+
+def iter_members(chunks) -> Iterator[Tuple[str, Iterator[bytes]]]:
+    """
+    Reads a tar from its chunks and yields the name and the chunks of each file.
+    The chunks of a member must be consumed before the next one is read.
+    """
+    with tarfile.open(fileobj=ChunksReader(chunks), mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            file = tar.extractfile(member)
+            yield member.name, iter(lambda: file.read(CHUNK_SIZE), b"")
@@ -1,20 +1,128 @@
 import lzma
+import os
+import time
+import zlib
+from typing import Optional
+
 from loguru import logger
 
+from worker.file import BACKUP_EXTENSIONS
+
+CHUNK_SIZE = 1024 * 1024
+
+# name: (file extension, default level, levels tried by the auto mode)
+CODECS = {
+    "xz": (".xz", 6, (0, 1, 3, 6)),
+    "gzip": (".gz", 6, (1, 6)),
+    "zstd": (".zst", 3, (1, 3, 9, 15)),
+}
+DEFAULT_CODEC = "xz"
+# the auto mode compresses SAMPLE_SLICES slices spread over the dump with each
+# candidate, SAMPLE_SIZE bytes in total and at most 1/SAMPLE_SLICES of the dump
+SAMPLE_SIZE = 1024 * 1024
+SAMPLE_SLICES = 8
+
+
+def has_codec(codec: str) -> bool:
+    if codec != "zstd":
+        return codec in CODECS
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_codec_from_filename(filename: str) -> Optional[str]:
+    """
+    Returns the codec of a backup file from its extension, or None.
+    """
+    for codec, (extension, _level, _levels) in CODECS.items():
+        if any(f"{base}{extension}" in filename for base in BACKUP_EXTENSIONS):
+            return codec
+    return None
+
+
+def _compressor(codec: str, level: int = None, dictionary=None):
+    """
+    Returns a compression object with compress() and flush() methods.
+
+    :param dictionary: Optional zstandard.ZstdCompressionDict, for zstd only.
+    """
+    if level is None:
+        level = CODECS[codec][1]
+    if codec == "xz":
+        return lzma.LZMACompressor(preset=level)
+    if codec == "gzip":
+        # gzip container, like the gzip command
+        return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    if codec == "zstd":
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=level, dict_data=dictionary).compressobj()
+    raise ValueError(f"Unknown compression codec: '{codec}'")
+
+
+def _decompressor(codec: str, dictionary=None):
+    if codec == "gzip":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if codec == "zstd":
+        import zstandard
+
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj()
+    raise ValueError(f"Unknown compression codec: '{codec}'")
+
+
+def compress_bytes(
+    data: bytes, codec: str = DEFAULT_CODEC, level: int = None, dictionary=None
+):
+    compressor = _compressor(codec, level, dictionary)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress_bytes(
+    data: bytes, codec: str = DEFAULT_CODEC, get_dictionary=None
+) -> bytes:
+    return b"".join(decompress_chunks([data], codec, get_dictionary))
+
 
-def compress_file(filepath):
+def compress_file(
+    filepath,
+    progress=None,
+    digest=None,
+    codec=DEFAULT_CODEC,
+    level=None,
+    dictionary=None,
+):
     """
-    Compresses a file using XZ compression.
+    Compresses a file using XZ, gzip or zstd compression.
 
     :param filepath: The path to the file to compress.
+    :param progress: Optional ProgressTracker updated with the bytes read.
+    :param digest: Optional hashlib object updated with the bytes written.
+    :param codec: The codec, one of CODECS.
+    :param level: The compression level (default: the default of the codec).
+    :param dictionary: Optional zstandard.ZstdCompressionDict, for zstd only.
     :return: The path to the compressed file.
     """
-    compressed_filepath = filepath + ".xz"
+    compressed_filepath = filepath + CODECS[codec][0]
 
     try:
+        # same output as lzma.open() / gzip / zstd, with access to the compressed bytes
+        compressor = _compressor(codec, level, dictionary)
         with open(filepath, "rb") as input_file:
-            with lzma.open(compressed_filepath, "wb") as output_file:
-                output_file.write(input_file.read())
+            with open(compressed_filepath, "wb") as output_file:
+
+                def write(data):
+                    output_file.write(data)
+                    if digest:
+                        digest.update(data)
+
+                while chunk := input_file.read(CHUNK_SIZE):
+                    write(compressor.compress(chunk))
+                    if progress:
+                        progress.update(len(chunk))
+                write(compressor.flush())
         logger.debug(f"File compressed successfully: {compressed_filepath}")
         return compressed_filepath
     except Exception as e:
@@ -24,20 +132,169 @@ def compress_file(filepath):
 
 def decompress_file(filepath):
     """
-    Decompresses a file using XZ compression.
+    Decompresses a file compressed by compress_file, the codec is given by the
+    file extension.
 
     :param filepath: The path to the file to decompress.
     :return: The path to the decompressed file.
     """
-    decompressed_filepath = filepath[:-3]
+    codec = next(
+        (codec for codec, values in CODECS.items() if filepath.endswith(values[0])),
+        DEFAULT_CODEC,
+    )
+    decompressed_filepath = filepath[: -len(CODECS[codec][0])]
     logger.info(f"Decompressing file: {filepath} -> {decompressed_filepath}")
 
     try:
-        with lzma.open(filepath, "rb") as input_file:
+        with open(filepath, "rb") as input_file:
             with open(decompressed_filepath, "wb") as output_file:
-                output_file.write(input_file.read())
+                chunks = iter(lambda: input_file.read(CHUNK_SIZE), b"")
+                for chunk in decompress_chunks(chunks, codec):
+                    output_file.write(chunk)
         logger.info(f"File decompressed successfully: {decompressed_filepath}")
         return decompressed_filepath
     except Exception as e:
         logger.error(f"Decompression failed: {e}")
         raise e
+
+
+def decompress_chunks(chunks, codec=DEFAULT_CODEC, get_dictionary=None):
+    """
+    Decompresses a stream of compressed chunks, e.g. a backup being downloaded.
+
+    :param chunks: An iterator over the compressed data.
+    :param codec: The codec of the data, one of CODECS.
+    :param get_dictionary: Optional function returning the zstd dictionary of an
+        id, called for the frames compressed with a dictionary.
+    :return: An iterator over the decompressed data, in chunks of up to CHUNK_SIZE
+        for XZ.
+    """
+    if codec != "xz":
+        yield from _decompress_frames(chunks, codec, get_dictionary)
+        return
+    decompressor = lzma.LZMADecompressor()
+    pending = False
+    for data in chunks:
+        while data or (pending and not decompressor.needs_input):
+            pending = True
+            output = decompressor.decompress(data, CHUNK_SIZE)
+            data = b""
+            if output:
+                yield output
+            if decompressor.eof:
+                # concatenated streams, as written by e.g. `xz -c a b`
+                data = decompressor.unused_data
+                decompressor = lzma.LZMADecompressor()
+                pending = False
+    if pending:
+        raise EOFError("Compressed data ended before the end-of-stream marker")
+
+
+def _get_frame_dictionary(codec, data, get_dictionary):
+    if codec != "zstd":
+        return None
+    import zstandard
+
+    try:
+        dictionary_id = zstandard.get_frame_parameters(data).dict_id
+    except zstandard.ZstdError:
+        # not a frame header, the decompressor reports it
+        return None
+    if not dictionary_id:
+        return None
+    if not get_dictionary:
+        raise ValueError(f"The data needs the zstd dictionary {dictionary_id}")
+    return get_dictionary(dictionary_id)
+
+
+def _decompress_frames(chunks, codec, get_dictionary=None):
+    decompressor = None
+    pending = False
+    for data in chunks:
+        while data:
+            if decompressor is None:
+                decompressor = _decompressor(
+                    codec, _get_frame_dictionary(codec, data, get_dictionary)
+                )
+            pending = True
+            output = decompressor.decompress(data)
+            data = b""
+            if output:
+                yield output
+            if decompressor.eof:
+                # concatenated members or frames
+                data = decompressor.unused_data
+                decompressor = None
+                pending = False
+    if pending:
+        raise EOFError("Compressed data ended before the end-of-stream marker")
+
+
+def _read_sample(filepath: str) -> bytes:
+    size = os.path.getsize(filepath)
+    slice_size = min(SAMPLE_SIZE, size // SAMPLE_SLICES) // SAMPLE_SLICES
+    with open(filepath, "rb") as file:
+        if not slice_size:
+            return file.read()
+        sample = bytearray()
+        for index in range(SAMPLE_SLICES):
+            file.seek(size * index // SAMPLE_SLICES)
+            sample += file.read(slice_size)
+        return bytes(sample)
+
+
+def choose_codec(filepath: str, bandwidth: float, time_budget: float = None) -> dict:
+    """
+    Picks the codec and level with the lowest compression plus upload time for a
+    dump, from the speed and ratio of each candidate on a sample of the dump and
+    the upload bandwidth.
+
+    With a time budget, the smallest output that fits in it is picked instead,
+    or the fastest candidate if none fits.
+
+    :param filepath: The path to the dump.
+    :param bandwidth: The upload bandwidth, in bytes per second.
+    :param time_budget: Optional time left for compression and upload, in seconds.
+    :return: The choice: codec, level, and the measures and estimates of each
+        candidate.
+    """
+    sample = _read_sample(filepath)
+    size = os.path.getsize(filepath)
+    candidates = []
+    for codec, (_extension, _level, levels) in CODECS.items():
+        if not has_codec(codec):
+            continue
+        for level in levels:
+            start = time.perf_counter()
+            compressed = compress_bytes(sample, codec, level)
+            elapsed = max(time.perf_counter() - start, 1e-6)
+            ratio = len(compressed) / max(len(sample), 1)
+            compression_time = size * elapsed / max(len(sample), 1)
+            upload_time = size * ratio / bandwidth
+            candidates.append(
+                {
+                    "codec": codec,
+                    "level": level,
+                    "ratio": round(ratio, 4),
+                    "speed": round(len(sample) / elapsed),
+                    "estimated_time": round(compression_time + upload_time, 3),
+                }
+            )
+
+    fitting = [
+        candidate
+        for candidate in candidates
+        if time_budget is None or candidate["estimated_time"] <= time_budget
+    ]
+    if time_budget is not None and fitting:
+        choice = min(fitting, key=lambda candidate: candidate["ratio"])
+    else:
+        choice = min(candidates, key=lambda candidate: candidate["estimated_time"])
+    return {
+        "codec": choice["codec"],
+        "level": choice["level"],
+        "bandwidth": round(bandwidth),
+        "time_budget": time_budget,
+        "sample_size": len(sample),
+        "candidates": candidates,
+    }
@@ -0,0 +1,174 @@
+"""
+Backups of several databases of a server in one run.
+
+A backup with `databases` (names or glob patterns, "*" for all) dumps each
+matching database of the server, database_parallel at a time, and packs the
+dumps into one backup file (see worker/archive.py) with one manifest and the
+statistics of each database. Patterns never match the system databases of the
+engine, and the databases matching exclude_databases are left out.
+"""
+
+import fnmatch
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from config import Backup, DBConnection
+from worker.archive import pack_files
+from worker.utils import format_bytes
+
+GLOB_CHARACTERS = "*?["
+
+
+def is_multi_database(backup: Backup) -> bool:
+    return bool(backup.databases)
+
+
+def get_database_connection(db_connection: DBConnection, database: str):
+    return db_connection.model_copy(update={"database": database})
+
+
+def resolve_databases(backup: Backup, engine, db_connection: DBConnection) -> List[str]:
+    """
+    Returns the databases of a backup: its names, and the databases of the server
+    matching its patterns, without the excluded ones.
+
+    :raise ValueError: If no database matches.
+    """
+    server_databases = None
+    databases = []
+    for pattern in backup.databases:
+        if any(character in pattern for character in GLOB_CHARACTERS):
+            if server_databases is None:
+                server_databases = [
+                    database
+                    for database in engine.list_databases(db_connection)
+                    if database not in engine.system_databases
+                ]
+            matches = [
+                database
+                for database in server_databases
+                if fnmatch.fnmatchcase(database, pattern)
+            ]
+        else:
+            matches = [pattern]
+        databases.extend(database for database in matches if database not in databases)
+
+    databases = [
+        database
+        for database in databases
+        if not any(
+            fnmatch.fnmatchcase(database, pattern)
+            for pattern in backup.exclude_databases or []
+        )
+    ]
+    if not databases:
+        raise ValueError(f"No database matches {', '.join(backup.databases)}")
+    return sorted(databases)
+
+
+def get_databases_size(
+    engine, db_connection: DBConnection, databases: List[str]
+) -> Optional[int]:
+    sizes = [
+        engine.get_database_size(get_database_connection(db_connection, database))
+        for database in databases
+    ]
+    if any(size is None for size in sizes):
+        return None
+    return sum(sizes)
+
+
+def _dump_database(
+    backup: Backup, engine, database: str, path: str, progress, db_connection
+) -> Tuple[Optional[Dict[str, int]], dict]:
+    # the engines read the database from the connection of the backup
+    database_backup = backup.model_copy(
+        update={
+            "db_connection_obj": get_database_connection(
+                backup.db_connection_obj, database
+            )
+        }
+    )
+    start_time = time.monotonic()
+    try:
+        row_counts = engine.dump(
+            database_backup,
+            path,
+            progress,
+            db_connection=get_database_connection(db_connection, database),
+        )
+    except Exception as e:
+        raise Exception(f"Dump of the database '{database}' failed: {e}") from e
+    stats = {
+        "size": os.path.getsize(path),
+        "duration": round(time.monotonic() - start_time, 3),
+        "tables": len(row_counts) if row_counts is not None else None,
+    }
+    logger.info(
+        f"[{backup.id}] Dumped '{database}': {format_bytes(stats['size'])}"
+        f" in {stats['duration']:.1f}s"
+    )
+    return row_counts, stats
+
+
+def dump_databases(
+    backup: Backup,
+    engine,
+    databases: List[str],
+    filepath: str,
+    progress=None,
+    digest=None,
+    db_connection: DBConnection = None,
+) -> Tuple[Optional[Dict[str, int]], Dict[str, dict]]:
+    """
+    Dumps databases, database_parallel at a time, and packs their dumps into
+    filepath, digest is updated with the written bytes.
+
+    :param db_connection: The server to dump (default: the connection of the
+        backup).
+    :return: The rows of each table counted while dumping, as database.table,
+        or None, and the size, dump time and number of tables of each database.
+    """
+    db_connection = db_connection or backup.db_connection_obj
+    results = {}
+    # the dumps are staged next to the backup file, on the same volume, and each
+    # one is packed then deleted as soon as it is done, so that the dumps and
+    # the backup file are never on disk in full together
+    with tempfile.TemporaryDirectory(
+        prefix="dbackup-databases-", dir=os.path.dirname(os.path.abspath(filepath))
+    ) as tmp_dir, pack_files(filepath, digest) as add_member:
+        with ThreadPoolExecutor(max_workers=backup.database_parallel or 1) as executor:
+            futures = {
+                executor.submit(
+                    _dump_database,
+                    backup,
+                    engine,
+                    database,
+                    os.path.join(tmp_dir, database),
+                    progress,
+                    db_connection,
+                ): database
+                for database in databases
+            }
+            for future in as_completed(futures):
+                database = futures[future]
+                results[database] = future.result()
+                add_member(database + engine.extension, os.path.join(tmp_dir, database))
+
+    row_counts = None
+    stats = {}
+    for database in databases:
+        database_row_counts, database_stats = results[database]
+        stats[database] = database_stats
+        if database_row_counts is not None:
+            row_counts = row_counts or {}
+            row_counts.update(
+                (f"{database}.{table}", count)
+                for table, count in database_row_counts.items()
+            )
+    return row_counts, stats
@@ -1,65 +1,548 @@
 import os
+import re
+import shlex
 import subprocess
 import tempfile
-from datetime import datetime
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
 from loguru import logger
-from config import Backup
+from config import Backup, DBConnection, ProtocolCompression, Replica
+from worker.utils import format_bytes
 
+CHUNK_SIZE = 1024 * 1024
+# commands compressing the output of mysqldump on the SSH host, fast levels since
+# the dump is compressed again by the compression stage
+SSH_COMPRESSORS = {
+    "gzip": "gzip -c -1",
+    "zstd": "zstd -c -q -1",
+}
+# option file lines enabling the compression of the client/server protocol
+PROTOCOL_COMPRESSION_OPTIONS = {
+    ProtocolCompression.ZLIB: "compress",
+    ProtocolCompression.ZSTD: "compression-algorithms=zstd",
+}
 
-def dump_db(
-    backup: Backup,
-    filepath: str = None,
-):
-    db_connection = backup.db_connection_obj
-    cnf_file_path = None
 
-    try:
-        with tempfile.NamedTemporaryFile(mode="w", delete=False) as cnf_file:
-            cnf_file.write(
-                f"""[client]
-host={db_connection.hostname}
+def _cnf(db_connection: DBConnection, hostname: str = None) -> str:
+    cnf = f"""[client]
+host={hostname or db_connection.hostname}
 user={db_connection.username}
 password={db_connection.password}
 port={db_connection.port}
 """
-            )
+    if db_connection.protocol_compression:
+        cnf += PROTOCOL_COMPRESSION_OPTIONS[db_connection.protocol_compression] + "\n"
+    return cnf
+
+
+@contextmanager
+def _cnf_file(db_connection: DBConnection):
+    """
+    Writes the credentials of a connection to a temporary option file, so that
+    they do not appear in the process list.
+    """
+    cnf_file_path = None
+    try:
+        with tempfile.NamedTemporaryFile(mode="w", delete=False) as cnf_file:
+            cnf_file.write(_cnf(db_connection))
             cnf_file_path = cnf_file.name
+        yield cnf_file_path
+    finally:
+        if cnf_file_path and os.path.exists(cnf_file_path):
+            os.remove(cnf_file_path)
+
+
+def run_query(db_connection: DBConnection, query: str) -> List[List[str]]:
+    """
+    Runs a query with the mysql client and returns the rows as lists of strings.
+    """
+    with _cnf_file(db_connection) as cnf_file_path:
+        result = subprocess.run(
+            [
+                "mysql",
+                f"--defaults-extra-file={cnf_file_path}",
+                "--batch",
+                "--skip-column-names",
+                "-e",
+                query,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=60,
+        )
+    return [line.split("\t") for line in result.stdout.splitlines()]
+
+
+def get_database_size(db_connection: DBConnection) -> Optional[int]:
+    """
+    Returns the size of the data and indexes of the database from information_schema,
+    or None if it could not be queried.
+    """
+    try:
+        rows = run_query(
+            db_connection,
+            "SELECT SUM(data_length + index_length) FROM information_schema.tables"
+            f" WHERE table_schema = '{db_connection.database}'",
+        )
+        if rows and rows[0][0] not in ("", "NULL"):
+            return int(rows[0][0])
+    except Exception as e:
+        logger.debug(f"Failed to get the size of '{db_connection.database}': {e}")
+    return None
+
 
+def create_database(db_connection: DBConnection, database: str):
+    run_query(db_connection, f"CREATE DATABASE IF NOT EXISTS `{database}`")
+
+
+def drop_database(db_connection: DBConnection, database: str):
+    run_query(db_connection, f"DROP DATABASE IF EXISTS `{database}`")
+
+
+def get_row_counts(db_connection: DBConnection, database: str) -> Dict[str, int]:
+    """
+    Returns the exact number of rows of each table of a database.
+    """
+    tables = [
+        row[0]
+        for row in run_query(
+            db_connection,
+            "SELECT table_name FROM information_schema.tables"
+            f" WHERE table_schema = '{database}' AND table_type = 'BASE TABLE'",
+        )
+    ]
+    if not tables:
+        return {}
+    rows = run_query(
+        db_connection,
+        " UNION ALL ".join(
+            f"SELECT '{table}', COUNT(*) FROM `{database}`.`{table}`"
+            for table in tables
+        ),
+    )
+    return {table: int(count) for table, count in rows}
+
+
+class DumpRowCounter:
+    """
+    Counts the rows of each table in the INSERT statements of a mysqldump output,
+    fed with the chunks of the dump as they are written.
+
+    Tables are found from the "Dumping data for table" comments (so nothing is
+    counted with --skip-comments) and rows from the INSERT statements and the
+    "),(" separators of extended inserts, once the quoted strings, which may
+    contain them, are blanked out. mysqldump escapes the quotes and newlines
+    of the strings with backslashes, so every string ends on its line.
+    """
+
+    DATA_MARKER = b"\n-- Dumping data for table `"
+    STRING = re.compile(rb"'(?:[^'\\\n]|\\.)*'")
+
+    def __init__(self):
+        self.rows: Dict[str, int] = {}
+        self._table = None
+        # the unfinished last line, starting with its newline so that the
+        # patterns below always match at the start of a line
+        self._rest = b"\n"
+
+    def update(self, chunk: bytes):
+        data = self._rest + chunk
+        end = data.rfind(b"\n")
+        self._rest = data[end:]
+        data = data[:end]
+
+        position = 0
+        while (marker := data.find(self.DATA_MARKER, position)) != -1:
+            self._count(data[position:marker])
+            name_start = marker + len(self.DATA_MARKER)
+            name_end = data.index(b"`", name_start)
+            self._table = data[name_start:name_end].decode()
+            self.rows.setdefault(self._table, 0)
+            position = name_end
+        self._count(data[position:])
+
+    def _count(self, data: bytes):
+        if self._table:
+            separators = data.count(b"),(")
+            if separators and b"'" in data:
+                separators = self.STRING.sub(b"''", data).count(b"),(")
+            self.rows[self._table] += data.count(b"\nINSERT INTO `") + separators
+
+
+@contextmanager
+def import_db(db_connection: DBConnection, database: str = None):
+    """
+    Starts a mysql client session on database (default: the database of the
+    connection) and yields its stdin to write SQL statements to.
+
+    Raises CalledProcessError with the output of mysql if the import fails.
+    """
+    with _cnf_file(db_connection) as cnf_file_path, tempfile.TemporaryFile(
+        mode="w+"
+    ) as stderr_file:
         command = [
-            "mysqldump",
+            "mysql",
             f"--defaults-extra-file={cnf_file_path}",
-            "--no-tablespaces",
-            db_connection.database,
+            database or db_connection.database,
         ]
+        process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr_file,
+        )
+        broken_pipe = None
+        try:
+            yield process.stdin
+        except BrokenPipeError as e:
+            # mysql exited early, its own error is more useful
+            broken_pipe = e
+        except BaseException:
+            process.kill()
+            raise
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = process.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read().strip()
+
+    if returncode != 0:
+        logger.error(f"mysql import error: {stderr}")
+        raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+    if broken_pipe:
+        raise broken_pipe
+
+
+def _run_status_query(
+    db_connection: DBConnection, query: str
+) -> Optional[Dict[str, str]]:
+    """
+    Runs a SHOW ... STATUS query and returns its first row by column name, or None
+    if it returned no row.
+    """
+    with _cnf_file(db_connection) as cnf_file_path:
+        result = subprocess.run(
+            ["mysql", f"--defaults-extra-file={cnf_file_path}", "--batch", "-e", query],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=60,
+        )
+    lines = result.stdout.splitlines()
+    if len(lines) < 2:
+        return None
+    return dict(zip(lines[0].split("\t"), lines[1].split("\t")))
+
+
+def get_replication_lag(db_connection: DBConnection) -> int:
+    """
+    Returns the replication lag of a replica in seconds.
+
+    Raises ValueError if the server does not replicate: not a replica, a stopped
+    replication thread or an unknown lag.
+    """
+    try:
+        status = _run_status_query(db_connection, "SHOW REPLICA STATUS")
+    except subprocess.CalledProcessError as e:
+        # syntax error before MySQL 8.0.22 and MariaDB 10.5.1
+        if "ERROR 1064" not in e.stderr:
+            raise
+        status = _run_status_query(db_connection, "SHOW SLAVE STATUS")
+    if not status:
+        raise ValueError("not a replica")
+    for thread in ("IO", "SQL"):
+        running = status.get(
+            f"Replica_{thread}_Running", status.get(f"Slave_{thread}_Running")
+        )
+        if running != "Yes":
+            raise ValueError(f"replication {thread} thread not running")
+    lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+    if lag in (None, "NULL"):
+        raise ValueError("unknown replication lag")
+    return int(lag)
 
-        if backup.skip_tables:
-            command.extend(
-                f"--ignore-table={db_connection.database}.{table}"
-                for table in backup.skip_tables
+
+def get_replica_connection(
+    db_connection: DBConnection, replica: Replica
+) -> DBConnection:
+    return db_connection.model_copy(
+        update={
+            "hostname": replica.hostname,
+            "port": replica.port,
+            "username": replica.username or db_connection.username,
+            "password": replica.password or db_connection.password,
+            # reached by its own hostname from the SSH host too
+            "ssh_db_hostname": None,
+            "replicas": [],
+        }
+    )
+
+
+def choose_dump_source(
+    db_connection: DBConnection,
+) -> Tuple[DBConnection, str, Optional[int]]:
+    """
+    Picks the server to dump a connection from: the healthy replica with the
+    lowest replication lag under max_replication_lag_seconds, or the primary if
+    the connection has no replicas, or if none is usable and
+    replica_fallback_to_primary is set.
+
+    :return: The connection to dump, its name ("primary" or the host:port of the
+        replica) and its replication lag.
+    """
+    if not db_connection.replicas:
+        return db_connection, "primary", None
+
+    candidates = []
+    for replica in db_connection.replicas:
+        name = f"{replica.hostname}:{replica.port}"
+        connection = get_replica_connection(db_connection, replica)
+        try:
+            lag = get_replication_lag(connection)
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"Replica {name} skipped: {e.stderr.strip() or e}")
+            continue
+        except Exception as e:
+            logger.warning(f"Replica {name} skipped: {e}")
+            continue
+        if lag > db_connection.max_replication_lag_seconds:
+            logger.warning(
+                f"Replica {name} skipped: {lag}s behind the primary, over"
+                f" {db_connection.max_replication_lag_seconds}s"
+            )
+            continue
+        logger.debug(f"Replica {name} is {lag}s behind the primary")
+        candidates.append((lag, name, connection))
+
+    if candidates:
+        # the first declared replica wins a tie
+        lag, name, connection = min(candidates, key=lambda candidate: candidate[0])
+        logger.info(f"Dumping from the replica {name}, {lag}s behind the primary")
+        return connection, name, lag
+    if not db_connection.replica_fallback_to_primary:
+        raise RuntimeError(
+            f"No replica of '{db_connection.id}' is usable and the fallback to the primary is disabled"
+        )
+    logger.warning(
+        f"No replica of '{db_connection.id}' is usable, dumping from the primary"
+    )
+    return db_connection, "primary", None
+
+
+def _dump_arguments(backup: Backup) -> List[str]:
+    db_connection = backup.db_connection_obj
+    arguments = ["--no-tablespaces", db_connection.database]
+
+    if backup.skip_tables:
+        arguments.extend(
+            f"--ignore-table={db_connection.database}.{table}"
+            for table in backup.skip_tables
+        )
+
+    if backup.dump_options:
+        arguments.extend(backup.dump_options)
+    return arguments
+
+
+def _write_dump(chunks, backup_file, progress=None, row_counter=None, digest=None):
+    for chunk in chunks:
+        backup_file.write(chunk)
+        if progress:
+            progress.update(len(chunk))
+        if row_counter:
+            row_counter.update(chunk)
+        if digest:
+            digest.update(chunk)
+
+
+def _ssh_dump_command(command: List[str], compression: str, cnf_size: int) -> str:
+    """
+    Returns the shell command running a dump program on the SSH host of a
+    connection, with the option file as its first argument.
+
+    The option file is read from stdin into a private temporary file, so that the
+    credentials never appear in the process list. The output is compressed, the
+    errors of the program are printed once it exited and its exit status is
+    returned.
+    """
+    compressor = SSH_COMPRESSORS[compression]
+    program = shlex.quote(command[0])
+    arguments = " ".join(shlex.quote(argument) for argument in command[1:])
+    return (
+        'umask 077 && f=$(mktemp) && trap \'rm -f "$f" "$f.rc" "$f.err"\' EXIT'
+        f' && head -c {cnf_size} > "$f"'
+        f' && {{ {program} --defaults-extra-file="$f" {arguments} 2> "$f.err";'
+        ' echo $? > "$f.rc"; }'
+        f' | {compressor}; rc=$?; cat "$f.err" >&2;'
+        ' [ $rc -ne 0 ] && exit $rc; exit "$(cat "$f.rc")"'
+    )
+
+
+def _dump_over_ssh(
+    db_connection: DBConnection,
+    command: List[str],
+    filepath: str,
+    progress=None,
+    row_counter: DumpRowCounter = None,
+    digest=None,
+) -> Tuple[int, str]:
+    """
+    Runs a dump program and a compressor on the SSH host of the connection and
+    writes the decompressed output to filepath, so that only the compressed dump
+    crosses the network.
+
+    :return: The exit status and the errors of the program.
+    """
+    from worker.compression import decompress_chunks
+    from worker.transfer_client.ssh_command import connect
+
+    host = db_connection.ssh_host_obj
+    cnf = _cnf(db_connection, db_connection.ssh_db_hostname).encode()
+    script = _ssh_dump_command(command, db_connection.ssh_compression.value, len(cnf))
+    # the login shell of the user may not be a POSIX shell
+    ssh_command = f"sh -c {shlex.quote(script)}"
+    received = 0
+
+    def read_output(stdout):
+        nonlocal received
+        while chunk := stdout.read(CHUNK_SIZE):
+            received += len(chunk)
+            yield chunk
+
+    ssh = connect(host)
+    try:
+        stdin, stdout, stderr = ssh.exec_command(ssh_command)
+        stdin.write(cnf)
+        stdin.channel.shutdown_write()
+        with open(filepath, "wb") as backup_file:
+            chunks = decompress_chunks(
+                read_output(stdout), db_connection.ssh_compression.value
+            )
+            _write_dump(
+                chunks,
+                backup_file,
+                progress,
+                row_counter,
+                digest,
+            )
+        returncode = stdout.channel.recv_exit_status()
+        stderr = stderr.read().decode(errors="replace").strip()
+    finally:
+        ssh.close()
+
+    logger.info(
+        f"{format_bytes(received)} received from {host.hostname}"
+        f" for {format_bytes(os.path.getsize(filepath))}"
+    )
+    return returncode, stderr
+
+
+def _dump_locally(
+    db_connection: DBConnection,
+    command: List[str],
+    filepath: str,
+    progress=None,
+    row_counter: DumpRowCounter = None,
+    digest=None,
+) -> Tuple[int, str]:
+    with _cnf_file(db_connection) as cnf_file_path:
+        command = [command[0], f"--defaults-extra-file={cnf_file_path}"] + command[1:]
+
+        # stderr goes to a file so that a chatty program cannot block on a full pipe
+        with open(filepath, "wb") as backup_file, tempfile.TemporaryFile(
+            mode="w+"
+        ) as stderr_file:
+            process = subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=stderr_file
             )
+            with process.stdout:
+                _write_dump(
+                    iter(lambda: process.stdout.read(CHUNK_SIZE), b""),
+                    backup_file,
+                    progress,
+                    row_counter,
+                    digest,
+                )
+            returncode = process.wait()
+            stderr_file.seek(0)
+            return returncode, stderr_file.read().strip()
+
 
-        if backup.dump_options:
-            command.extend(backup.dump_options)
+def run_dump(
+    db_connection: DBConnection,
+    command: List[str],
+    filepath: str,
+    progress=None,
+    row_counter: DumpRowCounter = None,
+    digest=None,
+    fail_on_stderr: bool = True,
+) -> str:
+    """
+    Runs a dump program, locally or on the SSH host of the connection, with the
+    credentials of the connection in an option file, and writes its output to
+    filepath.
 
-        with open(filepath, "w") as backup_file:
-            result = subprocess.run(
-                command,
-                stdout=backup_file,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True,
+    :param command: The program and its arguments, without the option file.
+    :param fail_on_stderr: Whether any error output fails the dump, for programs
+        that only print errors, unlike the backup tools logging their progress.
+    """
+    remote = (
+        f"ssh {db_connection.ssh_host_obj.hostname} "
+        if db_connection.ssh_host_obj
+        else ""
+    )
+    try:
+        if db_connection.ssh_host_obj:
+            returncode, stderr = _dump_over_ssh(
+                db_connection, command, filepath, progress, row_counter, digest
+            )
+        else:
+            returncode, stderr = _dump_locally(
+                db_connection, command, filepath, progress, row_counter, digest
             )
 
-            if result.stderr:
-                logger.error(f"mysqldump error: {result.stderr.strip()}")
-                raise Exception(f"mysqldump failed with error: {result.stderr.strip()}")
+        if returncode != 0:
+            raise subprocess.CalledProcessError(
+                returncode, f"{remote}{command[0]}", stderr=stderr
+            )
 
-            logger.info(f"Database dump saved to: {filepath}")
-            return filepath
+        if stderr and fail_on_stderr:
+            logger.error(f"{command[0]} error: {stderr}")
+            raise Exception(f"{command[0]} failed with error: {stderr}")
+
+        logger.info(f"Database dump saved to: {filepath}")
+        return filepath
 
     except subprocess.CalledProcessError as e:
-        logger.error(f"Database dump failed: {e}")
+        logger.error(f"Database dump failed: {e} {e.stderr}")
         raise e
-    finally:
-        if cnf_file_path and os.path.exists(cnf_file_path):
-            os.remove(cnf_file_path)
+
+
+def dump_db(
+    backup: Backup,
+    filepath: str = None,
+    progress=None,
+    row_counter: DumpRowCounter = None,
+    digest=None,
+    db_connection: DBConnection = None,
+):
+    """
+    Dumps the database of a backup to filepath with mysqldump, run locally or on
+    the SSH host of the connection.
+
+    :param db_connection: The server to dump (default: the connection of the
+        backup), e.g. a replica picked by choose_dump_source.
+    """
+    db_connection = db_connection or backup.db_connection_obj
+    return run_dump(
+        db_connection,
+        ["mysqldump"] + _dump_arguments(backup),
+        filepath,
+        progress,
+        row_counter,
+        digest,
+    )
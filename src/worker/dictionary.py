@@ -0,0 +1,240 @@
+"""
+Trained zstd dictionaries.
+
+The dumps of a database repeat the same statements, table and column names and
+values, which zstd cannot learn from small inputs such as the chunks of a
+repository. A dictionary is trained from a dump of each database, and reused by
+the next runs until it is dictionary_max_age_days old:
+
+    <dictionaries dir>/<db connection id>-<database>.<date>.<id>.zdict[.enc]
+
+The directory is `dictionaries/` in the path of the backup files, or
+`repo/dictionaries/` in a repository. The id is written by zstd in every frame
+compressed with the dictionary, so the dictionary of a backup file or a chunk is
+found from its data. Dictionaries contain parts of the dumps and are encrypted
+when the backups are.
+"""
+
+import io
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+
+from config import Backup
+from worker.transfer_client.base import is_not_found_error
+
+DICTIONARY_DIR = "dictionaries"
+DICTIONARY_SUFFIX = ".zdict"
+ENCRYPTED_SUFFIX = ".enc"
+DATE_FORMAT = "%Y%m%d%H%M%S"
+DICTIONARY_SIZE = 112 * 1024
+# the dictionary is trained on TRAINING_SAMPLES slices spread over the dump
+TRAINING_SAMPLES = 512
+TRAINING_SAMPLE_SIZE = 16 * 1024
+
+
+def get_dictionary_key(backup: Backup) -> str:
+    db_connection = backup.db_connection_obj
+    # the archives of several databases get a dictionary of their own
+    database = backup.id if backup.databases else db_connection.database
+    return f"{db_connection.id}-{database}"
+
+
+def parse_dictionary_name(filename: str) -> Optional[Tuple[str, datetime, int]]:
+    """
+    Returns the key, creation date and id of a dictionary file, or None.
+    """
+    name = filename.removesuffix(ENCRYPTED_SUFFIX)
+    if not name.endswith(DICTIONARY_SUFFIX):
+        return None
+    try:
+        key, date, dictionary_id = name[: -len(DICTIONARY_SUFFIX)].rsplit(".", 2)
+        return key, datetime.strptime(date, DATE_FORMAT), int(dictionary_id)
+    except ValueError:
+        return None
+
+
+def train_dictionary(filepath: str, level: int):
+    """
+    Trains a zstd dictionary for a compression level on slices of a dump.
+
+    :raise zstandard.ZstdError: If the dump is too small to train a dictionary.
+    """
+    import zstandard
+
+    size = os.path.getsize(filepath)
+    samples = []
+    with open(filepath, "rb") as file:
+        for index in range(TRAINING_SAMPLES):
+            file.seek(size * index // TRAINING_SAMPLES)
+            if sample := file.read(TRAINING_SAMPLE_SIZE):
+                samples.append(sample)
+    return zstandard.train_dictionary(DICTIONARY_SIZE, samples, level=level)
+
+
+class DictionaryStore:
+    """
+    The dictionaries of a directory, accessed through a connected TransferClient.
+
+    Dictionaries are encrypted with the key of a repository (fernet), or with a
+    key derived from the password and a salt stored in each file.
+    """
+
+    def __init__(self, client, path: str, password: str = None, fernet=None):
+        self.client = client
+        self.path = path
+        self.password = password
+        self.fernet = fernet
+        self.encrypted = bool(password or fernet)
+        self._files = None
+        self._dictionaries = {}
+        self._lock = threading.Lock()
+
+    def _list(self) -> Dict[str, Tuple[str, datetime, int]]:
+        if self._files is None:
+            # any other error must not look like an empty store: a new dictionary
+            # would be trained for every run
+            try:
+                filenames = self.client.list_files(self.path) or []
+            except Exception as e:
+                if not is_not_found_error(e):
+                    raise
+                filenames = []
+            self._files = {
+                filename: parsed
+                for filename in filenames
+                if filename.endswith(ENCRYPTED_SUFFIX) == self.encrypted
+                and (parsed := parse_dictionary_name(filename))
+            }
+        return self._files
+
+    def _encrypt(self, data: bytes) -> bytes:
+        from worker.security import encrypt_bytes, get_fernet_with_salt
+
+        if self.fernet:
+            return encrypt_bytes(self.fernet, data)
+        fernet, salt = get_fernet_with_salt(self.password)
+        return salt + encrypt_bytes(fernet, data)
+
+    def _decrypt(self, data: bytes) -> bytes:
+        from worker.security import SALT_SIZE, decrypt_bytes, get_fernet_with_salt
+
+        if self.fernet:
+            return decrypt_bytes(self.fernet, data)
+        fernet, _ = get_fernet_with_salt(self.password, data[:SALT_SIZE])
+        return decrypt_bytes(fernet, data[SALT_SIZE:])
+
+    def _load(self, filename: str):
+        import zstandard
+
+        with self.client.open_file(os.path.join(self.path, filename)) as file:
+            data = file.read()
+        if self.encrypted:
+            data = self._decrypt(data)
+        return zstandard.ZstdCompressionDict(data)
+
+    def get(self, dictionary_id: int):
+        """
+        Returns the dictionary of an id, downloaded once. Can be called from
+        several threads once load_all() was called.
+
+        :raise FileNotFoundError: If there is no dictionary with this id.
+        """
+        with self._lock:
+            if dictionary_id not in self._dictionaries:
+                filename = next(
+                    (
+                        filename
+                        for filename, (_key, _date, file_id) in self._list().items()
+                        if file_id == dictionary_id
+                    ),
+                    None,
+                )
+                if not filename:
+                    raise FileNotFoundError(
+                        f"No zstd dictionary {dictionary_id} in {self.path}"
+                    )
+                self._dictionaries[dictionary_id] = self._load(filename)
+            return self._dictionaries[dictionary_id]
+
+    def load(self, filename: str):
+        """
+        Downloads a dictionary by filename, so that get() does not use the client.
+        """
+        parsed = parse_dictionary_name(filename)
+        if not parsed:
+            raise ValueError(f"Not a zstd dictionary: {filename}")
+        return self.get(parsed[2])
+
+    def load_all(self):
+        """
+        Downloads all the dictionaries, so that get() does not use the client.
+        """
+        for _key, _date, dictionary_id in self._list().values():
+            self.get(dictionary_id)
+
+    def get_latest(
+        self, key: str, dump_file: str, level: int, max_age_days: int = None
+    ) -> Tuple[Optional[str], object]:
+        """
+        Returns the latest dictionary of a key, or a new one trained from the dump
+        if there is none or it is older than max_age_days, prepared for the
+        compression level.
+
+        :return: The filename and the dictionary, or (None, None) if the dump is
+            too small to train one.
+        """
+        import zstandard
+
+        dictionaries = sorted(
+            (date, filename)
+            for filename, (file_key, date, _id) in self._list().items()
+            if file_key == key
+        )
+        if dictionaries and (
+            not max_age_days
+            or datetime.now() - dictionaries[-1][0] < timedelta(days=max_age_days)
+        ):
+            filename = dictionaries[-1][1]
+            dictionary = self.get(self._list()[filename][2])
+        else:
+            try:
+                dictionary = train_dictionary(dump_file, level)
+            except zstandard.ZstdError as e:
+                logger.warning(f"Cannot train a zstd dictionary for {key}: {e}")
+                return None, None
+            filename = (
+                f"{key}.{datetime.now().strftime(DATE_FORMAT)}"
+                f".{dictionary.dict_id()}{DICTIONARY_SUFFIX}"
+            )
+            if self.encrypted:
+                filename += ENCRYPTED_SUFFIX
+            self._upload(filename, dictionary)
+            logger.info(f"Trained the zstd dictionary {filename}")
+        dictionary.precompute_compress(level=level)
+        return filename, dictionary
+
+    def _upload(self, filename: str, dictionary):
+        data = dictionary.as_bytes()
+        if self.encrypted:
+            data = self._encrypt(data)
+        # mkdir is not recursive with every protocol
+        self.client.mkdir(os.path.dirname(self.path))
+        self.client.mkdir(self.path)
+        self.client.upload_fileobj(io.BytesIO(data), os.path.join(self.path, filename))
+        self._list()[filename] = parse_dictionary_name(filename)
+        self._dictionaries[dictionary.dict_id()] = dictionary
+
+
+def get_dictionary_store(client, backup: Backup) -> DictionaryStore:
+    """
+    Returns the store of the dictionaries next to the backup files of a backup.
+    """
+    return DictionaryStore(
+        client,
+        os.path.join(backup.path, DICTIONARY_DIR),
+        password=backup.encryption_password if backup.encryption_enabled else None,
+    )
@@ -0,0 +1,24 @@
+from config import DATABASE_ENGINES, Backup, BackupEngine
+
+
+def get_engine(backup: Backup):
+    """
+    Returns the DumpEngine of a backup: its engine option, or the default engine
+    of the type of its connection.
+    """
+    engine = backup.engine or DATABASE_ENGINES[backup.db_connection_obj.type][0]
+    # engine modules are imported on demand, like the transfer clients
+    if engine == BackupEngine.MYSQLDUMP:
+        from worker.engines.mysql import MySQLDumpEngine
+
+        return MySQLDumpEngine()
+    elif engine in (BackupEngine.XTRABACKUP, BackupEngine.MARIABACKUP):
+        from worker.engines.physical import PhysicalEngine
+
+        return PhysicalEngine(engine)
+    elif engine == BackupEngine.PG_DUMP:
+        from worker.engines.postgres import PostgresEngine
+
+        return PostgresEngine()
+    else:
+        raise ValueError(f"Unknown engine: {engine}")
@@ -0,0 +1,96 @@
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+from config import Backup, DBConnection
+from worker.file import DUMP_EXTENSION
+
+
+class DumpEngine(ABC):
+    """
+    Backs up a type of database server to a single file, which then goes through
+    the compression, encryption and upload stages, and restores it from the
+    stream of its decompressed chunks.
+    """
+
+    name: str
+    # extension of the uncompressed backup files
+    extension = DUMP_EXTENSION
+    # whether the backups are restored into a database of a running server
+    logical = True
+    # databases left out of the backups of all the databases of a server
+    system_databases = ()
+
+    def choose_source(
+        self, db_connection: DBConnection
+    ) -> Tuple[DBConnection, str, Optional[int]]:
+        """
+        Returns the server to dump, "primary" or the host:port of a replica, and
+        its replication lag.
+        """
+        return db_connection, "primary", None
+
+    @abstractmethod
+    def dump(
+        self,
+        backup: Backup,
+        filepath: str,
+        progress=None,
+        digest=None,
+        db_connection: DBConnection = None,
+    ) -> Optional[Dict[str, int]]:
+        """
+        Dumps the database of a backup to filepath, digest is updated with the
+        written bytes.
+
+        :param db_connection: The server to dump (default: the connection of the
+            backup).
+        :return: The rows of each table counted while dumping, or None.
+        """
+        pass
+
+    @abstractmethod
+    def restore(
+        self, chunks, db_connection: DBConnection, database: str, parallel: int = 1
+    ):
+        """
+        Restores the chunks of a backup into an existing database, with up to
+        parallel sessions.
+        """
+        pass
+
+    @abstractmethod
+    def list_databases(self, db_connection: DBConnection) -> List[str]:
+        """
+        Returns the databases of the server of a connection.
+        """
+        pass
+
+    @abstractmethod
+    def create_database(self, db_connection: DBConnection, database: str):
+        """
+        Creates a database if it does not exist.
+        """
+        pass
+
+    @abstractmethod
+    def drop_database(self, db_connection: DBConnection, database: str):
+        """
+        Drops a database if it exists.
+        """
+        pass
+
+    @abstractmethod
+    def get_row_counts(
+        self, db_connection: DBConnection, database: str
+    ) -> Dict[str, int]:
+        """
+        Returns the exact number of rows of each table of a database.
+        """
+        pass
+
+    def get_database_size(self, db_connection: DBConnection) -> Optional[int]:
+        """
+        Returns the size of the database of a connection, or None if it could
+        not be queried.
+        """
+        return None
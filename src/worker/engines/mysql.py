@@ -0,0 +1,230 @@
+"""
+The mysqldump engine, on top of the MySQL helpers of worker/db.py.
+
+Restores replay the dump with the mysql client. In parallel, the dump is split
+into its table sections, restored in several sessions at the same time.
+"""
+
+import queue
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from config import Backup, DBConnection
+from worker.db import (
+    DumpRowCounter,
+    choose_dump_source,
+    create_database,
+    drop_database,
+    dump_db,
+    get_database_size,
+    get_row_counts,
+    import_db,
+    run_query,
+)
+from worker.engines.base import DumpEngine
+
+CHUNK_SIZE = 1024 * 1024
+# chunks waiting to be written to each mysql session of a parallel restore
+QUEUE_SIZE = 8
+# mysqldump comments starting a section that only depends on the header
+TABLE_MARKERS = (
+    b"-- Table structure for table ",
+    b"-- Temporary view structure for view ",
+)
+# sections that need all the tables, restored last in their own session
+DEFERRED_MARKERS = (
+    b"-- Final view structure for view ",
+    b"-- Dumping routines for database ",
+    b"-- Dumping events for database ",
+)
+# without a table marker in the first MAX_HEADER_SIZE bytes, the dump is not
+# split and is restored in a single session
+MAX_HEADER_SIZE = 1024 * 1024
+
+_END_OF_SECTION = object()
+
+
+def _iter_lines(chunks):
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if rest:
+        yield rest
+
+
+class _ImportWorker(threading.Thread):
+    """
+    A mysql session restoring the sections of a dump it is given, one at a time.
+    """
+
+    def __init__(self, db_connection: DBConnection, database: str, idle: queue.Queue):
+        super().__init__(daemon=True)
+        self.db_connection = db_connection
+        self.database = database
+        self.idle = idle
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.error = None
+
+    def run(self):
+        data = b""
+        try:
+            with import_db(self.db_connection, self.database) as stdin:
+                while (data := self.queue.get()) is not None:
+                    if data is _END_OF_SECTION:
+                        self.idle.put(self)
+                    else:
+                        stdin.write(data)
+        except Exception as e:
+            self.error = e
+            self.idle.put(self)
+            # keep consuming, so that the dispatcher never blocks on a full queue
+            while data is not None:
+                data = self.queue.get()
+
+
+class _ParallelImport:
+    """
+    Splits a mysqldump output into its table sections and restores them in up to
+    workers mysql sessions at the same time.
+
+    The header of the dump (session settings) is replayed before each section.
+    Views, routines and events are kept in memory and restored at the end, once
+    all the tables exist.
+    """
+
+    def __init__(self, db_connection: DBConnection, database: str, workers: int):
+        self.db_connection = db_connection
+        self.database = database
+        self.max_workers = workers
+        self.workers = []
+        self.idle = queue.Queue()
+
+    def _acquire(self) -> _ImportWorker:
+        if self.idle.empty() and len(self.workers) < self.max_workers:
+            worker = _ImportWorker(self.db_connection, self.database, self.idle)
+            worker.start()
+            self.workers.append(worker)
+        else:
+            worker = self.idle.get()
+        self._raise_errors()
+        return worker
+
+    def _raise_errors(self):
+        for worker in self.workers:
+            if worker.error:
+                raise worker.error
+
+    def run(self, chunks):
+        header = bytearray()
+        deferred = bytearray()
+        buffer = bytearray()
+        # None while reading the header, then a worker or the deferred buffer
+        section = None
+        split = True
+
+        def flush():
+            self._raise_errors()
+            if section is deferred:
+                deferred.extend(buffer)
+            elif buffer:
+                section.queue.put(bytes(buffer))
+            buffer.clear()
+
+        try:
+            for line in _iter_lines(chunks):
+                if split and line.startswith(b"-- "):
+                    if line.startswith(TABLE_MARKERS):
+                        if section is None:
+                            header.extend(buffer)
+                            buffer.clear()
+                        else:
+                            flush()
+                            if section is not deferred:
+                                section.queue.put(_END_OF_SECTION)
+                        section = self._acquire()
+                        section.queue.put(bytes(header))
+                    elif line.startswith(DEFERRED_MARKERS) and section is not None:
+                        flush()
+                        if section is not deferred:
+                            section.queue.put(_END_OF_SECTION)
+                        section = deferred
+
+                buffer.extend(line)
+                if section is None and len(buffer) > MAX_HEADER_SIZE:
+                    logger.warning(
+                        "No table section found in the dump, restoring it in a single session"
+                    )
+                    split = False
+                    section = self._acquire()
+                if len(buffer) >= CHUNK_SIZE:
+                    flush()
+
+            if section is None:
+                section = self._acquire()
+            flush()
+        finally:
+            for worker in self.workers:
+                worker.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+        self._raise_errors()
+
+        if deferred:
+            with import_db(self.db_connection, self.database) as stdin:
+                stdin.write(header)
+                stdin.write(deferred)
+
+
+class MySQLDumpEngine(DumpEngine):
+    name = "mysqldump"
+    system_databases = ("information_schema", "performance_schema", "mysql", "sys")
+
+    def choose_source(
+        self, db_connection: DBConnection
+    ) -> Tuple[DBConnection, str, Optional[int]]:
+        return choose_dump_source(db_connection)
+
+    def dump(
+        self,
+        backup: Backup,
+        filepath: str,
+        progress=None,
+        digest=None,
+        db_connection: DBConnection = None,
+    ) -> Optional[Dict[str, int]]:
+        # row counts are checked by the restore drills
+        row_counter = DumpRowCounter()
+        dump_db(backup, filepath, progress, row_counter, digest, db_connection)
+        return row_counter.rows
+
+    def restore(
+        self, chunks, db_connection: DBConnection, database: str, parallel: int = 1
+    ):
+        if parallel > 1:
+            _ParallelImport(db_connection, database, parallel).run(chunks)
+        else:
+            with import_db(db_connection, database) as stdin:
+                for chunk in chunks:
+                    stdin.write(chunk)
+
+    def list_databases(self, db_connection: DBConnection) -> List[str]:
+        return [row[0] for row in run_query(db_connection, "SHOW DATABASES")]
+
+    def create_database(self, db_connection: DBConnection, database: str):
+        create_database(db_connection, database)
+
+    def drop_database(self, db_connection: DBConnection, database: str):
+        drop_database(db_connection, database)
+
+    def get_row_counts(
+        self, db_connection: DBConnection, database: str
+    ) -> Dict[str, int]:
+        return get_row_counts(db_connection, database)
+
+    def get_database_size(self, db_connection: DBConnection) -> Optional[int]:
+        return get_database_size(db_connection)
@@ -0,0 +1,253 @@
+"""
+Physical hot backups with xtrabackup (MySQL, Percona Server) or mariabackup
+(MariaDB).
+
+The backup tool copies the data files of the whole server while it keeps
+serving queries, and streams them as an xbstream archive that goes through the
+compression, encryption and upload stages like a dump:
+
+    <prefix><date>.xbstream[.xz|.gz|.zst][.enc]
+
+It reads the data directory, so it runs on the database server: locally, or on
+the SSH host of the connection like a remote mysqldump.
+
+A restore extracts the archive with xbstream/mbstream as it is downloaded,
+prepares it (applies the redo log copied during the backup) and, optionally,
+copies it back into the empty data directory of a stopped server.
+"""
+
+import os
+import subprocess
+import tempfile
+import time
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from config import Backup, BackupEngine, DBConnection
+from worker.db import run_dump
+from worker.engines.mysql import MySQLDumpEngine
+from worker.file import PHYSICAL_EXTENSION
+from worker.progress import format_duration, track_progress
+from worker.utils import format_bytes
+
+# engine: (backup tool, archive tool)
+TOOLS = {
+    BackupEngine.XTRABACKUP: ("xtrabackup", "xbstream"),
+    BackupEngine.MARIABACKUP: ("mariabackup", "mbstream"),
+}
+# directory of the temporary files of the backup tool on the SSH host
+REMOTE_TMP_DIR = "/tmp"
+# lines of the output of a failed tool kept in the error
+ERROR_LINES = 20
+
+
+def _backup_command(backup: Backup, remote: bool) -> List[str]:
+    program, _ = TOOLS[backup.engine]
+    target_dir = REMOTE_TMP_DIR if remote else tempfile.gettempdir()
+    return [
+        program,
+        "--backup",
+        "--stream=xbstream",
+        f"--target-dir={target_dir}",
+        f"--parallel={backup.dump_parallel}",
+    ]
+
+
+def backup_server(
+    backup: Backup,
+    filepath: str,
+    progress=None,
+    digest=None,
+    db_connection: DBConnection = None,
+) -> str:
+    """
+    Streams a physical backup of the server of a backup to filepath, with
+    dump_parallel copy threads.
+
+    :param db_connection: The server to back up (default: the connection of the
+        backup).
+    """
+    db_connection = db_connection or backup.db_connection_obj
+    # the tool reads "compress" from the option file as its own --compress
+    db_connection = db_connection.model_copy(update={"protocol_compression": None})
+    command = _backup_command(backup, bool(db_connection.ssh_host_obj))
+    # the tools log their progress to stderr, only the exit status tells a failure
+    return run_dump(
+        db_connection, command, filepath, progress, digest=digest, fail_on_stderr=False
+    )
+
+
+def _run_tool(command: List[str]):
+    logger.debug(f"Running {' '.join(command)}")
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        output = "\n".join(result.stderr.strip().splitlines()[-ERROR_LINES:])
+        raise subprocess.CalledProcessError(
+            result.returncode, command[:2], stderr=output
+        )
+
+
+def _extract(chunks, archive_tool: str, target_dir: str, parallel: int) -> int:
+    """
+    Extracts an xbstream archive into target_dir as its chunks arrive.
+
+    :return: The size of the archive.
+    """
+    command = [archive_tool, "-x", "-C", target_dir]
+    if archive_tool == "xbstream":
+        command.append(f"--parallel={parallel}")
+    extracted_bytes = 0
+    broken_pipe = None
+    with tempfile.TemporaryFile(mode="w+") as stderr_file:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stderr=stderr_file)
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+                extracted_bytes += len(chunk)
+        except BrokenPipeError as e:
+            # the exit status and errors of the archive tool explain it
+            broken_pipe = e
+        finally:
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = process.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read().strip()
+
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, stderr=stderr)
+    if broken_pipe:
+        raise broken_pipe
+    return extracted_bytes
+
+
+def _get_directory_size(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, filename))
+        for root, _dirs, filenames in os.walk(directory)
+        for filename in filenames
+    )
+
+
+def restore_physical_backup(
+    backup: Backup,
+    target_dir: str,
+    filename: str = None,
+    datadir: str = None,
+    parallel: int = 1,
+) -> dict:
+    """
+    Restores a physical backup from its destination: the archive is downloaded,
+    decrypted, decompressed and extracted into target_dir as a stream, then
+    prepared.
+
+    :param backup: The backup to restore.
+    :param target_dir: The directory to extract into, created if needed, empty.
+    :param filename: The backup file to restore (default: the latest physical one).
+    :param datadir: The empty data directory of a stopped server to copy the
+        prepared backup back into, if any.
+    :param parallel: Number of threads extracting and copying the files, and of
+        chunks decrypted in parallel.
+    :return: The statistics of the restore.
+    """
+    from worker.engines import get_engine
+    from worker.restore import connect_backup_file, open_backup_chunks
+
+    engine = get_engine(backup)
+    if engine.logical:
+        raise ValueError(
+            f"Backup '{backup.id}' uses the {engine.name} engine,"
+            " set engine to xtrabackup or mariabackup to restore a physical backup"
+        )
+    program, archive_tool = TOOLS[backup.engine]
+    os.makedirs(target_dir, exist_ok=True)
+    if os.listdir(target_dir):
+        raise ValueError(f"The target directory {target_dir} is not empty")
+    tier, client, filename = connect_backup_file(backup, engine, filename)
+    try:
+        logger.info(f"[{backup.id}] Extracting {filename} into {target_dir}...")
+
+        start_time = time.monotonic()
+        with track_progress(backup.id, "restore") as progress, ExitStack() as stack:
+            reader, chunks = open_backup_chunks(
+                client, tier, filename, parallel, progress, stack
+            )
+            archive_bytes = _extract(chunks, archive_tool, target_dir, parallel)
+    finally:
+        client.disconnect()
+    restored_bytes = _get_directory_size(target_dir)
+
+    logger.info(f"[{backup.id}] Preparing {target_dir}...")
+    _run_tool([program, "--prepare", f"--target-dir={target_dir}"])
+    if datadir:
+        logger.info(f"[{backup.id}] Copying {target_dir} back into {datadir}...")
+        _run_tool(
+            [
+                program,
+                "--copy-back",
+                f"--target-dir={target_dir}",
+                f"--datadir={datadir}",
+                f"--parallel={parallel}",
+            ]
+        )
+    duration = time.monotonic() - start_time
+
+    stats = {
+        "backup_id": backup.id,
+        "file": filename,
+        "target_dir": target_dir,
+        "datadir": datadir,
+        "downloaded_bytes": reader.bytes_read,
+        "archive_bytes": archive_bytes,
+        # the extracted data files, before the prepare
+        "restored_bytes": restored_bytes,
+        "duration": duration,
+        "throughput": restored_bytes / duration if duration > 0 else 0,
+    }
+    logger.success(
+        f"[{backup.id}] Restored {filename} into {datadir or target_dir} in"
+        f" {format_duration(duration)}: {format_bytes(reader.bytes_read)} downloaded,"
+        f" {format_bytes(restored_bytes)} of data files"
+        f" at {format_bytes(stats['throughput'])}/s"
+    )
+    return stats
+
+
+class PhysicalEngine(MySQLDumpEngine):
+    """
+    Physical backups of a MySQL or MariaDB server. They are restored into a
+    directory with restore_physical_backup, the other queries are the ones of
+    the mysqldump engine.
+    """
+
+    extension = PHYSICAL_EXTENSION
+    logical = False
+
+    def __init__(self, engine: BackupEngine):
+        self.name = engine.value
+
+    def choose_source(
+        self, db_connection: DBConnection
+    ) -> Tuple[DBConnection, str, Optional[int]]:
+        # the backup tool reads the data files of the server it runs on
+        return db_connection, "primary", None
+
+    def dump(
+        self,
+        backup: Backup,
+        filepath: str,
+        progress=None,
+        digest=None,
+        db_connection: DBConnection = None,
+    ) -> Optional[Dict[str, int]]:
+        backup_server(backup, filepath, progress, digest, db_connection)
+        return None
+
+    def restore(
+        self, chunks, db_connection: DBConnection, database: str, parallel: int = 1
+    ):
+        raise ValueError("Physical backups are restored into a directory")
@@ -0,0 +1,308 @@
+"""
+The PostgreSQL engine.
+
+pg_dump writes a directory format dump with dump_parallel jobs, one file per
+table, uncompressed so that the compression stage and the chunking of a
+repository see the data. The directory is packed into a tar file, the backup
+file, as a `dump/` directory:
+
+    <prefix><date>.pgdump[.xz|.gz|.zst][.enc]
+
+The dump directory is staged next to the backup file and its files are deleted
+as they are packed. A restore unpacks the tar into a temporary directory of
+the local directory of the backup files as it is downloaded, then runs
+pg_restore with parallel jobs, which needs the whole directory.
+"""
+
+import os
+import subprocess
+import tarfile
+import tempfile
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from config import Backup, DBConnection
+from worker.archive import ChunksReader
+from worker.engines.base import DumpEngine
+from worker.file import PG_DUMP_EXTENSION, MeteredFile, get_local_dir
+
+# name of the pg_dump directory in the tar
+DUMP_DIR = "dump"
+# the database psql connects to for CREATE and DROP DATABASE
+MAINTENANCE_DATABASE = "postgres"
+# seconds between two updates of the progress of pg_dump
+PROGRESS_INTERVAL = 1
+
+
+def _escape_passfile_field(value) -> str:
+    return str(value).replace("\\", "\\\\").replace(":", "\\:")
+
+
+def _pack_dump_dir(tar: tarfile.TarFile, dump_dir: str):
+    """
+    Adds the pg_dump directory to a tar as DUMP_DIR, deleting each file once it
+    is added so that the dump is not on disk twice.
+    """
+    tar.add(dump_dir, arcname=DUMP_DIR, recursive=False)
+    for name in sorted(os.listdir(dump_dir)):
+        path = os.path.join(dump_dir, name)
+        tar.add(path, arcname=f"{DUMP_DIR}/{name}")
+        os.remove(path)
+
+
+@contextmanager
+def _passfile(db_connection: DBConnection):
+    """
+    Writes the credentials of a connection to a temporary password file, so that
+    they do not appear in the process list.
+    """
+    passfile_path = None
+    try:
+        with tempfile.NamedTemporaryFile(mode="w", delete=False) as passfile:
+            passfile.write(
+                ":".join(
+                    _escape_passfile_field(value)
+                    for value in (
+                        db_connection.hostname,
+                        db_connection.port,
+                        "*",
+                        db_connection.username,
+                        db_connection.password,
+                    )
+                )
+                + "\n"
+            )
+            passfile_path = passfile.name
+        yield passfile_path
+    finally:
+        if passfile_path and os.path.exists(passfile_path):
+            os.remove(passfile_path)
+
+
+def _connection_arguments(db_connection: DBConnection, database: str) -> List[str]:
+    return [
+        f"--host={db_connection.hostname}",
+        f"--port={db_connection.port}",
+        f"--username={db_connection.username}",
+        f"--dbname={database}",
+        "--no-password",
+    ]
+
+
+def _env(passfile_path: str) -> dict:
+    return {**os.environ, "PGPASSFILE": passfile_path}
+
+
+def _quote_identifier(name: str) -> str:
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _quote_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def run_query(
+    db_connection: DBConnection, query: str, database: str = None
+) -> List[List[str]]:
+    """
+    Runs a query with psql and returns the rows as lists of strings.
+
+    :param database: The database to connect to (default: the one of the
+        connection).
+    """
+    with _passfile(db_connection) as passfile_path:
+        result = subprocess.run(
+            [
+                "psql",
+                *_connection_arguments(
+                    db_connection, database or db_connection.database
+                ),
+                "--no-psqlrc",
+                "--no-align",
+                "--tuples-only",
+                "--field-separator=\t",
+                "--set=ON_ERROR_STOP=1",
+                f"--command={query}",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+            timeout=60,
+            env=_env(passfile_path),
+        )
+    return [line.split("\t") for line in result.stdout.splitlines()]
+
+
+def _get_directory_size(path: str) -> int:
+    size = 0
+    for directory, _dirs, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(directory, file))
+            except OSError:
+                pass
+    return size
+
+
+class PostgresEngine(DumpEngine):
+    name = "pg_dump"
+    extension = PG_DUMP_EXTENSION
+    system_databases = (MAINTENANCE_DATABASE,)
+
+    def _pg_dump(self, command: List[str], passfile_path: str, dump_dir, progress):
+        written = 0
+        # stderr goes to a file so that a chatty pg_dump cannot block on a full pipe
+        with tempfile.TemporaryFile(mode="w+") as stderr_file:
+            process = subprocess.Popen(
+                command,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr_file,
+                env=_env(passfile_path),
+            )
+            while True:
+                try:
+                    returncode = process.wait(timeout=PROGRESS_INTERVAL)
+                except subprocess.TimeoutExpired:
+                    returncode = None
+                if progress:
+                    size = _get_directory_size(dump_dir)
+                    progress.update(size - written)
+                    written = size
+                if returncode is not None:
+                    break
+            stderr_file.seek(0)
+            stderr = stderr_file.read().strip()
+        if returncode != 0:
+            logger.error(f"Database dump failed: pg_dump {stderr}")
+            raise subprocess.CalledProcessError(returncode, "pg_dump", stderr=stderr)
+
+    def dump(
+        self,
+        backup: Backup,
+        filepath: str,
+        progress=None,
+        digest=None,
+        db_connection: DBConnection = None,
+    ) -> Optional[Dict[str, int]]:
+        db_connection = db_connection or backup.db_connection_obj
+        with tempfile.TemporaryDirectory(
+            prefix="dbackup-pg-", dir=os.path.dirname(os.path.abspath(filepath))
+        ) as tmp_dir, _passfile(db_connection) as passfile_path:
+            dump_dir = os.path.join(tmp_dir, DUMP_DIR)
+            command = [
+                "pg_dump",
+                *_connection_arguments(db_connection, db_connection.database),
+                "--format=directory",
+                f"--jobs={backup.dump_parallel}",
+                "--compress=0",
+                f"--file={dump_dir}",
+            ]
+            command.extend(
+                f"--exclude-table={table}" for table in backup.skip_tables or []
+            )
+            command.extend(backup.dump_options or [])
+            self._pg_dump(command, passfile_path, dump_dir, progress)
+
+            with open(filepath, "wb") as backup_file, tarfile.open(
+                fileobj=MeteredFile(backup_file, digest), mode="w|"
+            ) as tar:
+                _pack_dump_dir(tar, dump_dir)
+
+        logger.info(f"Database dump saved to: {filepath}")
+        return None
+
+    def restore(
+        self, chunks, db_connection: DBConnection, database: str, parallel: int = 1
+    ):
+        with tempfile.TemporaryDirectory(
+            prefix="dbackup-pg-", dir=get_local_dir()
+        ) as tmp_dir:
+            with tarfile.open(fileobj=ChunksReader(chunks), mode="r|") as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(tmp_dir, filter="data")
+                else:
+                    tar.extractall(tmp_dir)
+            with _passfile(db_connection) as passfile_path:
+                command = [
+                    "pg_restore",
+                    *_connection_arguments(db_connection, database),
+                    "--format=directory",
+                    f"--jobs={parallel}",
+                    "--exit-on-error",
+                    os.path.join(tmp_dir, DUMP_DIR),
+                ]
+                result = subprocess.run(
+                    command, capture_output=True, text=True, env=_env(passfile_path)
+                )
+        if result.returncode != 0:
+            stderr = result.stderr.strip()
+            logger.error(f"pg_restore error: {stderr}")
+            raise subprocess.CalledProcessError(
+                result.returncode, "pg_restore", stderr=stderr
+            )
+
+    def list_databases(self, db_connection: DBConnection) -> List[str]:
+        return [
+            row[0]
+            for row in run_query(
+                db_connection,
+                "SELECT datname FROM pg_database WHERE NOT datistemplate",
+                MAINTENANCE_DATABASE,
+            )
+        ]
+
+    def create_database(self, db_connection: DBConnection, database: str):
+        exists = run_query(
+            db_connection,
+            f"SELECT 1 FROM pg_database WHERE datname = {_quote_literal(database)}",
+            MAINTENANCE_DATABASE,
+        )
+        if not exists:
+            run_query(
+                db_connection,
+                f"CREATE DATABASE {_quote_identifier(database)}",
+                MAINTENANCE_DATABASE,
+            )
+
+    def drop_database(self, db_connection: DBConnection, database: str):
+        run_query(
+            db_connection,
+            f"DROP DATABASE IF EXISTS {_quote_identifier(database)}",
+            MAINTENANCE_DATABASE,
+        )
+
+    def get_row_counts(
+        self, db_connection: DBConnection, database: str
+    ) -> Dict[str, int]:
+        tables = run_query(
+            db_connection,
+            "SELECT table_schema, table_name FROM information_schema.tables"
+            " WHERE table_type = 'BASE TABLE'"
+            " AND table_schema NOT IN ('pg_catalog', 'information_schema')",
+            database,
+        )
+        if not tables:
+            return {}
+        rows = run_query(
+            db_connection,
+            " UNION ALL ".join(
+                f"SELECT {_quote_literal(f'{schema}.{table}')}, COUNT(*)"
+                f" FROM {_quote_identifier(schema)}.{_quote_identifier(table)}"
+                for schema, table in tables
+            ),
+            database,
+        )
+        return {table: int(count) for table, count in rows}
+
+    def get_database_size(self, db_connection: DBConnection) -> Optional[int]:
+        try:
+            rows = run_query(
+                db_connection, "SELECT pg_database_size(current_database())"
+            )
+            if rows and rows[0][0]:
+                return int(rows[0][0])
+        except Exception as e:
+            logger.debug(f"Failed to get the size of '{db_connection.database}': {e}")
+        return None
@@ -4,6 +4,56 @@ from datetime import datetime
 
 from loguru import logger
 
+# sidecar manifest uploaded next to each backup file, see worker/manifest.py
+MANIFEST_SUFFIX = ".manifest.json"
+# extensions of the uncompressed backups: mysqldump output, xbstream archive,
+# tar of a pg_dump directory
+DUMP_EXTENSION = ".sql"
+PHYSICAL_EXTENSION = ".xbstream"
+PG_DUMP_EXTENSION = ".pgdump"
+# appended to the extension of the dumps of several databases, see worker/archive.py
+ARCHIVE_SUFFIX = ".tar"
+BACKUP_EXTENSIONS = tuple(
+    extension + suffix
+    for extension in (DUMP_EXTENSION, PHYSICAL_EXTENSION, PG_DUMP_EXTENSION)
+    for suffix in (ARCHIVE_SUFFIX, "")
+)
+
+
+class MeteredFile:
+    """
+    Wraps a binary file object, counting the bytes read from or written to it
+    and updating a hash digest and a ProgressTracker with them, if given.
+    """
+
+    def __init__(self, file, digest=None, progress=None):
+        self.file = file
+        self.digest = digest
+        self.progress = progress
+        self.size = 0
+
+    @property
+    def bytes_read(self) -> int:
+        # the name of the counter of the repository readers, see worker/restore.py
+        return self.size
+
+    def _meter(self, data):
+        self.size += len(data)
+        if self.digest:
+            self.digest.update(data)
+        if self.progress and data:
+            self.progress.update(len(data))
+
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self._meter(data)
+        return data
+
+    def write(self, data):
+        self.file.write(data)
+        self._meter(data)
+        return len(data)
+
 
 def file_exists(filepath):
     """
@@ -57,8 +107,29 @@ def get_filename_from_path(filepath):
     return os.path.basename(filepath)
 
 
+def get_backup_file_prefix(backup_id: str, backup_filename: str = None):
+    """
+    Returns the prefix of the backup file names, before the date.
+
+    :param backup_id: The name of the backup.
+    :param backup_filename: The filename of the backup.
+    """
+    return backup_filename if backup_filename else f"{backup_id}" + "_"
+
+
+def get_local_dir() -> str:
+    """
+    Returns the directory where the backup files are written before they are
+    uploaded, and where the data of a run is staged, on the same volume.
+    """
+    return tempfile.gettempdir()
+
+
 def get_backup_file(
-    backup_id: str, backup_filename: str = None, date_format: str = None
+    backup_id: str,
+    backup_filename: str = None,
+    date_format: str = None,
+    extension: str = DUMP_EXTENSION,
 ):
     """
     Generates a backup file name and path.
@@ -66,12 +137,12 @@ def get_backup_file(
     :param backup_id: The name of the backup.
     :param backup_filename: The filename of the backup.
     :param date_format: The date format to use in the filename.
+    :param extension: The extension of the uncompressed backup.
     :return: A tuple containing the prefix, filename, and path.
     """
-    tmp_dir = tempfile.gettempdir()
-    prefix = backup_filename if backup_filename else f"{backup_id}" + "_"
-    filename = f"{prefix}{datetime.now().strftime(date_format)}.sql"
-    path = os.path.join(tmp_dir, filename)
+    prefix = get_backup_file_prefix(backup_id, backup_filename)
+    filename = f"{prefix}{datetime.now().strftime(date_format)}{extension}"
+    path = os.path.join(get_local_dir(), filename)
     return prefix, filename, path
 
 
@@ -88,13 +159,46 @@ def get_backup_date_from_filename(
     """
     try:
         date_str = filename[len(filename_prefix) :]
-        date_str = date_str.split(".sql")[0]
+        for extension in BACKUP_EXTENSIONS:
+            date_str = date_str.split(extension)[0]
         return datetime.strptime(date_str, date_format)
     except Exception as e:
         logger.error(f"Failed to extract date from filename '{filename}': {e}")
         return None
 
 
+def get_backup_files(files, filename_prefix, date_format):
+    """
+    Returns the backup files of a directory listing, oldest first.
+
+    :param files: List of file names.
+    :param filename_prefix: Prefix of the backup filenames.
+    :param date_format: Date format used in the backup filenames.
+    :return: List of backup files, without their manifests.
+    """
+    backup_files = []
+    for file in files or []:
+        if not file.startswith(filename_prefix) or file.endswith(MANIFEST_SUFFIX):
+            continue
+        date = get_backup_date_from_filename(file, filename_prefix, date_format)
+        if not date:
+            continue
+        backup_files.append((date, file))
+
+    backup_files.sort()
+    return [file for _, file in backup_files]
+
+
+def is_archive_file(filename: str) -> bool:
+    """
+    Returns whether a backup file holds the dumps of several databases.
+    """
+    return any(
+        extension.endswith(ARCHIVE_SUFFIX) and extension in filename
+        for extension in BACKUP_EXTENSIONS
+    )
+
+
 def get_backups_to_delete(files, filename_prefix, date_format, max_backup_files):
     """
     Returns a list of files to delete based on the max_backup_files limit.
@@ -105,19 +209,7 @@ def get_backups_to_delete(files, filename_prefix, date_format, max_backup_files)
     :param max_backup_files: Maximum number of backup files to keep.
     :return: List of files to delete.
     """
-    if not files:
-        return []
-
-    files = [file for file in files if file.startswith(filename_prefix)]
-    files_to_delete = []
-
-    for file in files:
-        date = get_backup_date_from_filename(file, filename_prefix, date_format)
-        if not date:
-            continue
-        files_to_delete.append((date, file))
-
-    files_to_delete.sort()
-    if len(files_to_delete) > max_backup_files:
-        return [file for _, file in files_to_delete[:-max_backup_files]]
+    backup_files = get_backup_files(files, filename_prefix, date_format)
+    if len(backup_files) > max_backup_files:
+        return backup_files[:-max_backup_files]
     return []
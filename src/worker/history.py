@@ -0,0 +1,383 @@
+import json
+import math
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from loguru import logger
+
+from data.BackupData import BackupData
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    backup_id TEXT NOT NULL,
+    kind TEXT NOT NULL DEFAULT 'backup',
+    database TEXT,
+    host TEXT,
+    protocol TEXT,
+    start_time TEXT NOT NULL,
+    end_time TEXT,
+    duration REAL,
+    success INTEGER NOT NULL,
+    error TEXT,
+    artifact TEXT,
+    artifact_size INTEGER,
+    checksum TEXT,
+    details TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_backup_id_start_time ON runs (backup_id, start_time);
+CREATE TABLE IF NOT EXISTS stages (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    wall_time REAL,
+    cpu_time REAL,
+    bytes_in INTEGER,
+    bytes_out INTEGER,
+    sha256 TEXT,
+    attempts INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS stages_run_id ON stages (run_id);
+"""
+
+# keys of BackupData.to_dict() that are stored in their own columns
+RUN_COLUMNS = [
+    "kind",
+    "database",
+    "host",
+    "protocol",
+    "start_time",
+    "end_time",
+    "duration",
+    "error",
+    "artifact",
+    "artifact_size",
+    "checksum",
+]
+
+
+def percentile(values: List[float], percent: float) -> Optional[float]:
+    """
+    Returns the nearest-rank percentile of a list of values.
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[rank - 1]
+
+
+class HistoryStore:
+    """
+    SQLite store of the outcome of every backup run.
+
+    Runs are written by a background thread, so recording a run never waits on
+    the disk. Queries open their own connection and can be made from any thread.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._queue = queue.Queue()
+        self._thread = None
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        with closing(self._connect()) as connection:
+            connection.executescript(SCHEMA)
+            self._migrate(connection)
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.filename, timeout=30)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA foreign_keys=ON")
+        return connection
+
+    def _migrate(self, connection: sqlite3.Connection):
+        columns = [row["name"] for row in connection.execute("PRAGMA table_info(runs)")]
+        # added with the restore drills, older runs are all backups
+        if "kind" not in columns:
+            connection.execute(
+                "ALTER TABLE runs ADD COLUMN kind TEXT NOT NULL DEFAULT 'backup'"
+            )
+            connection.commit()
+        columns = [
+            row["name"] for row in connection.execute("PRAGMA table_info(stages)")
+        ]
+        # added with the manifests
+        if "sha256" not in columns:
+            connection.execute("ALTER TABLE stages ADD COLUMN sha256 TEXT")
+            connection.commit()
+        # added with the stage retries
+        if "attempts" not in columns:
+            connection.execute(
+                "ALTER TABLE stages ADD COLUMN attempts INTEGER NOT NULL DEFAULT 1"
+            )
+            connection.commit()
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._write_loop, name="history-writer", daemon=True
+        )
+        self._thread.start()
+
+    def close(self):
+        """
+        Waits for the pending runs to be written and stops the writer thread.
+        """
+        if not self._thread:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def record(self, backup_data: BackupData, **details):
+        """
+        Queues a run to be written, extra keyword arguments are stored as JSON details.
+        """
+        run = backup_data.to_dict()
+        run.update(details)
+        self._queue.put(run)
+
+    def mark_uploaded(self, backup_id: str, artifact: str):
+        """
+        Queues the update of the run of a spooled backup file, successful once
+        the file is uploaded.
+        """
+        self._queue.put({"id": backup_id, "uploaded_artifact": artifact})
+
+    def _write_loop(self):
+        connection = self._connect()
+        try:
+            while True:
+                run = self._queue.get()
+                if run is None:
+                    return
+                try:
+                    if "uploaded_artifact" in run:
+                        self._write_uploaded(connection, run)
+                    else:
+                        self._write_run(connection, run)
+                except Exception as e:
+                    logger.error(f"[{run['id']}] Failed to write run history: {e}")
+        finally:
+            connection.close()
+
+    def _write_uploaded(self, connection: sqlite3.Connection, run: dict):
+        with connection:
+            connection.execute(
+                "UPDATE runs SET success = 1, error = NULL"
+                " WHERE backup_id = ? AND artifact = ? AND kind = 'backup'",
+                [run["id"], run["uploaded_artifact"]],
+            )
+
+    def _write_run(self, connection: sqlite3.Connection, run: dict):
+        run = dict(run)
+        stages = run.pop("stages", [])
+        backup_id = run.pop("id")
+        success = run.pop("success")
+        columns = {column: run.pop(column, None) for column in RUN_COLUMNS}
+        with connection:
+            cursor = connection.execute(
+                f"""INSERT INTO runs (backup_id, success, {", ".join(RUN_COLUMNS)}, details)
+                VALUES (?, ?, {", ".join("?" for _ in RUN_COLUMNS)}, ?)""",
+                [backup_id, int(success), *columns.values(), json.dumps(run)],
+            )
+            connection.executemany(
+                """INSERT INTO stages (run_id, name, wall_time, cpu_time, bytes_in, bytes_out, sha256, attempts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+                [
+                    (
+                        cursor.lastrowid,
+                        stage["name"],
+                        stage["wall_time"],
+                        stage["cpu_time"],
+                        stage["bytes_in"],
+                        stage["bytes_out"],
+                        stage.get("sha256"),
+                        stage.get("attempts", 1),
+                    )
+                    for stage in stages
+                ],
+            )
+
+    def get_runs(
+        self,
+        backup_id: str = None,
+        since: datetime = None,
+        success: bool = None,
+        limit: int = None,
+        kind: str = None,
+        artifact: str = None,
+    ) -> List[dict]:
+        """
+        Returns the runs, most recent first, with their stages and details.
+        """
+        conditions, params = [], []
+        if backup_id:
+            conditions.append("backup_id = ?")
+            params.append(backup_id)
+        if kind:
+            conditions.append("kind = ?")
+            params.append(kind)
+        if artifact:
+            conditions.append("artifact = ?")
+            params.append(artifact)
+        if since:
+            conditions.append("start_time >= ?")
+            params.append(since.isoformat())
+        if success is not None:
+            conditions.append("success = ?")
+            params.append(int(success))
+        query = "SELECT * FROM runs"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY start_time DESC, id DESC"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+
+        with closing(self._connect()) as connection:
+            rows = connection.execute(query, params).fetchall()
+            runs = []
+            for row in rows:
+                run = dict(row)
+                run["success"] = bool(run["success"])
+                run.update(json.loads(run.pop("details") or "{}"))
+                run["stages"] = [
+                    dict(stage)
+                    for stage in connection.execute(
+                        "SELECT name, wall_time, cpu_time, bytes_in, bytes_out,"
+                        " sha256, attempts FROM stages WHERE run_id = ?",
+                        (run["id"],),
+                    )
+                ]
+                runs.append(run)
+        return runs
+
+    def get_last_run(
+        self, backup_id: str, success: bool = True, kind: str = "backup"
+    ) -> Optional[dict]:
+        runs = self.get_runs(backup_id, success=success, limit=1, kind=kind)
+        return runs[0] if runs else None
+
+    def get_artifact_run(self, backup_id: str, artifact: str) -> Optional[dict]:
+        """
+        Returns the successful backup run that produced an artifact.
+        """
+        runs = self.get_runs(
+            backup_id, success=True, limit=1, kind="backup", artifact=artifact
+        )
+        return runs[0] if runs else None
+
+    def get_upload_bandwidth(
+        self, host: str, protocol: str, runs: int = 10
+    ) -> Optional[float]:
+        """
+        Returns the upload bandwidth to a host in bytes per second, over the
+        uploads of its last successful runs, or None without uploads.
+        """
+        with closing(self._connect()) as connection:
+            uploads = connection.execute(
+                "SELECT stages.bytes_in, stages.wall_time FROM stages"
+                " JOIN runs ON runs.id = stages.run_id"
+                " WHERE runs.host = ? AND runs.protocol = ? AND runs.success = 1"
+                " AND stages.name = 'upload' AND stages.wall_time > 0"
+                " ORDER BY runs.start_time DESC LIMIT ?",
+                (host, protocol, runs),
+            ).fetchall()
+        total_bytes = sum(upload[0] or 0 for upload in uploads)
+        total_time = sum(upload[1] for upload in uploads)
+        if not total_bytes:
+            return None
+        return total_bytes / total_time
+
+    def get_backup_ids(self) -> List[str]:
+        with closing(self._connect()) as connection:
+            return [
+                row[0]
+                for row in connection.execute(
+                    "SELECT DISTINCT backup_id FROM runs ORDER BY backup_id"
+                )
+            ]
+
+    def get_stats(self, backup_id: str, days: int = 30) -> dict:
+        """
+        Returns duration percentiles, stage timings and size growth of a backup,
+        and the restore times of its drills, over the last days.
+        """
+        since = datetime.now() - timedelta(days=days)
+        runs = list(reversed(self.get_runs(backup_id, since=since, kind="backup")))
+        drills = self.get_runs(backup_id, since=since, kind="drill")
+        restore_times = [
+            stage["wall_time"]
+            for drill in drills
+            for stage in drill["stages"]
+            if stage["name"] == "restore" and stage["wall_time"] is not None
+        ]
+        successful_runs = [run for run in runs if run["success"]]
+        durations = [run["duration"] for run in successful_runs if run["duration"]]
+        sizes = [
+            run["artifact_size"] for run in successful_runs if run["artifact_size"]
+        ]
+
+        stages = {}
+        for run in successful_runs:
+            for stage in run["stages"]:
+                if stage["wall_time"] is not None:
+                    stages.setdefault(stage["name"], []).append(stage["wall_time"])
+
+        return {
+            "backup_id": backup_id,
+            "days": days,
+            "runs": len(runs),
+            "failures": len(runs) - len(successful_runs),
+            "duration_p50": percentile(durations, 50),
+            "duration_p95": percentile(durations, 95),
+            "duration_max": max(durations) if durations else None,
+            "stage_p95": {
+                name: percentile(wall_times, 95) for name, wall_times in stages.items()
+            },
+            "last_size": sizes[-1] if sizes else None,
+            "size_growth": (
+                (sizes[-1] - sizes[0]) / sizes[0] if len(sizes) > 1 else None
+            ),
+            "drills": len(drills),
+            "drill_failures": len([drill for drill in drills if not drill["success"]]),
+            "restore_p95": percentile(restore_times, 95),
+            "last_restore": restore_times[0] if restore_times else None,
+        }
+
+
+_store: Optional[HistoryStore] = None
+
+
+def init_history(filename: str) -> Optional[HistoryStore]:
+    global _store
+    try:
+        _store = HistoryStore(filename)
+        _store.start()
+    except Exception as e:
+        logger.error(f"Failed to open run history '{filename}': {e}")
+        _store = None
+    return _store
+
+
+def get_store() -> Optional[HistoryStore]:
+    return _store
+
+
+def record_backup(backup_data: BackupData, **details):
+    if _store:
+        _store.record(backup_data, **details)
+
+
+def mark_uploaded(backup_id: str, artifact: str):
+    if _store:
+        _store.mark_uploaded(backup_id, artifact)
+
+
+def close_history():
+    if _store:
+        _store.close()
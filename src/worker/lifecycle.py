@@ -0,0 +1,233 @@
+"""
+Tiered storage of the backup files.
+
+The lifecycle rules of a backup move its aging files from its destination, the
+first tier, to the next tiers, and can delete them at the end:
+
+    lifecycle:
+      - after_days: 3        # from the destination to the offsite host
+        host_id: "offsite"
+        path: "/backups/app"
+      - after_days: 90       # then deleted
+
+The first rule also moves the files over max_backup_files, which are not
+deleted by the retention of the backup runs. A file is copied with its manifest
+and the zstd dictionary it needs, then checked against its manifest, and only
+then deleted from the tier it leaves, so that it is always on one tier at least.
+Restores look for the backup files in every tier, the newest first.
+
+The mover never connects to the database: it runs in the background in the
+scheduler, on the lifecycle_schedule of the backup, or with the lifecycle
+command.
+"""
+
+import hashlib
+import os
+from datetime import datetime, timedelta
+from typing import List
+
+from loguru import logger
+
+from config import Backup
+from worker.dictionary import DICTIONARY_DIR
+from worker.file import (
+    MANIFEST_SUFFIX,
+    MeteredFile,
+    get_backup_date_from_filename,
+    get_backup_file_prefix,
+    get_backup_files,
+)
+from worker.manifest import read_manifest
+from worker.transfer_client.transfer_manager import get_client
+
+
+def get_tiers(backup: Backup) -> List[Backup]:
+    """
+    Returns the backup as stored on each tier: on its destination, then on the
+    tier of each of its lifecycle rules that moves files.
+    """
+    tiers = [backup]
+    for rule in backup.lifecycle or []:
+        if not rule.deletes:
+            tiers.append(
+                backup.model_copy(
+                    update={
+                        "local": rule.local,
+                        "host_id": rule.host_id,
+                        "host_obj": rule.host_obj,
+                        "path": rule.path,
+                    }
+                )
+            )
+    return tiers
+
+
+def get_tier_name(tier: Backup) -> str:
+    return f"{'local' if tier.local else tier.host_id}:{tier.path}"
+
+
+def connect_tier(tier: Backup):
+    client = get_client(
+        tier.host_obj.protocol if not tier.local else "local", tier.host_obj
+    )
+    client.connect()
+    return client
+
+
+def _copy_file(source_client, source_path: str, target_client, target_path: str):
+    digest = hashlib.sha256()
+    with source_client.open_file(source_path) as file:
+        reader = MeteredFile(file, digest)
+        target_client.upload_fileobj(reader, target_path)
+    return reader.size, digest.hexdigest()
+
+
+def _copy_dictionary(
+    source_client, source: Backup, target_client, target: Backup, name
+):
+    target_dir = os.path.join(target.path, DICTIONARY_DIR)
+    try:
+        existing = target_client.list_files(target_dir)
+    except Exception:
+        existing = []
+    if name in (existing or []):
+        return
+    target_client.mkdir(target_dir)
+    _copy_file(
+        source_client,
+        os.path.join(source.path, DICTIONARY_DIR, name),
+        target_client,
+        os.path.join(target_dir, name),
+    )
+
+
+def move_file(source_client, source: Backup, target_client, target: Backup, filename):
+    """
+    Copies a backup file, its manifest and its dictionary from a tier to another,
+    checks the copy and deletes the file from the first tier.
+
+    :raise ValueError: If the copy does not match the manifest, the copy is
+        deleted and the file kept.
+    """
+    source_path = os.path.join(source.path, filename)
+    target_path = os.path.join(target.path, filename)
+    try:
+        manifest = read_manifest(source_client, source_path)
+    except Exception as e:
+        logger.debug(f"[{source.id}] Cannot read the manifest of {filename}: {e}")
+        manifest = None
+
+    target_client.mkdir(target.path)
+    if manifest and manifest.get("dictionary"):
+        _copy_dictionary(
+            source_client, source, target_client, target, manifest["dictionary"]
+        )
+    size, sha256 = _copy_file(source_client, source_path, target_client, target_path)
+    target_size = target_client.get_size(target_path)
+    error = None
+    if target_size is not None and target_size != size:
+        error = f"{filename} copied with {target_size} bytes instead of {size}"
+    elif manifest and (size, sha256) != (manifest["size"], manifest["sha256"]):
+        error = f"{filename} does not match its manifest"
+    if error:
+        target_client.delete_file(target_path)
+        raise ValueError(error)
+    if manifest:
+        # after the file, so that a manifest never describes a missing file
+        _copy_file(
+            source_client,
+            source_path + MANIFEST_SUFFIX,
+            target_client,
+            target_path + MANIFEST_SUFFIX,
+        )
+        source_client.delete_file(source_path + MANIFEST_SUFFIX)
+    source_client.delete_file(source_path)
+
+
+def delete_file(client, tier: Backup, filename: str):
+    path = os.path.join(tier.path, filename)
+    client.delete_file(path)
+    if filename + MANIFEST_SUFFIX in (client.list_files(tier.path) or []):
+        client.delete_file(path + MANIFEST_SUFFIX)
+
+
+def _get_due_files(
+    files: List[str], backup: Backup, prefix: str, after_days: int, keep: int = None
+) -> List[str]:
+    """
+    Returns the files older than after_days, and the oldest files over keep,
+    oldest first.
+    """
+    limit = datetime.now() - timedelta(days=after_days)
+    overflow = files[:-keep] if keep and len(files) > keep else []
+    return [
+        file
+        for file in files
+        if file in overflow
+        or get_backup_date_from_filename(file, prefix, backup.date_format) <= limit
+    ]
+
+
+def apply_lifecycle(backup: Backup) -> dict:
+    """
+    Moves the aging backup files of a backup to their next tier, or deletes
+    them, from the first tier to the last one.
+
+    :return: The number of files moved, deleted, and that failed to.
+    """
+    stats = {"moved": 0, "deleted": 0, "failed": 0}
+    if not backup.lifecycle:
+        return stats
+    prefix = get_backup_file_prefix(backup.id, backup.filename)
+    tiers = get_tiers(backup)
+    for index, rule in enumerate(backup.lifecycle):
+        source = tiers[index]
+        target = None if rule.deletes else tiers[index + 1]
+        source_client = target_client = None
+        try:
+            source_client = connect_tier(source)
+            files = get_backup_files(
+                source_client.list_files(source.path), prefix, backup.date_format
+            )
+            due = _get_due_files(
+                files,
+                backup,
+                prefix,
+                rule.after_days,
+                backup.max_backup_files if index == 0 else None,
+            )
+            if not due:
+                continue
+            if target:
+                target_client = connect_tier(target)
+            for filename in due:
+                try:
+                    if target:
+                        move_file(
+                            source_client, source, target_client, target, filename
+                        )
+                        stats["moved"] += 1
+                        logger.info(
+                            f"[{backup.id}] Moved {filename} from"
+                            f" {get_tier_name(source)} to {get_tier_name(target)}"
+                        )
+                    else:
+                        delete_file(source_client, source, filename)
+                        stats["deleted"] += 1
+                        logger.info(
+                            f"[{backup.id}] Deleted {filename} from"
+                            f" {get_tier_name(source)}"
+                        )
+                except Exception as e:
+                    stats["failed"] += 1
+                    logger.error(f"[{backup.id}] Lifecycle of {filename} failed: {e}")
+        except Exception as e:
+            stats["failed"] += 1
+            logger.error(
+                f"[{backup.id}] Lifecycle of {get_tier_name(source)} failed: {e}"
+            )
+        finally:
+            for client in (source_client, target_client):
+                if client:
+                    client.disconnect()
+    return stats
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+from typing import List
+
+from loguru import logger
+
+from config import Backup
+from data.BackupData import BackupData
+from worker.file import MANIFEST_SUFFIX, get_backup_file_prefix, get_backup_files
+
+MANIFEST_VERSION = 1
+CHUNK_SIZE = 1024 * 1024
+
+
+def build_manifest(backup_data: BackupData) -> dict:
+    """
+    Returns the manifest of the artifact of a backup run, from the sizes and
+    hashes recorded by its stages.
+    """
+    encryption = None
+    if backup_data.encrypt:
+        from worker.security import FORMAT_NAME, ITERATIONS
+
+        encryption = {
+            "format": FORMAT_NAME,
+            "cipher": "fernet",
+            "kdf": "pbkdf2-sha256",
+            "iterations": ITERATIONS,
+        }
+    row_counts = backup_data.row_counts or {}
+    return {
+        "version": MANIFEST_VERSION,
+        "backup_id": backup_data.id,
+        "created": backup_data.start_time.isoformat(),
+        "artifact": backup_data.artifact,
+        "size": backup_data.artifact_size,
+        "sha256": backup_data.checksum,
+        "codec": backup_data.codec,
+        "codec_level": backup_data.codec_level,
+        # measures behind the choice of the auto compression mode
+        "codec_choice": backup_data.codec_choice,
+        # zstd dictionary, in the dictionaries/ directory next to the backups
+        "dictionary": backup_data.dictionary,
+        "encryption": encryption,
+        "database": backup_data.database,
+        "engine": backup_data.engine,
+        # the members of a multi-database archive
+        "databases": backup_data.databases,
+        "source": backup_data.source,
+        "source_lag": backup_data.source_lag,
+        "tables": sorted(row_counts),
+        "row_counts": row_counts,
+        "stages": {
+            stage.name: {"size": stage.bytes_out, "sha256": stage.sha256}
+            for stage in backup_data.stages
+            if stage.sha256
+        },
+    }
+
+
+def write_manifest(backup_data: BackupData, directory: str) -> str:
+    """
+    Writes the manifest of a backup run next to its artifact and returns its path.
+    """
+    filepath = os.path.join(directory, backup_data.artifact + MANIFEST_SUFFIX)
+    with open(filepath, "w") as file:
+        json.dump(build_manifest(backup_data), file, indent=2)
+    return filepath
+
+
+def read_manifest(client, remote_path: str) -> dict:
+    with client.open_file(remote_path + MANIFEST_SUFFIX) as file:
+        return json.loads(file.read())
+
+
+def _download_sha256(client, remote_path: str) -> str:
+    digest = hashlib.sha256()
+    with client.open_file(remote_path) as file:
+        while chunk := file.read(CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify_file(client, remote_dir: str, filename: str, download=False) -> dict:
+    """
+    Compares the size and hash of a remote backup file against its manifest.
+
+    The hash is computed on the remote side when the protocol allows it,
+    otherwise only if download is set.
+
+    :return: The result, with the list of errors and whether the hash was checked.
+    """
+    remote_path = os.path.join(remote_dir, filename)
+    result = {"file": filename, "errors": [], "size": None, "sha256": None}
+    try:
+        manifest = read_manifest(client, remote_path)
+    except Exception as e:
+        result["errors"].append(f"cannot read the manifest: {e}")
+        return result
+
+    size = client.get_size(remote_path)
+    result["size"] = size
+    if size is not None and size != manifest["size"]:
+        result["errors"].append(f"size {size} instead of {manifest['size']}")
+
+    sha256 = client.get_sha256(remote_path)
+    if sha256 is None and download:
+        sha256 = _download_sha256(client, remote_path)
+    result["sha256"] = sha256
+    if sha256 is not None and sha256 != manifest["sha256"]:
+        result["errors"].append(f"sha256 {sha256} instead of {manifest['sha256']}")
+    return result
+
+
+def _verify_repository(backup: Backup, client, filename, all_files, download):
+    """
+    Checks that the chunks of repository recipes exist, and with download that
+    their content matches their id.
+    """
+    from worker.repository import open_repository
+
+    repository = open_repository(client, backup)
+    if filename:
+        filenames = [filename]
+    else:
+        filenames = repository.list_recipes(
+            get_backup_file_prefix(backup.id, backup.filename), backup.date_format
+        )
+        if not all_files:
+            filenames = filenames[-1:]
+
+    results = []
+    for name in filenames:
+        errors = repository.verify(name, download)
+        results.append({"file": name, "errors": errors})
+        if errors:
+            logger.error(f"[{backup.id}] {name}: {', '.join(errors)}")
+        elif download:
+            logger.success(f"[{backup.id}] {name}: all chunks match their id")
+        else:
+            logger.warning(
+                f"[{backup.id}] {name}: all chunks exist, their content was not"
+                " checked (use --download)"
+            )
+    return results
+
+
+def verify_backup(
+    backup: Backup, filename: str = None, all_files=False, download=False
+) -> List[dict]:
+    """
+    Verifies the backup files of a backup against their manifests, or the
+    recipes of a repository backup: the latest one, a given one, or all of them.
+    The backup files are looked for on every tier (see worker/lifecycle.py).
+    """
+    from worker.lifecycle import connect_tier, get_tier_name, get_tiers
+    from worker.transfer_client.base import is_not_found_error
+
+    if backup.repository:
+        client = connect_tier(backup)
+        try:
+            return _verify_repository(backup, client, filename, all_files, download)
+        finally:
+            client.disconnect()
+
+    prefix = get_backup_file_prefix(backup.id, backup.filename)
+    # each tier holds older files than the tiers before it
+    tier_results = []
+    for index, tier in enumerate(get_tiers(backup)):
+        client = connect_tier(tier)
+        try:
+            try:
+                filenames = get_backup_files(
+                    client.list_files(tier.path), prefix, backup.date_format
+                )
+            except Exception as e:
+                # a tier no file was moved to yet
+                if index == 0 or not is_not_found_error(e):
+                    raise
+                filenames = []
+            if filename:
+                filenames = [filename] if filename in filenames else []
+            elif not all_files:
+                filenames = filenames[-1:]
+            results = [
+                verify_file(client, tier.path, name, download) for name in filenames
+            ]
+        finally:
+            client.disconnect()
+        for result in results:
+            result["tier"] = get_tier_name(tier)
+        tier_results.insert(0, results)
+        if results and (filename or not all_files):
+            break
+    results = [result for results in tier_results for result in results]
+
+    for result in results:
+        if result["errors"]:
+            logger.error(
+                f"[{backup.id}] {result['file']}: {', '.join(result['errors'])}"
+            )
+        elif result["sha256"] is None:
+            logger.warning(
+                f"[{backup.id}] {result['file']}: size matches the manifest,"
+                " the hash cannot be computed remotely (use --download)"
+            )
+        else:
+            logger.success(f"[{backup.id}] {result['file']}: matches the manifest")
+    return results
@@ -0,0 +1,192 @@
+"""
+Prometheus metrics of the scheduler process.
+
+The metrics are only created once init_metrics() has been called (when the
+http server is enabled), every other function is a no-op until then so that
+the backup path does not pay for metrics it does not export.
+"""
+
+import threading
+import time
+from typing import Optional
+
+from data.BackupData import BackupData
+
+DURATION_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 28800]
+SIZE_BUCKETS = [1_000_000 * 4**i for i in range(11)]  # 1 MB to ~1 TB
+
+_metrics: Optional[dict] = None
+_jobs_submitted = 0
+_jobs_started = 0
+# the scheduler submits and starts jobs from several threads
+_jobs_lock = threading.Lock()
+
+
+def init_metrics():
+    global _metrics
+    if _metrics is not None:
+        return
+
+    from prometheus_client import Counter, Gauge, Histogram
+
+    _metrics = {
+        "stage_duration": Histogram(
+            "dbackup_stage_duration_seconds",
+            "Wall time of each backup stage.",
+            ["backup_id", "stage"],
+            buckets=DURATION_BUCKETS,
+        ),
+        "stage_size": Histogram(
+            "dbackup_stage_output_bytes",
+            "Size of the file produced by each backup stage.",
+            ["backup_id", "stage"],
+            buckets=SIZE_BUCKETS,
+        ),
+        "stage_throughput": Gauge(
+            "dbackup_stage_throughput_mb_per_second",
+            "Throughput of the last run of each backup stage.",
+            ["backup_id", "stage"],
+        ),
+        "backup_duration": Histogram(
+            "dbackup_backup_duration_seconds",
+            "Total duration of the backup tasks.",
+            ["backup_id"],
+            buckets=DURATION_BUCKETS,
+        ),
+        "backup_runs": Counter(
+            "dbackup_backup_runs",
+            "Number of backup runs.",
+            ["backup_id", "status"],
+        ),
+        "last_success": Gauge(
+            "dbackup_last_success_timestamp_seconds",
+            "Unix timestamp of the last successful backup.",
+            ["backup_id"],
+        ),
+        "restore_duration": Gauge(
+            "dbackup_restore_duration_seconds",
+            "Restore time of the last restore drill.",
+            ["backup_id"],
+        ),
+        "drill_runs": Counter(
+            "dbackup_restore_drill_runs",
+            "Number of restore drills.",
+            ["backup_id", "status"],
+        ),
+        "last_drill_success": Gauge(
+            "dbackup_last_restore_drill_success_timestamp_seconds",
+            "Unix timestamp of the last successful restore drill.",
+            ["backup_id"],
+        ),
+        "deferral": Histogram(
+            "dbackup_deferral_seconds",
+            "Time a backup waited for a quiet database before its dump.",
+            ["backup_id"],
+            buckets=DURATION_BUCKETS,
+        ),
+        "running_jobs": Gauge("dbackup_running_jobs", "Number of running backups."),
+        "queue_depth": Gauge(
+            "dbackup_queued_jobs", "Number of backups waiting for a free worker."
+        ),
+        "transfer_retries": Counter(
+            "dbackup_transfer_retries",
+            "Number of retried transfer operations.",
+            ["backup_id", "protocol"],
+        ),
+        "pooled_connections": Gauge(
+            "dbackup_pooled_connections",
+            "Number of open pooled connections.",
+            ["kind"],
+        ),
+        "spool_files": Gauge(
+            "dbackup_spool_files", "Number of backup files waiting in the spool."
+        ),
+        "spool_bytes": Gauge(
+            "dbackup_spool_bytes", "Size of the backup files waiting in the spool."
+        ),
+    }
+    # computed on scrape, a job can start before its submission event is handled
+    _metrics["queue_depth"].set_function(
+        lambda: max(_jobs_submitted - _jobs_started, 0)
+    )
+
+
+def render() -> bytes:
+    from prometheus_client import generate_latest
+
+    return generate_latest()
+
+
+def job_submitted():
+    global _jobs_submitted
+    with _jobs_lock:
+        _jobs_submitted += 1
+
+
+def job_started():
+    global _jobs_started
+    with _jobs_lock:
+        _jobs_started += 1
+    if _metrics:
+        _metrics["running_jobs"].inc()
+
+
+def job_finished():
+    if _metrics:
+        _metrics["running_jobs"].dec()
+
+
+def observe_backup(backup_data: BackupData):
+    if not _metrics:
+        return
+
+    status = "success" if backup_data.success else "failure"
+    _metrics["backup_runs"].labels(backup_data.id, status).inc()
+    if backup_data.end_time:
+        duration = backup_data.get_duration()
+        _metrics["backup_duration"].labels(backup_data.id).observe(duration)
+    if backup_data.success:
+        _metrics["last_success"].labels(backup_data.id).set(time.time())
+
+    if backup_data.deferred_seconds is not None:
+        _metrics["deferral"].labels(backup_data.id).observe(
+            backup_data.deferred_seconds
+        )
+
+    for stage in backup_data.stages:
+        labels = (backup_data.id, stage.name)
+        if stage.wall_time is not None:
+            _metrics["stage_duration"].labels(*labels).observe(stage.wall_time)
+        if stage.bytes_out is not None:
+            _metrics["stage_size"].labels(*labels).observe(stage.bytes_out)
+        if stage.throughput is not None:
+            _metrics["stage_throughput"].labels(*labels).set(stage.throughput)
+
+
+def observe_drill(backup_data: BackupData):
+    if not _metrics:
+        return
+
+    status = "success" if backup_data.success else "failure"
+    _metrics["drill_runs"].labels(backup_data.id, status).inc()
+    if backup_data.success:
+        _metrics["last_drill_success"].labels(backup_data.id).set(time.time())
+    restore_stage = backup_data.get_stage("restore")
+    if restore_stage and restore_stage.wall_time is not None:
+        _metrics["restore_duration"].labels(backup_data.id).set(restore_stage.wall_time)
+
+
+def inc_transfer_retries(backup_id: str, protocol: str):
+    if _metrics:
+        _metrics["transfer_retries"].labels(backup_id, protocol).inc()
+
+
+def set_pooled_connections(kind: str, count: int):
+    if _metrics:
+        _metrics["pooled_connections"].labels(kind).set(count)
+
+
+def set_spool_depth(files: int, size: int):
+    if _metrics:
+        _metrics["spool_files"].set(files)
+        _metrics["spool_bytes"].set(size)
@@ -1,11 +1,111 @@
-from abc import ABC, abstractmethod
-from typing import List
-import requests
+"""
+Notifications are sent in the background by a NotificationDispatcher: the jobs
+queue their messages and return, and a few worker threads send them with the
+client of each notification, kept open between messages (one SMTP connection or
+HTTP session per notification) and closed after idle_timeout seconds unused.
+A failed message is retried with a doubling delay, or after the delay asked by
+a rate limited Discord webhook.
+
+A notification with digest collects the runs instead, and sends one message
+with all the runs of digest_window seconds, from its first run, and their
+totals. Failed runs are also sent right away with digest_failures_immediately.
+The digests still open when dbackup exits are sent before it does.
+"""
+
+import html
+import queue
 import smtplib
+import threading
+import time
+from abc import ABC, abstractmethod
 from email.mime.text import MIMEText
-from config import Notification
+from typing import Dict, List, Optional
+
+import requests
 from loguru import logger
+
+from config import Notification, NotificationDelivery
 from data.BackupData import BackupData
+from worker import metrics
+from worker.progress import format_duration
+from worker.utils import format_bytes
+
+# seconds before an unanswered webhook request fails
+HTTP_TIMEOUT = 10
+# upper bound of the delay between two attempts, in seconds
+MAX_RETRY_DELAY = 300
+# Discord limit of the description of an embed
+DISCORD_DESCRIPTION_LIMIT = 4096
+
+
+def _get_deferral_summary(backup_data: BackupData) -> str:
+    summary = (
+        f"{format_duration(backup_data.deferred_seconds)} waiting for a quiet database"
+    )
+    if backup_data.admission and backup_data.admission["forced"]:
+        summary += ", started at the deadline"
+    return summary
+
+
+def get_digest_entry(backup_data: BackupData, listed: bool = True) -> dict:
+    """
+    Returns what a digest keeps of a run.
+
+    :param listed: Whether the run gets a line in the digest, as the notify_on_*
+        settings of its backup ask; every run is counted in the totals.
+    """
+    return {
+        "id": backup_data.id,
+        "listed": listed,
+        "kind": backup_data.kind,
+        "success": backup_data.success,
+        "error": backup_data.error,
+        "duration": backup_data.get_duration(),
+        "size": backup_data.artifact_size,
+    }
+
+
+def _get_digest_title(entries: List[dict]) -> str:
+    failed = sum(1 for entry in entries if not entry["success"])
+    icon = "❌" if failed else "✅"
+    return f"{icon} dbackup digest: {len(entries)} run(s), {failed} failed {icon}"
+
+
+def _get_digest_totals(entries: List[dict]) -> str:
+    duration = sum(entry["duration"] or 0 for entry in entries)
+    size = sum(entry["size"] or 0 for entry in entries)
+    return (
+        f"total duration {format_duration(duration)}, total size {format_bytes(size)}"
+    )
+
+
+def _get_digest_lines(entries: List[dict]) -> List[str]:
+    """
+    Returns one line per listed run, the failed runs first.
+    """
+    lines = []
+    for entry in sorted(entries, key=lambda entry: entry["success"]):
+        if not entry.get("listed", True):
+            continue
+        name = "drill" if entry["kind"] == "drill" else "backup"
+        if entry["success"]:
+            line = f"✅ [{entry['id']}] {name} in {format_duration(entry['duration'] or 0)}"
+            if entry["size"] is not None:
+                line += f", {format_bytes(entry['size'])}"
+        else:
+            line = f"❌ [{entry['id']}] {name} failed: {entry['error']}"
+        lines.append(line)
+    return lines
+
+
+class RetryLater(Exception):
+    """
+    A message to send again after delay seconds.
+    """
+
+    def __init__(self, message: str, delay: float):
+        super().__init__(message)
+        self.delay = delay
 
 
 # Abstract Base Class for Notification Clients
@@ -21,27 +121,75 @@ class NotificationClient(ABC):
     def disconnect(self):
         pass
 
+    @classmethod
     @abstractmethod
-    def send_message(self, backup_data: BackupData):
+    def build_message(cls, backup_data: BackupData):
+        """
+        Returns the message of a run, built when it is queued.
+        """
+        pass
+
+    @abstractmethod
+    def send(self, message):
+        """
+        Sends a message built by build_message, raises if it was not sent.
+        """
         pass
 
+    @classmethod
+    @abstractmethod
+    def build_digest(cls, entries: List[dict]):
+        """
+        Returns the message of the digest of several runs.
+        """
+        pass
+
+    def send_message(self, backup_data: BackupData):
+        self.send(self.build_message(backup_data))
+
+
+def _get_retry_after(response: requests.Response) -> float:
+    try:
+        return float(response.json()["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return float(response.headers.get("Retry-After", 1))
+
 
 # Discord Notification Client
 class DiscordNotificationClient(NotificationClient):
     def __init__(self, discord_webhook_url):
         self.discord_webhook_url = discord_webhook_url
+        self.session = None
+        # set when the rate limit of the webhook is used up
+        self._blocked_until = 0
 
     def connect(self):
-        pass
+        self.session = requests.Session()
 
     def disconnect(self):
-        pass
+        if self.session:
+            self.session.close()
+            self.session = None
 
-    def send_message(self, backup_data: BackupData):
-        self._send_message(backup_data)
+    def send(self, message: dict):
+        wait = self._blocked_until - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        response = self.session.post(
+            self.discord_webhook_url, json=message, timeout=HTTP_TIMEOUT
+        )
+        if response.status_code == 429:
+            raise RetryLater("Discord rate limit reached", _get_retry_after(response))
+        response.raise_for_status()
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            self._blocked_until = time.monotonic() + float(
+                response.headers.get("X-RateLimit-Reset-After", 0)
+            )
+        logger.debug("Notification sent successfully!")
 
-    def _send_message(self, backup_data: BackupData):
-        color = self.SUCCESS_COLOR if backup_data.success else self.ERROR_COLOR
+    @classmethod
+    def build_message(cls, backup_data: BackupData) -> dict:
+        color = cls.SUCCESS_COLOR if backup_data.success else cls.ERROR_COLOR
 
         embed_data = {
             "embeds": [
@@ -84,12 +232,53 @@ class DiscordNotificationClient(NotificationClient):
             ]
         }
 
-        try:
-            response = requests.post(self.discord_webhook_url, json=embed_data)
-            response.raise_for_status()
-            logger.debug("Notification sent successfully!")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to send Discord notification: {e}")
+        if backup_data.deferred_seconds:
+            embed_data["embeds"][0]["fields"].append(
+                {
+                    "name": "Deferred",
+                    "value": _get_deferral_summary(backup_data),
+                    "inline": False,
+                }
+            )
+
+        if backup_data.stages:
+            embed_data["embeds"][0]["fields"].append(
+                {
+                    "name": "Stages",
+                    "value": backup_data.get_stages_summary(),
+                    "inline": False,
+                }
+            )
+
+        return embed_data
+
+    @classmethod
+    def build_digest(cls, entries: List[dict]) -> dict:
+        failed = any(not entry["success"] for entry in entries)
+        lines = _get_digest_lines(entries)
+        description = ""
+        for index, line in enumerate(lines):
+            more = f"\n… and {len(lines) - index} more"
+            if len(description) + len(line) + 1 + len(more) > DISCORD_DESCRIPTION_LIMIT:
+                description += more
+                break
+            description += ("\n" if description else "") + line
+        return {
+            "embeds": [
+                {
+                    "title": _get_digest_title(entries),
+                    "color": cls.ERROR_COLOR if failed else cls.SUCCESS_COLOR,
+                    "description": description,
+                    "fields": [
+                        {
+                            "name": "Totals",
+                            "value": _get_digest_totals(entries),
+                            "inline": False,
+                        }
+                    ],
+                }
+            ]
+        }
 
 
 # Email Notification Client
@@ -116,28 +305,37 @@ class EmailNotificationClient(NotificationClient):
         self.server = None
 
     def connect(self):
-        try:
-            if self.smtp_use_ssl:
-                self.server = smtplib.SMTP_SSL(
-                    self.smtp_server, self.smtp_port, timeout=10
-                )
-            else:
-                self.server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=10)
-                if self.smtp_use_tls:
-                    self.server.starttls()
+        if self.smtp_use_ssl:
+            self.server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=10)
+        else:
+            self.server = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=10)
+            if self.smtp_use_tls:
+                self.server.starttls()
 
-            self.server.login(self.smtp_user, self.smtp_password)
-        except Exception as e:
-            logger.error(f"Failed to connect to SMTP server: {e}")
+        self.server.login(self.smtp_user, self.smtp_password)
 
     def disconnect(self):
         if self.server:
-            self.server.quit()
+            try:
+                self.server.quit()
+            except smtplib.SMTPException:
+                # already closed by the server
+                self.server.close()
             self.server = None
 
-    def send_message(self, backup_data: BackupData):
+    @classmethod
+    def build_message(cls, backup_data: BackupData):
         subject = backup_data.status_short
-        color = self.SUCCESS_COLOR if backup_data.success else self.ERROR_COLOR
+        color = cls.SUCCESS_COLOR if backup_data.success else cls.ERROR_COLOR
+        stages_summary = backup_data.get_stages_summary().replace("\n", "<br>")
+        deferral_row = ""
+        if backup_data.deferred_seconds:
+            deferral_row = f"""
+    <tr>
+        <td style="padding: 16px;">
+            <p style="margin: 0;"><strong>Deferred:</strong> {_get_deferral_summary(backup_data)}</p>
+        </td>
+    </tr>"""
         message = f"""
 <table border="0" cellpadding="0" cellspacing="0" width="100%" style="max-width: 500px; font-family: Arial, sans-serif; border: 1px solid #cccccc;">
     <tr>
@@ -178,26 +376,333 @@ class EmailNotificationClient(NotificationClient):
         <td style="padding: 16px;">
             <p style="margin: 0;"><strong>Duration:</strong> {backup_data.duration_in_seconds} seconds</p>
         </td>
+    </tr>{deferral_row}
+    <tr>
+        <td style="padding: 16px;">
+            <p style="margin: 0;"><strong>Stages:</strong><br>{stages_summary}</p>
+        </td>
     </tr>
 </table>
 """
-        self._send_email(subject, message)
+        return subject, message
 
-    def _send_email(self, subject, body):
-        if not self.server:
-            logger.error("SMTP server connection is not established")
-            return
+    @classmethod
+    def build_digest(cls, entries: List[dict]):
+        subject = _get_digest_title(entries)
+        failed = any(not entry["success"] for entry in entries)
+        color = cls.ERROR_COLOR if failed else cls.SUCCESS_COLOR
+        rows = "".join(f"""
+    <tr>
+        <td style="padding: 4px 16px;">{html.escape(line)}</td>
+    </tr>""" for line in _get_digest_lines(entries))
+        message = f"""
+<table border="0" cellpadding="0" cellspacing="0" width="100%" style="max-width: 500px; font-family: Arial, sans-serif; border: 1px solid #cccccc;">
+    <tr>
+        <td style="padding: 16px; background-color: #{color:06x}; color: #ffffff; font-size: 18px; font-weight: bold;">
+            {subject}
+        </td>
+    </tr>
+    <tr>
+        <td style="padding: 16px;">
+            <p style="margin: 0;"><strong>Totals:</strong> {_get_digest_totals(entries)}</p>
+        </td>
+    </tr>{rows}
+</table>
+"""
+        return subject, message
 
+    def send(self, message):
+        subject, body = message
         msg = MIMEText(body, "html")
         msg["Subject"] = subject
         msg["From"] = self.sender
         msg["To"] = ", ".join(self.recipients)
 
+        self.server.sendmail(self.sender, self.recipients, msg.as_string())
+        logger.debug(f"Email sent successfully to: {self.recipients}")
+
+
+def _create_client(notification: Notification) -> NotificationClient:
+    if notification.method == "discord":
+        return DiscordNotificationClient(notification.discord_webhook_url)
+    return EmailNotificationClient(
+        notification.smtp_server,
+        notification.smtp_port,
+        notification.smtp_user,
+        notification.smtp_password,
+        notification.smtp_use_tls,
+        notification.smtp_use_ssl,
+        notification.smtp_sender,
+        notification.smtp_recipients,
+    )
+
+
+CLIENT_CLASSES = {
+    "discord": DiscordNotificationClient,
+    "email": EmailNotificationClient,
+}
+
+
+def _is_permanent(error: Exception) -> bool:
+    """
+    Whether sending again cannot help: a rejected webhook or SMTP login.
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return 400 <= error.response.status_code < 500
+    return isinstance(
+        error, (smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused)
+    )
+
+
+class _PooledClient:
+    """
+    The open client of a notification, used by one worker at a time.
+    """
+
+    def __init__(self, notification: Notification):
+        self.notification = notification
+        self.lock = threading.Lock()
+        self.client: Optional[NotificationClient] = None
+        self.last_used = 0.0
+
+
+class _Digest:
+    """
+    The runs collected for a notification until due.
+    """
+
+    def __init__(self, notification: Notification):
+        self.notification = notification
+        self.entries: List[dict] = []
+        self.due = time.monotonic() + notification.digest_window
+
+
+class NotificationDispatcher:
+    def __init__(self, settings: NotificationDelivery):
+        self.settings = settings
+        self._queue = queue.Queue()
+        self._clients: Dict[str, _PooledClient] = {}
+        self._clients_lock = threading.Lock()
+        self._digests: Dict[str, _Digest] = {}
+        self._digests_changed = threading.Condition()
+        self._closing = False
+        self._digest_thread = threading.Thread(
+            target=self._send_due_digests, name="notification-digest", daemon=True
+        )
+        self._digest_thread.start()
+        self._threads = [
+            threading.Thread(
+                target=self._work, name=f"notification-{index}", daemon=True
+            )
+            for index in range(settings.workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, backup_id: str, notification: Notification, message):
+        self._queue.put((backup_id, notification, message))
+
+    def collect(self, notification: Notification, entry: dict):
+        """
+        Adds a run to the digest of a notification.
+        """
+        with self._digests_changed:
+            digest = self._digests.get(notification.id)
+            if not digest:
+                digest = self._digests[notification.id] = _Digest(notification)
+                self._digests_changed.notify()
+            digest.entries.append(entry)
+
+    def _submit_digest(self, digest: _Digest):
+        client_class = CLIENT_CLASSES[digest.notification.method.value]
+        self.submit(
+            "digest", digest.notification, client_class.build_digest(digest.entries)
+        )
+
+    def _send_due_digests(self):
+        with self._digests_changed:
+            while not self._closing:
+                now = time.monotonic()
+                for notification_id, digest in list(self._digests.items()):
+                    if digest.due <= now:
+                        del self._digests[notification_id]
+                        self._submit_digest(digest)
+                next_due = min(
+                    (digest.due for digest in self._digests.values()), default=None
+                )
+                self._digests_changed.wait(None if next_due is None else next_due - now)
+
+    def _work(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.settings.idle_timeout)
+            except queue.Empty:
+                self._close_idle_clients()
+                continue
+            if item is None:
+                self._queue.task_done()
+                return
+            try:
+                self._deliver(*item)
+            except Exception as e:
+                logger.error(f"Notification worker error: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _deliver(self, backup_id: str, notification: Notification, message):
+        max_attempts = self.settings.max_attempts
+        for attempt in range(1, max_attempts + 1):
+            try:
+                self._send(notification, message)
+                logger.debug(
+                    f"[{backup_id}] Notification '{notification.id}' sent"
+                    f" (attempt {attempt})"
+                )
+                return
+            except Exception as e:
+                if _is_permanent(e) or attempt == max_attempts:
+                    logger.error(
+                        f"[{backup_id}] Failed to send the {notification.method.value}"
+                        f" notification '{notification.id}' after {attempt}"
+                        f" attempt(s): {e}"
+                    )
+                    return
+                delay = min(
+                    max(
+                        self.settings.retry_delay * 2 ** (attempt - 1),
+                        e.delay if isinstance(e, RetryLater) else 0,
+                    ),
+                    MAX_RETRY_DELAY,
+                )
+                logger.warning(
+                    f"[{backup_id}] Notification '{notification.id}' attempt"
+                    f" {attempt}/{max_attempts} failed: {e}, retrying in {delay:.1f}s"
+                )
+                time.sleep(delay)
+
+    def _send(self, notification: Notification, message):
+        with self._clients_lock:
+            pooled = self._clients.setdefault(
+                notification.id, _PooledClient(notification)
+            )
+        with pooled.lock:
+            if (
+                pooled.client
+                and time.monotonic() - pooled.last_used > self.settings.idle_timeout
+            ):
+                self._close_client(pooled)
+            if not pooled.client:
+                client = _create_client(notification)
+                client.connect()
+                pooled.client = client
+                self._report_pooled_clients()
+            try:
+                pooled.client.send(message)
+            except RetryLater:
+                raise
+            except Exception:
+                # a broken connection is opened again by the next attempt
+                self._close_client(pooled)
+                raise
+            finally:
+                pooled.last_used = time.monotonic()
+
+    def _close_client(self, pooled: _PooledClient):
         try:
-            self.server.sendmail(self.sender, self.recipients, msg.as_string())
-            logger.debug("Email sent successfully to: {self.recipients}")
+            pooled.client.disconnect()
         except Exception as e:
-            logger.error(f"Failed to send email: {e}")
+            logger.debug(
+                f"Failed to close notification '{pooled.notification.id}': {e}"
+            )
+        pooled.client = None
+        self._report_pooled_clients()
+
+    def _close_idle_clients(self, all_clients: bool = False):
+        with self._clients_lock:
+            pooled_clients = list(self._clients.values())
+        for pooled in pooled_clients:
+            # clients in use are not idle
+            if not pooled.lock.acquire(blocking=all_clients):
+                continue
+            try:
+                if pooled.client and (
+                    all_clients
+                    or time.monotonic() - pooled.last_used > self.settings.idle_timeout
+                ):
+                    self._close_client(pooled)
+            finally:
+                pooled.lock.release()
+
+    def _report_pooled_clients(self):
+        with self._clients_lock:
+            pooled_clients = list(self._clients.values())
+        for method in CLIENT_CLASSES:
+            metrics.set_pooled_connections(
+                method,
+                sum(
+                    1
+                    for pooled in pooled_clients
+                    if pooled.client and pooled.notification.method.value == method
+                ),
+            )
+
+    def close(self, timeout: float = None):
+        """
+        Waits up to timeout seconds for the queued messages to be sent, then
+        stops the workers and closes the clients.
+        """
+        with self._digests_changed:
+            self._closing = True
+            self._digests_changed.notify()
+            # the digests are sent early rather than lost
+            for digest in self._digests.values():
+                self._submit_digest(digest)
+            self._digests.clear()
+        self._digest_thread.join()
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    logger.warning(
+                        f"{self._queue.unfinished_tasks} notification(s) not sent"
+                        " before exiting"
+                    )
+                    return
+                self._queue.all_tasks_done.wait(remaining)
+        for _thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._close_idle_clients(all_clients=True)
+
+
+_dispatcher: Optional[NotificationDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def start_dispatcher(settings: NotificationDelivery = None) -> NotificationDispatcher:
+    """
+    Starts the notification workers, once.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = NotificationDispatcher(settings or NotificationDelivery())
+        return _dispatcher
+
+
+def stop_dispatcher():
+    """
+    Sends the queued notifications, for up to shutdown_timeout seconds, and
+    stops the workers.
+    """
+    global _dispatcher
+    with _dispatcher_lock:
+        dispatcher, _dispatcher = _dispatcher, None
+    if dispatcher:
+        dispatcher.close(dispatcher.settings.shutdown_timeout)
 
 
 def send_notifications(
@@ -206,28 +711,23 @@ def send_notifications(
     notify_on_success: bool,
     notify_on_fail: bool,
 ):
-    if (not notify_on_success and backup_data.success) or (
-        not notify_on_fail and not backup_data.success
-    ):
+    wanted = notify_on_success if backup_data.success else notify_on_fail
+    if not wanted and not any(notification.digest for notification in notifications):
         return
+    dispatcher = start_dispatcher()
     for notification in notifications:
-        if notification.method == "discord":
-            client = DiscordNotificationClient(notification.discord_webhook_url)
-        elif notification.method == "email":
-            client = EmailNotificationClient(
-                notification.smtp_server,
-                notification.smtp_port,
-                notification.smtp_user,
-                notification.smtp_password,
-                notification.smtp_use_tls,
-                notification.smtp_use_ssl,
-                notification.smtp_sender,
-                notification.smtp_recipients,
-            )
-        else:
+        client_class = CLIENT_CLASSES.get(notification.method.value)
+        if not client_class:
             logger.error(f"Unsupported notification method: {notification.method}")
             continue
-
-        client.connect()
-        client.send_message(backup_data)
-        client.disconnect()
+        if notification.digest:
+            # every run is counted, so that a digest also tells what succeeded
+            dispatcher.collect(notification, get_digest_entry(backup_data, wanted))
+            if backup_data.success or not notification.digest_failures_immediately:
+                continue
+        if not wanted:
+            continue
+        # built now, the worker may send it after the job is done
+        dispatcher.submit(
+            backup_data.id, notification, client_class.build_message(backup_data)
+        )
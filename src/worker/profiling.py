@@ -0,0 +1,170 @@
+import cProfile
+import io
+import os
+import pstats
+import resource
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+from loguru import logger
+
+from worker.utils import format_bytes
+
+REPORT_DIR = "/dbackup/storage/logs/profiles"
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 20
+
+# only one cProfile profiler can be active at a time
+_cprofile_lock = threading.Lock()
+_tracemalloc_lock = threading.Lock()
+_tracemalloc_users = 0
+
+
+def set_report_dir(path: str):
+    global REPORT_DIR
+    REPORT_DIR = path
+
+
+def get_run_report_dir(backup_id: str) -> str:
+    """
+    Returns a new report directory for a run of a backup.
+    """
+    return os.path.join(
+        REPORT_DIR, backup_id, datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+    )
+
+
+def _reset_peak_rss() -> bool:
+    # resets VmHWM of the process, available since Linux 4.0
+    try:
+        with open("/proc/self/clear_refs", "w") as file:
+            file.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _get_peak_rss() -> int:
+    try:
+        with open("/proc/self/status") as file:
+            for line in file:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _start_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+        tracemalloc.reset_peak()
+
+
+def _stop_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+
+@contextmanager
+def profile_stage(backup_id: str, stage: str, report_dir: Optional[str]):
+    """
+    Profiles a stage of a backup with cProfile and tracemalloc and writes the
+    reports to report_dir. Does nothing if report_dir is None.
+
+    tracemalloc and the peak RSS cover the whole process, so the memory figures
+    include concurrent backups.
+    """
+    if not report_dir:
+        yield
+        return
+
+    os.makedirs(report_dir, exist_ok=True)
+    profiler = None
+    if _cprofile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+    else:
+        logger.warning(
+            f"[{backup_id}] Another stage is being profiled, skipping cProfile for {stage}"
+        )
+    peak_rss_reset = _reset_peak_rss()
+    _start_tracemalloc()
+    error = None
+    try:
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if profiler:
+                profiler.disable()
+                _cprofile_lock.release()
+            snapshot = tracemalloc.take_snapshot()
+            _current, peak_traced = tracemalloc.get_traced_memory()
+    finally:
+        _stop_tracemalloc()
+        # also for a failed stage, without hiding its error
+        try:
+            _write_report(
+                backup_id,
+                stage,
+                report_dir,
+                profiler,
+                snapshot,
+                peak_traced,
+                peak_rss_reset,
+                error,
+            )
+        except Exception as e:
+            logger.warning(f"[{backup_id}] Failed to write the {stage} profile: {e}")
+
+
+def _write_report(
+    backup_id: str,
+    stage: str,
+    report_dir: str,
+    profiler: Optional[cProfile.Profile],
+    snapshot: tracemalloc.Snapshot,
+    peak_traced: int,
+    peak_rss_reset: bool,
+    error: Optional[BaseException],
+):
+    peak_rss = _get_peak_rss()
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    report_path = os.path.join(report_dir, f"{stage}.txt")
+    with open(report_path, "w") as report:
+        report.write(f"Backup: {backup_id}\nStage: {stage}\n")
+        if error is not None:
+            report.write(f"Failed: {error!r}\n")
+        report.write(
+            f"\nPeak RSS: {format_bytes(peak_rss)}"
+            f"{'' if peak_rss_reset else ' (since process start)'}\n"
+            f"Peak RSS of subprocesses: {format_bytes(children_rss)}\n"
+            f"Peak traced Python memory: {format_bytes(peak_traced)}\n\n"
+        )
+        report.write(f"Top {TOP_ALLOCATIONS} allocations still alive:\n")
+        for statistic in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+            report.write(f"  {statistic}\n")
+        if profiler:
+            profiler.dump_stats(os.path.join(report_dir, f"{stage}.prof"))
+            stats_output = io.StringIO()
+            stats = pstats.Stats(profiler, stream=stats_output)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_FUNCTIONS)
+            report.write(f"\n{stats_output.getvalue()}")
+    logger.info(
+        f"[{backup_id}] {stage} profile{' (failed stage)' if error else ''}:"
+        f" peak RSS {format_bytes(peak_rss)},"
+        f" peak traced {format_bytes(peak_traced)}, report: {report_path}"
+    )
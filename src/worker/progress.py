@@ -0,0 +1,133 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from worker.utils import format_bytes
+
+# minimum number of seconds between two progress log lines of a stage
+LOG_INTERVAL_SECONDS = 30
+
+_trackers: Dict[str, "ProgressTracker"] = {}
+_trackers_lock = threading.Lock()
+
+
+def set_log_interval(seconds: int):
+    global LOG_INTERVAL_SECONDS
+    LOG_INTERVAL_SECONDS = seconds
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class ProgressTracker:
+    """
+    Tracks the bytes processed by a stage of a running backup.
+
+    update() is called for every chunk, so it only adds to a counter and
+    compares the clock against the next log time, under a lock since the
+    threads dumping several databases share one tracker.
+    """
+
+    def __init__(self, backup_id: str, stage: str, total_bytes: Optional[int] = None):
+        self.backup_id = backup_id
+        self.stage = stage
+        self.total_bytes = total_bytes
+        self.bytes_done = 0
+        self.start_time = time.monotonic()
+        self._last_log_time = self.start_time
+        self._last_log_bytes = 0
+        self._next_log_time = self.start_time + LOG_INTERVAL_SECONDS
+        self._lock = threading.Lock()
+
+    def update(self, size: int):
+        """
+        Adds the size of a processed chunk.
+        """
+        with self._lock:
+            self.bytes_done += size
+            if time.monotonic() >= self._next_log_time:
+                self._log()
+
+    def set_bytes_done(self, bytes_done: int):
+        """
+        Sets the total of processed bytes, for callbacks that report a running total.
+        """
+        with self._lock:
+            self.bytes_done = bytes_done
+            if time.monotonic() >= self._next_log_time:
+                self._log()
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start_time
+
+    @property
+    def rate(self) -> float:
+        """
+        Average rate since the start of the stage, in bytes per second.
+        """
+        elapsed = self.elapsed
+        return self.bytes_done / elapsed if elapsed > 0 else 0
+
+    @property
+    def eta(self) -> Optional[float]:
+        if not self.total_bytes or not self.rate:
+            return None
+        return max(self.total_bytes - self.bytes_done, 0) / self.rate
+
+    def _log(self):
+        now = time.monotonic()
+        current_rate = (self.bytes_done - self._last_log_bytes) / (
+            now - self._last_log_time
+        )
+        self._last_log_time = now
+        self._last_log_bytes = self.bytes_done
+        self._next_log_time = now + LOG_INTERVAL_SECONDS
+
+        message = f"[{self.backup_id}] {self.stage}: {format_bytes(self.bytes_done)}"
+        if self.total_bytes:
+            percent = min(self.bytes_done / self.total_bytes, 1)
+            message += f" / ~{format_bytes(self.total_bytes)} ({percent:.0%})"
+        message += f", {format_bytes(current_rate)}/s"
+        if self.eta is not None:
+            message += f", ETA {format_duration(self.eta)}"
+        logger.info(message)
+
+    def to_dict(self) -> dict:
+        return {
+            "backup_id": self.backup_id,
+            "stage": self.stage,
+            "bytes_done": self.bytes_done,
+            "total_bytes": self.total_bytes,
+            "elapsed": self.elapsed,
+            "rate": self.rate,
+            "eta": self.eta,
+        }
+
+
+@contextmanager
+def track_progress(backup_id: str, stage: str, total_bytes: Optional[int] = None):
+    """
+    Registers a tracker for the running stage of a backup, so that it is
+    visible in get_status() until the stage ends.
+    """
+    tracker = ProgressTracker(backup_id, stage, total_bytes)
+    with _trackers_lock:
+        _trackers[backup_id] = tracker
+    try:
+        yield tracker
+    finally:
+        with _trackers_lock:
+            if _trackers.get(backup_id) is tracker:
+                del _trackers[backup_id]
+
+
+def get_status() -> List[dict]:
+    with _trackers_lock:
+        trackers = list(_trackers.values())
+    return [tracker.to_dict() for tracker in trackers]
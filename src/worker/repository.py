@@ -0,0 +1,767 @@
+"""
+Deduplicated backup repository.
+
+Instead of one compressed and encrypted file per run, the dump is split into
+content-defined chunks and only the chunks that are not in the repository yet
+are compressed, encrypted and uploaded. Layout, in the path of the backup:
+
+    repo/config.json          options of the repository, fixed at its creation
+    repo/index                stored size and reference count of each chunk
+    repo/chunks/<id>          a chunk, compressed then encrypted
+    repo/recipes/<name>       the chunk ids of a dump in order, and its manifest
+    repo/dictionaries/        zstd dictionaries, see worker/dictionary.py
+
+Chunk ids are the SHA-256 of the chunks, or their HMAC-SHA256 in an encrypted
+repository so that they do not reveal the content. Retention deletes recipes
+and garbage collects the chunks that are no longer referenced.
+
+A repository has a single writer: a run holds repo/lock, naming its owner, while
+it stores a dump and garbage collects the chunks. A lock older than
+LOCK_STALE_SECONDS is left by a run that died and is taken over. The transfer
+protocols cannot create a file exclusively, so the lock is read back after it
+is written, and the garbage collection also reads the index and the recipes
+again before deleting chunks.
+"""
+
+import hashlib
+import hmac
+import io
+import json
+import os
+import socket
+import struct
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List
+from zlib import crc32
+
+from loguru import logger
+
+from config import Backup
+from worker.compression import CODECS, DEFAULT_CODEC, compress_bytes, decompress_bytes
+from worker.dictionary import DICTIONARY_DIR, DictionaryStore, get_dictionary_key
+from worker.file import get_backup_files
+from worker.transfer_client.base import is_not_found_error
+from worker.utils import map_ordered
+
+REPOSITORY_DIR = "repo"
+CONFIG_FILENAME = "config.json"
+INDEX_FILENAME = "index"
+LOCK_FILENAME = "lock"
+# a lock not refreshed for this long was left by a run that died
+LOCK_STALE_SECONDS = 6 * 3600
+CHUNKS_DIR = "chunks"
+RECIPES_DIR = "recipes"
+RECIPE_SUFFIX = ".recipe"
+REPOSITORY_VERSION = 1
+
+READ_SIZE = 4 * 1024 * 1024
+MIN_CHUNK_SIZE = 256 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# a chunk ends after a record whose CRC-32 has these bits unset: one record in 1024
+CUT_MASK = 0x3FF
+# extended INSERT statements of mysqldump: INSERT INTO `t` VALUES (...),(...);
+INSERT_START = b"INSERT INTO "
+INSERT_VALUES = b" VALUES ("
+INSERT_END = b");"
+ROW_SEPARATOR = b"),("
+# table names in the INSERT prefixes saved in the recipes
+PREFIX_ENCODING = "utf-8"
+# chunks compressed and encrypted at the same time (the codecs release the GIL)
+PACK_WORKERS = min(os.cpu_count() or 1, 4)
+
+INDEX_MAGIC = b"DBKIDX\x00\x01"
+INDEX_HEADER_LENGTH = struct.Struct(">I")
+# chunk id, stored size, reference count
+INDEX_ENTRY = struct.Struct(">32sII")
+# encrypted in the configuration to detect a wrong password before writing
+KEY_CHECK = b"dbackup repository"
+
+
+class Chunker:
+    """
+    Splits a dump into content-defined chunks.
+
+    Chunks end on a record boundary, a line or a row of an extended INSERT,
+    after the first record whose CRC-32 matches CUT_MASK once the chunk is
+    MIN_CHUNK_SIZE long, or after MAX_CHUNK_SIZE.
+
+    mysqldump wraps the INSERT statements of a table by size, so one row added
+    or resized moves all the following wraps. Consecutive INSERT lines of a
+    table are joined into a single statement in the chunks, and the positions
+    of the wraps are returned with each chunk to be restored by unwrap().
+    Chunks then only depend on the rows: an updated row changes the chunk
+    around it only.
+    """
+
+    def __init__(self):
+        self._chunk = bytearray()
+        self._wraps = []
+        self._chunks = []
+        self._rest = b""
+        # prefix of the INSERT line whose end is pending, and its last row
+        self._prefix = None
+        self._last_row = b""
+
+    def update(self, data: bytes) -> list:
+        """
+        Adds data to the stream.
+
+        :return: The (chunk, wraps) completed by the data, wraps being the list of
+            the (offset, INSERT prefix) of the joined lines in the chunk.
+        """
+        data = self._rest + data
+        end = data.rfind(b"\n") + 1
+        self._rest = data[end:]
+        for line in data[:end].split(b"\n")[:-1]:
+            self._add_line(line)
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+    def finish(self) -> list:
+        """
+        Ends the stream and returns its last (chunk, wraps).
+        """
+        if self._prefix is not None:
+            self._chunk += INSERT_END + b"\n"
+            self._prefix = None
+        self._chunk += self._rest
+        self._rest = b""
+        if self._chunk:
+            self._cut()
+        chunks, self._chunks = self._chunks, []
+        return chunks
+
+    def _cut(self):
+        self._chunks.append((bytes(self._chunk), self._wraps))
+        self._chunk.clear()
+        self._wraps = []
+
+    def _end_record(self, record: bytes):
+        size = len(self._chunk)
+        if size >= MIN_CHUNK_SIZE and (
+            size >= MAX_CHUNK_SIZE or not crc32(record) & CUT_MASK
+        ):
+            self._cut()
+
+    def _add_line(self, line: bytes):
+        prefix = None
+        if line.startswith(INSERT_START) and line.endswith(INSERT_END):
+            values = line.find(INSERT_VALUES)
+            if values > 0:
+                prefix = line[: values + len(INSERT_VALUES)]
+
+        start = 0
+        if self._prefix is not None:
+            if prefix == self._prefix:
+                # the statement goes on, join the lines
+                self._wraps.append((len(self._chunk), prefix))
+                self._chunk += ROW_SEPARATOR
+                start = len(prefix)
+            else:
+                self._chunk += INSERT_END + b"\n"
+            self._end_record(self._last_row)
+        self._prefix = prefix
+
+        if prefix is None:
+            self._chunk += line
+            self._chunk += b"\n"
+            self._end_record(line)
+            return
+
+        # the end of the statement is added with the next line
+        body = line[start : -len(INSERT_END)]
+        if len(self._chunk) + len(body) < MIN_CHUNK_SIZE:
+            # no cut point in this line
+            self._chunk += body
+            self._last_row = body.rsplit(ROW_SEPARATOR, 1)[-1]
+            return
+        rows = body.split(ROW_SEPARATOR)
+        position = cut = 0
+        for row in rows[:-1]:
+            position += len(row) + len(ROW_SEPARATOR)
+            size = len(self._chunk) + position - cut
+            if size >= MIN_CHUNK_SIZE and (
+                size >= MAX_CHUNK_SIZE or not crc32(row) & CUT_MASK
+            ):
+                self._chunk += body[cut:position]
+                self._cut()
+                cut = position
+        self._chunk += body[cut:]
+        self._last_row = rows[-1]
+
+
+def unwrap(chunk: bytes, wraps) -> bytes:
+    """
+    Restores the INSERT lines joined by the Chunker in a chunk.
+    """
+    if not wraps:
+        return chunk
+    parts = []
+    position = 0
+    for offset, prefix in wraps:
+        parts += [chunk[position:offset], INSERT_END, b"\n", prefix]
+        position = offset + len(ROW_SEPARATOR)
+    parts.append(chunk[position:])
+    return b"".join(parts)
+
+
+class ChunkIndex:
+    """
+    Stored size and reference count of the chunks of a repository, and the
+    recipes whose references are counted.
+
+    Format: INDEX_MAGIC, the length of a JSON list of the recipes and the list,
+    then one INDEX_ENTRY per chunk.
+    """
+
+    def __init__(self):
+        self.chunks: Dict[bytes, list] = {}
+        self.recipes: List[str] = []
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ChunkIndex":
+        if not data.startswith(INDEX_MAGIC):
+            raise ValueError("Invalid chunk index")
+        index = cls()
+        offset = len(INDEX_MAGIC)
+        (length,) = INDEX_HEADER_LENGTH.unpack_from(data, offset)
+        offset += INDEX_HEADER_LENGTH.size
+        index.recipes = json.loads(data[offset : offset + length])
+        for chunk_id, size, references in INDEX_ENTRY.iter_unpack(
+            data[offset + length :]
+        ):
+            index.chunks[chunk_id] = [size, references]
+        return index
+
+    def to_bytes(self) -> bytes:
+        header = json.dumps(self.recipes).encode()
+        return b"".join(
+            [INDEX_MAGIC, INDEX_HEADER_LENGTH.pack(len(header)), header]
+            + [
+                INDEX_ENTRY.pack(chunk_id, size, references)
+                for chunk_id, (size, references) in self.chunks.items()
+            ]
+        )
+
+    def add_references(self, recipe: str, chunk_ids):
+        for chunk_id in set(chunk_ids):
+            # chunks of a recipe the index missed, their size is unknown
+            self.chunks.setdefault(chunk_id, [0, 0])[1] += 1
+        self.recipes.append(recipe)
+
+    def remove_references(self, recipe: str, chunk_ids) -> List[bytes]:
+        """
+        Removes the references of a recipe and returns the chunks left without
+        any reference, which are removed from the index.
+        """
+        unreferenced = []
+        for chunk_id in set(chunk_ids):
+            entry = self.chunks.get(chunk_id)
+            if entry is None:
+                continue
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del self.chunks[chunk_id]
+                unreferenced.append(chunk_id)
+        self.recipes.remove(recipe)
+        return unreferenced
+
+
+def get_recipe_name(backup_filename: str) -> str:
+    return backup_filename + RECIPE_SUFFIX
+
+
+class Repository:
+    """
+    A deduplicated repository in the path of a backup, accessed through a
+    connected TransferClient.
+    """
+
+    def __init__(self, client, backup: Backup):
+        self.client = client
+        self.backup = backup
+        self.path = os.path.join(backup.path, REPOSITORY_DIR)
+        self.chunks_path = os.path.join(self.path, CHUNKS_DIR)
+        self.recipes_path = os.path.join(self.path, RECIPES_DIR)
+        self.compression = None
+        self.compression_level = None
+        self.fernet = None
+        self.id_key = None
+        self.dictionaries = None
+        # zstd dictionary of the chunks stored by this run
+        self.dictionary = None
+        self.index = ChunkIndex()
+        self.bytes_read = 0
+        # owner written in the lock held by this run
+        self.lock_owner = None
+
+    def _read(self, remote_path: str) -> bytes:
+        with self.client.open_file(remote_path) as file:
+            data = file.read()
+        self.bytes_read += len(data)
+        return data
+
+    def _write(self, remote_path: str, data: bytes):
+        self.client.upload_fileobj(io.BytesIO(data), remote_path)
+
+    def _list(self, remote_path: str) -> List[str]:
+        # any other error must not look like an empty repository: it would be
+        # created again with a new salt, or have all its chunks collected
+        try:
+            return self.client.list_files(remote_path) or []
+        except Exception as e:
+            if is_not_found_error(e):
+                return []
+            raise
+
+    def _read_lock(self) -> dict:
+        if LOCK_FILENAME not in self._list(self.path):
+            return None
+        try:
+            return json.loads(self._read(os.path.join(self.path, LOCK_FILENAME)))
+        except Exception as e:
+            if is_not_found_error(e):
+                return None
+            raise
+
+    def _write_lock(self):
+        self._write(
+            os.path.join(self.path, LOCK_FILENAME),
+            json.dumps(
+                {
+                    "owner": self.lock_owner,
+                    "backup_id": self.backup.id,
+                    "time": datetime.now().timestamp(),
+                }
+            ).encode(),
+        )
+
+    @contextmanager
+    def lock(self):
+        """
+        Holds the lock of the repository, created if needed.
+
+        :raise RuntimeError: If another run holds it.
+        """
+        self.client.mkdir(self.backup.path)
+        self.client.mkdir(self.path)
+        lock = self._read_lock()
+        if lock and datetime.now().timestamp() - lock["time"] < LOCK_STALE_SECONDS:
+            raise RuntimeError(
+                f"The repository in {self.path} is locked by {lock['owner']}"
+                f" (backup {lock['backup_id']})"
+            )
+        if lock:
+            logger.warning(
+                f"[{self.backup.id}] Taking over the stale lock of {lock['owner']}"
+                f" in {self.path}"
+            )
+        self.lock_owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._write_lock()
+        lock = self._read_lock()
+        if not lock or lock["owner"] != self.lock_owner:
+            raise RuntimeError(
+                f"The repository in {self.path} was locked by"
+                f" {lock['owner'] if lock else 'another run'} at the same time"
+            )
+        try:
+            yield
+        finally:
+            try:
+                lock = self._read_lock()
+                if lock and lock["owner"] == self.lock_owner:
+                    self.client.delete_file(os.path.join(self.path, LOCK_FILENAME))
+            except Exception as e:
+                logger.warning(
+                    f"[{self.backup.id}] Failed to release the lock of {self.path}: {e}"
+                )
+            self.lock_owner = None
+
+    def _check_lock(self):
+        """
+        Refreshes the lock before a change, and checks that it is still held.
+        """
+        lock = self._read_lock()
+        if not lock or lock["owner"] != self.lock_owner:
+            raise RuntimeError(f"The lock of the repository in {self.path} was lost")
+        self._write_lock()
+
+    def open(self, create=False):
+        """
+        Loads the configuration and the chunk index of the repository.
+
+        :param create: Create the repository if it does not exist, with the
+            compression and encryption options of the backup.
+        """
+        if CONFIG_FILENAME in self._list(self.path):
+            config = json.loads(self._read(os.path.join(self.path, CONFIG_FILENAME)))
+            if config["version"] > REPOSITORY_VERSION:
+                raise ValueError(
+                    f"Unsupported repository version {config['version']} in {self.path}"
+                )
+        elif create:
+            config = self._create()
+        else:
+            raise FileNotFoundError(f"No repository found in {self.path}")
+
+        self.compression = config["compression"]
+        self.compression_level = config.get("compression_level")
+        if config["encryption"]:
+            from cryptography.fernet import InvalidToken
+
+            from worker.security import decrypt_bytes, get_repository_keys
+
+            if not self.backup.encryption_password:
+                raise ValueError(f"The repository in {self.path} is encrypted")
+            self.fernet, self.id_key = get_repository_keys(
+                self.backup.encryption_password,
+                bytes.fromhex(config["encryption"]["salt"]),
+            )
+            try:
+                decrypt_bytes(self.fernet, bytes.fromhex(config["encryption"]["check"]))
+            except InvalidToken:
+                raise ValueError(f"Wrong password for the repository in {self.path}")
+        if (config["compression"] is not None) != bool(
+            self.backup.compression_enabled
+        ) or bool(config["encryption"]) != bool(self.backup.encryption_enabled):
+            logger.warning(
+                f"[{self.backup.id}] The repository keeps the compression and"
+                " encryption options it was created with"
+            )
+
+        self.dictionaries = DictionaryStore(
+            self.client, os.path.join(self.path, DICTIONARY_DIR), fernet=self.fernet
+        )
+
+        self._load_index()
+
+    def _load_index(self):
+        self.index = ChunkIndex()
+        if INDEX_FILENAME in self._list(self.path):
+            self.index = ChunkIndex.from_bytes(
+                self._read(os.path.join(self.path, INDEX_FILENAME))
+            )
+        self._sync_index()
+
+    def _create(self) -> dict:
+        logger.info(f"[{self.backup.id}] Creating a repository in {self.path}")
+        encryption = None
+        if self.backup.encryption_enabled:
+            from worker.security import (
+                ITERATIONS,
+                SALT_SIZE,
+                encrypt_bytes,
+                get_repository_keys,
+            )
+
+            salt = os.urandom(SALT_SIZE)
+            fernet, _id_key = get_repository_keys(self.backup.encryption_password, salt)
+            encryption = {
+                "cipher": "fernet",
+                "kdf": "pbkdf2-sha256",
+                "iterations": ITERATIONS,
+                "salt": salt.hex(),
+                "check": encrypt_bytes(fernet, KEY_CHECK).hex(),
+            }
+        codec = level = None
+        if self.backup.compression_enabled:
+            codec = self.backup.compression_codec.value
+            level = self.backup.compression_level
+            if codec == "auto":
+                # chunks are compressed one by one, the codec is not picked per run
+                codec, level = DEFAULT_CODEC, None
+        config = {
+            "version": REPOSITORY_VERSION,
+            "chunker": {
+                "min_size": MIN_CHUNK_SIZE,
+                "max_size": MAX_CHUNK_SIZE,
+                "mask": CUT_MASK,
+            },
+            "compression": codec,
+            "compression_level": level,
+            "encryption": encryption,
+        }
+        for path in (self.backup.path, self.path, self.chunks_path, self.recipes_path):
+            self.client.mkdir(path)
+        self._write(
+            os.path.join(self.path, CONFIG_FILENAME),
+            json.dumps(config, indent=2).encode(),
+        )
+        return config
+
+    def _sync_index(self):
+        """
+        Accounts for the recipes uploaded or deleted by a run that stopped
+        before saving the index.
+        """
+        recipes = {
+            name
+            for name in self._list(self.recipes_path)
+            if name.endswith(RECIPE_SUFFIX)
+        }
+        for name in sorted(recipes - set(self.index.recipes)):
+            logger.warning(f"[{self.backup.id}] Adding {name} to the chunk index")
+            self.index.add_references(name, self.read_recipe(name)["chunk_ids"])
+        for name in sorted(set(self.index.recipes) - recipes):
+            logger.warning(
+                f"[{self.backup.id}] {name} is missing, its chunks will not be"
+                " garbage collected"
+            )
+            self.index.recipes.remove(name)
+
+    def save_index(self):
+        self._write(os.path.join(self.path, INDEX_FILENAME), self.index.to_bytes())
+
+    def _chunk_id(self, chunk: bytes) -> bytes:
+        if self.id_key:
+            return hmac.new(self.id_key, chunk, hashlib.sha256).digest()
+        return hashlib.sha256(chunk).digest()
+
+    def _pack(self, data: bytes) -> bytes:
+        if self.compression:
+            data = compress_bytes(
+                data, self.compression, self.compression_level, self.dictionary
+            )
+        if self.fernet:
+            from worker.security import encrypt_bytes
+
+            data = encrypt_bytes(self.fernet, data)
+        return data
+
+    def _unpack(self, data: bytes) -> bytes:
+        if self.fernet:
+            from worker.security import decrypt_bytes
+
+            data = decrypt_bytes(self.fernet, data)
+        if self.compression:
+            data = decompress_bytes(data, self.compression, self.dictionaries.get)
+        return data
+
+    def store(self, dump_file: str, recipe_name: str, info: dict, progress=None):
+        """
+        Stores a dump: uploads its new chunks, then its recipe, then the index.
+        Requires the lock.
+
+        :param dump_file: The path of the dump.
+        :param recipe_name: The name of the recipe of the dump.
+        :param info: Manifest fields saved in the recipe.
+        :param progress: Optional ProgressTracker updated with the bytes read.
+        :return: The statistics of the dump: chunks, new_chunks, size (stored
+            size of its chunks), uploaded_bytes, recipe_size, recipe_sha256 and
+            dictionary (the zstd dictionary of the new chunks).
+        """
+        self._check_lock()
+        dictionary_name = None
+        if self.compression == "zstd" and self.backup.compression_dictionary:
+            dictionary_name, self.dictionary = self.dictionaries.get_latest(
+                get_dictionary_key(self.backup),
+                dump_file,
+                self.compression_level or CODECS["zstd"][1],
+                self.backup.dictionary_max_age_days,
+            )
+        chunk_ids = []
+        new_chunk_ids = set()
+        # wraps of the chunks by position in the recipe
+        wraps = {}
+
+        def new_chunks():
+            chunker = Chunker()
+            with open(dump_file, "rb") as file:
+                while data := file.read(READ_SIZE):
+                    chunks = chunker.update(data)
+                    if progress:
+                        progress.update(len(data))
+                    yield from chunks
+            yield from chunker.finish()
+
+        def unique_chunks():
+            for chunk, chunk_wraps in new_chunks():
+                chunk_id = self._chunk_id(chunk)
+                if chunk_wraps:
+                    wraps[str(len(chunk_ids))] = [
+                        [offset, prefix.decode(PREFIX_ENCODING, "surrogateescape")]
+                        for offset, prefix in chunk_wraps
+                    ]
+                chunk_ids.append(chunk_id)
+                if chunk_id not in self.index.chunks and chunk_id not in new_chunk_ids:
+                    new_chunk_ids.add(chunk_id)
+                    yield chunk_id, chunk
+
+        def pack(item):
+            chunk_id, chunk = item
+            return chunk_id, self._pack(chunk)
+
+        uploaded_bytes = 0
+        for chunk_id, data in map_ordered(pack, unique_chunks(), PACK_WORKERS):
+            self._write(os.path.join(self.chunks_path, chunk_id.hex()), data)
+            self.index.chunks[chunk_id] = [len(data), 0]
+            uploaded_bytes += len(data)
+
+        recipe = dict(info, version=REPOSITORY_VERSION)
+        recipe["chunk_ids"] = [chunk_id.hex() for chunk_id in chunk_ids]
+        recipe["wraps"] = wraps
+        recipe["dictionary"] = dictionary_name
+        data = json.dumps(recipe).encode()
+        if self.fernet:
+            from worker.security import encrypt_bytes
+
+            data = encrypt_bytes(self.fernet, data)
+        self._check_lock()
+        self._write(os.path.join(self.recipes_path, recipe_name), data)
+
+        self.index.add_references(recipe_name, chunk_ids)
+        self.save_index()
+        return {
+            "chunks": len(chunk_ids),
+            "new_chunks": len(new_chunk_ids),
+            "size": sum(self.index.chunks[chunk_id][0] for chunk_id in set(chunk_ids)),
+            "uploaded_bytes": uploaded_bytes,
+            "recipe_size": len(data),
+            "recipe_sha256": hashlib.sha256(data).hexdigest(),
+            "dictionary": dictionary_name,
+        }
+
+    def list_recipes(self, prefix: str, date_format: str) -> List[str]:
+        """
+        Returns the recipes of the backups with the given file prefix, oldest first.
+        """
+        return get_backup_files(
+            [
+                name
+                for name in self._list(self.recipes_path)
+                if name.endswith(RECIPE_SUFFIX)
+            ],
+            prefix,
+            date_format,
+        )
+
+    def read_recipe(self, name: str) -> dict:
+        """
+        Downloads a recipe, with its chunk ids as bytes and its wraps as a list of
+        the (offset, INSERT prefix) of each chunk.
+        """
+        data = self._read(os.path.join(self.recipes_path, name))
+        if self.fernet:
+            from worker.security import decrypt_bytes
+
+            data = decrypt_bytes(self.fernet, data)
+        recipe = json.loads(data)
+        recipe["chunk_ids"] = [
+            bytes.fromhex(chunk_id) for chunk_id in recipe["chunk_ids"]
+        ]
+        wraps = recipe.get("wraps", {})
+        recipe["wraps"] = [
+            [
+                (offset, prefix.encode(PREFIX_ENCODING, "surrogateescape"))
+                for offset, prefix in wraps.get(str(position), [])
+            ]
+            for position in range(len(recipe["chunk_ids"]))
+        ]
+        return recipe
+
+    def iter_chunks(self, recipe: dict, workers: int = 1, progress=None):
+        """
+        Downloads the chunks of a recipe and yields their content in order, with
+        up to workers chunks decrypted and decompressed at the same time.
+        """
+
+        def download():
+            for chunk_id, wraps in zip(recipe["chunk_ids"], recipe["wraps"]):
+                data = self._read(os.path.join(self.chunks_path, chunk_id.hex()))
+                if progress:
+                    progress.update(len(data))
+                yield chunk_id, wraps, data
+
+        def unpack(item):
+            chunk_id, wraps, data = item
+            chunk = self._unpack(data)
+            if self._chunk_id(chunk) != chunk_id:
+                raise ValueError(f"Chunk {chunk_id.hex()} is corrupted")
+            return unwrap(chunk, wraps)
+
+        if self.compression == "zstd":
+            # the client is not used by the threads decompressing the chunks
+            self.dictionaries.load_all()
+        yield from map_ordered(unpack, download(), workers)
+
+    def verify(self, name: str, download=False) -> List[str]:
+        """
+        Checks that the chunks of a recipe exist, and with download that their
+        content matches their id.
+
+        :return: The list of errors.
+        """
+        try:
+            recipe = self.read_recipe(name)
+        except Exception as e:
+            return [f"cannot read the recipe: {e}"]
+        stored = set(self._list(self.chunks_path))
+        missing = [
+            chunk_id
+            for chunk_id in set(recipe["chunk_ids"])
+            if chunk_id.hex() not in stored
+        ]
+        if missing:
+            return [f"{len(missing)} missing chunk(s)"]
+        if download:
+            size = 0
+            try:
+                for chunk in self.iter_chunks(recipe, PACK_WORKERS):
+                    size += len(chunk)
+            except Exception as e:
+                return [str(e)]
+            if size != recipe["size"]:
+                return [f"size {size} instead of {recipe['size']}"]
+        return []
+
+    def remove_old_recipes(
+        self, prefix: str, date_format: str, max_backup_files: int
+    ) -> List[str]:
+        """
+        Deletes the oldest recipes over max_backup_files, then the chunks that no
+        recipe references anymore. Requires the lock.
+
+        The index is saved before deleting anything, so a run stopping halfway
+        leaves recipes that the next one adds back, or unreferenced chunks that
+        the next garbage collection deletes.
+
+        :return: The deleted recipes.
+        """
+        self._check_lock()
+        recipes = self.list_recipes(prefix, date_format)
+        to_delete = []
+        if len(recipes) > max_backup_files:
+            to_delete = recipes[:-max_backup_files]
+        for name in to_delete:
+            self.index.remove_references(name, self.read_recipe(name)["chunk_ids"])
+        if to_delete:
+            self.save_index()
+        for name in to_delete:
+            logger.info(f"[{self.backup.id}] Deleting {name}")
+            self.client.delete_file(os.path.join(self.recipes_path, name))
+
+        # the chunks referenced by the index and the recipes as they are now
+        # stored, not as this run loaded them
+        self._load_index()
+        deleted_chunks = 0
+        for name in self._list(self.chunks_path):
+            try:
+                chunk_id = bytes.fromhex(name)
+            except ValueError:
+                continue
+            if chunk_id not in self.index.chunks:
+                self.client.delete_file(os.path.join(self.chunks_path, name))
+                deleted_chunks += 1
+        if deleted_chunks:
+            logger.info(
+                f"[{self.backup.id}] Deleted {deleted_chunks} unreferenced chunk(s)"
+            )
+        return to_delete
+
+
+def open_repository(client, backup: Backup, create=False) -> Repository:
+    repository = Repository(client, backup)
+    repository.open(create)
+    return repository
@@ -0,0 +1,290 @@
+import os
+import time
+from contextlib import ExitStack
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from config import Backup, DBConnection
+from worker.archive import iter_members
+from worker.compression import decompress_chunks, get_codec_from_filename
+from worker.dictionary import get_dictionary_store
+from worker.engines import get_engine
+from worker.file import (
+    MeteredFile,
+    get_backup_file_prefix,
+    get_backup_files,
+    is_archive_file,
+)
+from worker.lifecycle import connect_tier, get_tiers
+from worker.manifest import read_manifest
+from worker.progress import format_duration, track_progress
+from worker.utils import format_bytes
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def list_backup_files(backup: Backup, client) -> List[str]:
+    """
+    Returns the backup files of a backup on its destination, oldest first: the
+    recipes of a repository backup.
+    """
+    prefix = get_backup_file_prefix(backup.id, backup.filename)
+    if backup.repository:
+        from worker.repository import Repository
+
+        return Repository(client, backup).list_recipes(prefix, backup.date_format)
+    return get_backup_files(client.list_files(backup.path), prefix, backup.date_format)
+
+
+def _read_chunks(file):
+    while chunk := file.read(CHUNK_SIZE):
+        yield chunk
+
+
+def _load_dictionary(client, backup: Backup, filename: str, dictionaries):
+    """
+    Downloads the zstd dictionary referenced by the manifest of a backup file, if
+    any. Without a manifest, the dictionary is downloaded when the data needs it.
+    """
+    try:
+        manifest = read_manifest(client, os.path.join(backup.path, filename))
+    except Exception as e:
+        logger.debug(f"[{backup.id}] Cannot read the manifest of {filename}: {e}")
+        return
+    if manifest.get("dictionary"):
+        dictionaries.load(manifest["dictionary"])
+
+
+def find_backup_file(client, backup: Backup, engine, filename: str = None) -> str:
+    """
+    Returns filename, or the latest backup file of a backup made by its engine,
+    checking that it is one.
+    """
+    if not filename:
+        files = [
+            file
+            for file in list_backup_files(backup, client)
+            if engine.extension in file
+        ]
+        if not files:
+            raise FileNotFoundError(
+                f"No {engine.name} backup file found in {backup.path}"
+            )
+        filename = files[-1]
+    if engine.extension not in filename:
+        raise ValueError(f"{filename} is not a {engine.name} backup")
+    return filename
+
+
+def connect_backup_file(backup: Backup, engine, filename: str = None):
+    """
+    Looks for filename, or the latest backup file of a backup made by its engine,
+    on the tiers of the backup, the newest first (see worker/lifecycle.py).
+
+    :return: The backup as stored on the tier holding the file, a client
+        connected to this tier, and the file name.
+    """
+    tiers = get_tiers(backup)
+    for index, tier in enumerate(tiers):
+        client = connect_tier(tier)
+        try:
+            # the last tier reports the missing file
+            if index < len(tiers) - 1:
+                files = list_backup_files(tier, client)
+                if filename:
+                    found = filename in files
+                else:
+                    found = any(engine.extension in file for file in files)
+                if not found:
+                    client.disconnect()
+                    continue
+            return tier, client, find_backup_file(client, tier, engine, filename)
+        except BaseException:
+            client.disconnect()
+            raise
+
+
+def open_backup_chunks(
+    client, backup: Backup, filename: str, parallel: int, progress, stack: ExitStack
+):
+    """
+    Opens a backup file, or the chunks of a repository recipe, as a stream of
+    decrypted and decompressed chunks.
+
+    :param stack: Closes the remote file once the chunks were read.
+    :return: The reader counting the downloaded bytes (bytes_read) and the chunks.
+    """
+    if backup.repository:
+        from worker.repository import open_repository
+
+        # counts the downloaded bytes like MeteredFile
+        reader = open_repository(client, backup)
+        return reader, reader.iter_chunks(
+            reader.read_recipe(filename), parallel, progress
+        )
+
+    codec = get_codec_from_filename(filename)
+    dictionaries = get_dictionary_store(client, backup)
+    if codec == "zstd":
+        # before the download, FTP cannot open a second file meanwhile
+        _load_dictionary(client, backup, filename, dictionaries)
+    remote_file = stack.enter_context(
+        client.open_file(os.path.join(backup.path, filename))
+    )
+    reader = MeteredFile(remote_file, progress=progress)
+    if filename.endswith(".enc"):
+        from worker.security import decrypt_stream
+
+        chunks = decrypt_stream(reader, backup.encryption_password, parallel)
+    else:
+        chunks = _read_chunks(reader)
+    if codec:
+        chunks = decompress_chunks(chunks, codec, dictionaries.get)
+    return reader, chunks
+
+
+def _restore_archive(
+    backup: Backup,
+    engine,
+    chunks,
+    db_connection: DBConnection,
+    parallel: int,
+    databases: List[str] = None,
+    prefix: str = "",
+) -> Dict[str, str]:
+    """
+    Restores the databases of a backup file of several databases, one after the
+    other, each into prefix + its name.
+
+    :return: The restored databases and the databases they were restored into.
+    """
+    restored = {}
+    for member, member_chunks in iter_members(chunks):
+        if not member.endswith(engine.extension):
+            continue
+        name = member[: -len(engine.extension)]
+        if databases and name not in databases:
+            continue
+        target = prefix + name
+        logger.info(f"[{backup.id}] Restoring '{name}' into '{target}'...")
+        engine.create_database(db_connection, target)
+        engine.restore(member_chunks, db_connection, target, parallel)
+        restored[name] = target
+    missing = set(databases or []) - set(restored)
+    if missing:
+        raise FileNotFoundError(
+            f"No database {', '.join(sorted(missing))} in the backup file"
+        )
+    return restored
+
+
+def restore_backup(
+    backup: Backup,
+    filename: str = None,
+    database: str = None,
+    parallel: int = 1,
+    db_connection: Optional[DBConnection] = None,
+    databases: List[str] = None,
+    prefix: str = "",
+) -> dict:
+    """
+    Restores a backup from its destination. The backup file, or the chunks of a
+    repository recipe, are downloaded, decrypted, decompressed and imported as a
+    stream, without temporary files.
+
+    :param backup: The backup to restore.
+    :param filename: The backup file to restore (default: the latest one).
+    :param database: The database to restore into (default: the backed up one),
+        created if it does not exist.
+    :param parallel: Number of sessions restoring at the same time, and of chunks
+        decrypted in parallel.
+    :param db_connection: The server to restore to (default: the backed up one).
+    :param databases: For a backup file of several databases, the databases to
+        restore (default: all of them), each into its name, created if it does
+        not exist.
+    :param prefix: For a backup file of several databases, prepended to the
+        names of the databases restored into.
+    :return: The statistics of the restore.
+    """
+    db_connection = db_connection or backup.db_connection_obj
+    engine = get_engine(backup)
+
+    tier, client, filename = connect_backup_file(backup, engine, filename)
+    try:
+        if not engine.logical:
+            raise ValueError(
+                f"{filename} is a physical backup, restore it into a directory"
+            )
+        archive = is_archive_file(filename)
+        if archive and database:
+            raise ValueError(
+                f"{filename} holds several databases, select them with databases"
+                " and prefix"
+            )
+        if not archive and (databases or prefix):
+            raise ValueError(f"{filename} holds a single database")
+        if archive:
+            target = f"{prefix}*" if prefix else "their databases"
+        else:
+            database = database or backup.db_connection_obj.database
+            target = f"'{database}'"
+        logger.info(
+            f"[{backup.id}] Restoring {filename} into {target}"
+            f" with {parallel} session(s)..."
+        )
+
+        if not archive and (
+            db_connection is not backup.db_connection_obj
+            or database != backup.db_connection_obj.database
+        ):
+            engine.create_database(db_connection, database)
+
+        start_time = time.monotonic()
+        restored = None
+        with track_progress(backup.id, "restore") as progress, ExitStack() as stack:
+            reader, chunks = open_backup_chunks(
+                client, tier, filename, parallel, progress, stack
+            )
+
+            restored_bytes = 0
+
+            def count(chunks):
+                nonlocal restored_bytes
+                for chunk in chunks:
+                    restored_bytes += len(chunk)
+                    yield chunk
+
+            if archive:
+                restored = _restore_archive(
+                    backup,
+                    engine,
+                    count(chunks),
+                    db_connection,
+                    parallel,
+                    databases,
+                    prefix,
+                )
+                target = f"{len(restored)} database(s)"
+            else:
+                engine.restore(count(chunks), db_connection, database, parallel)
+        duration = time.monotonic() - start_time
+    finally:
+        client.disconnect()
+
+    stats = {
+        "backup_id": backup.id,
+        "file": filename,
+        "database": database,
+        "databases": restored,
+        "downloaded_bytes": reader.bytes_read,
+        "restored_bytes": restored_bytes,
+        "duration": duration,
+        "throughput": restored_bytes / duration if duration > 0 else 0,
+    }
+    logger.success(
+        f"[{backup.id}] Restored {filename} into {target} in"
+        f" {format_duration(duration)}: {format_bytes(reader.bytes_read)} downloaded,"
+        f" {format_bytes(restored_bytes)} of dump at {format_bytes(stats['throughput'])}/s"
+    )
+    return stats
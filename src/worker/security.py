@@ -1,6 +1,8 @@
 import os
 import base64
+import struct
 from loguru import logger
+from worker.utils import map_ordered
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
@@ -12,6 +14,15 @@ KEY_SIZE = 32
 SALT_SIZE = 16
 PASSWORD_ENCODING = "utf-8"
 
+# chunked format: MAGIC + salt, then for each chunk a 4 bytes length followed by the
+# raw (not base64 encoded) Fernet token of CHUNK_HEADER + up to CHUNK_SIZE bytes
+MAGIC = b"DBKENC\x00\x01"
+FORMAT_NAME = "DBKENC/1"  # name of the format in the manifests
+CHUNK_SIZE = 4 * 1024 * 1024
+FRAME_LENGTH = struct.Struct(">I")
+# chunk index and last chunk flag, prevents reordering and truncation of the chunks
+CHUNK_HEADER = struct.Struct(">Q?")
+
 
 def get_fernet_with_salt(password, salt=None):
     """
@@ -38,25 +49,80 @@ def get_fernet_with_salt(password, salt=None):
     return fernet, salt
 
 
-def encrypt_file(filepath, password):
+def get_repository_keys(password, salt):
+    """
+    Derives the keys of a deduplicated repository from a password.
+
+    :param password: The password of the repository.
+    :param salt: The salt stored in the repository configuration.
+    :return: A tuple containing the Fernet object encrypting the chunks and the
+        HMAC key naming them.
+    """
+    kdf = PBKDF2HMAC(
+        algorithm=hashes.SHA256(),
+        length=2 * KEY_SIZE,
+        salt=salt,
+        iterations=ITERATIONS,
+        backend=default_backend(),
+    )
+    key = kdf.derive(password.encode(PASSWORD_ENCODING))
+    fernet = Fernet(base64.urlsafe_b64encode(key[:KEY_SIZE]))
+    return fernet, key[KEY_SIZE:]
+
+
+def encrypt_bytes(fernet, data):
+    """
+    Encrypts data into a raw (not base64 encoded) Fernet token.
+    """
+    return base64.urlsafe_b64decode(fernet.encrypt(data))
+
+
+def decrypt_bytes(fernet, token):
+    """
+    Decrypts a raw Fernet token, raises InvalidToken if it was altered.
+    """
+    return fernet.decrypt(base64.urlsafe_b64encode(token))
+
+
+def encrypt_file(filepath, password, progress=None, digest=None):
     """
     Encrypts a file using Fernet symmetric encryption derived from a password.
 
+    The file is encrypted in chunks, so that it never has to fit in memory.
+
     :param filepath: The path to the file to encrypt.
     :param password: The password to derive the encryption key.
+    :param progress: Optional ProgressTracker updated with the bytes read.
+    :param digest: Optional hashlib object updated with the bytes written.
     :return: The path to the encrypted file.
     """
     encrypted_filepath = filepath + ".enc"
     try:
         f, salt = get_fernet_with_salt(password)
 
-        with open(filepath, "rb") as file:
-            data = file.read()
-
-        encrypted_data = f.encrypt(data)
-
-        with open(encrypted_filepath, "wb") as file:
-            file.write(salt + encrypted_data)
+        with open(filepath, "rb") as input_file, open(
+            encrypted_filepath, "wb"
+        ) as output_file:
+
+            def write(data):
+                output_file.write(data)
+                if digest:
+                    digest.update(data)
+
+            write(MAGIC + salt)
+            index = 0
+            chunk = input_file.read(CHUNK_SIZE)
+            while True:
+                next_chunk = input_file.read(CHUNK_SIZE)
+                token = f.encrypt(CHUNK_HEADER.pack(index, not next_chunk) + chunk)
+                frame = base64.urlsafe_b64decode(token)
+                write(FRAME_LENGTH.pack(len(frame)) + frame)
+                if progress:
+                    progress.update(len(chunk))
+                if not next_chunk:
+                    break
+                chunk = next_chunk
+                index += 1
 
         logger.debug(f"File encrypted successfully: {encrypted_filepath}")
         return encrypted_filepath
@@ -65,6 +131,74 @@ def encrypt_file(filepath, password):
         raise
 
 
+def _read_frames(file):
+    while True:
+        length = file.read(FRAME_LENGTH.size)
+        if not length:
+            return
+        if len(length) < FRAME_LENGTH.size:
+            raise InvalidToken("Encrypted file is truncated")
+        (frame_length,) = FRAME_LENGTH.unpack(length)
+        frame = file.read(frame_length)
+        if len(frame) < frame_length:
+            raise InvalidToken("Encrypted file is truncated")
+        yield frame
+
+
+def decrypt_chunks(file, password, workers=1):
+    """
+    Decrypts a file object written by encrypt_file, chunk by chunk.
+
+    :param file: A binary file object positioned after MAGIC.
+    :param password: The password to derive the decryption key.
+    :param workers: Number of chunks decrypted in parallel.
+    :return: An iterator over the decrypted chunks.
+    """
+    salt = file.read(SALT_SIZE)
+    f, _ = get_fernet_with_salt(password, salt)
+
+    def decrypt_frame(frame):
+        data = f.decrypt(base64.urlsafe_b64encode(frame))
+        return CHUNK_HEADER.unpack_from(data), data[CHUNK_HEADER.size :]
+
+    frames = _read_frames(file)
+    if workers > 1:
+        chunks = map_ordered(decrypt_frame, frames, workers)
+    else:
+        chunks = map(decrypt_frame, frames)
+
+    expected_index = 0
+    last_seen = False
+    for (index, last), chunk in chunks:
+        if last_seen or index != expected_index:
+            raise InvalidToken("Encrypted file chunks are out of order")
+        yield chunk
+        last_seen = last
+        expected_index += 1
+    if not last_seen:
+        raise InvalidToken("Encrypted file is truncated")
+
+
+def decrypt_stream(file, password, workers=1):
+    """
+    Decrypts a binary file object in the chunked or the legacy single token format.
+
+    :param file: A binary file object, e.g. a remote file being downloaded.
+    :param password: The password to derive the decryption key.
+    :param workers: Number of chunks decrypted in parallel (chunked format only).
+    :return: An iterator over the decrypted chunks.
+    """
+    header = file.read(len(MAGIC))
+    if header == MAGIC:
+        yield from decrypt_chunks(file, password, workers)
+        return
+
+    # files encrypted before the chunked format: salt + a single token
+    data = header + file.read()
+    f, _ = get_fernet_with_salt(password, data[:SALT_SIZE])
+    yield f.decrypt(data[SALT_SIZE:])
+
+
 def decrypt_file(encrypted_filepath, password):
     """
     Decrypts a file encrypted with Fernet symmetric encryption derived from a password.
@@ -81,16 +215,11 @@ def decrypt_file(encrypted_filepath, password):
     logger.info(f"Decrypting file: {encrypted_filepath} -> {decrypted_filepath}")
 
     try:
-        with open(encrypted_filepath, "rb") as file:
-            salt = file.read(SALT_SIZE)
-            encrypted_data = file.read()
-
-        f, _ = get_fernet_with_salt(password, salt)
-
-        decrypted_data = f.decrypt(encrypted_data)
-
-        with open(decrypted_filepath, "wb") as file:
-            file.write(decrypted_data)
+        with open(encrypted_filepath, "rb") as file, open(
+            decrypted_filepath, "wb"
+        ) as output_file:
+            for chunk in decrypt_stream(file, password):
+                output_file.write(chunk)
 
         logger.info(f"File decrypted successfully: {decrypted_filepath}")
         return decrypted_filepath
@@ -0,0 +1,275 @@
+"""
+Store-and-forward spool of the backup files that could not be uploaded.
+
+When the upload of a backup file fails, even after its retries, the file and
+its manifest are moved to the spool instead of being deleted, with a metadata
+file, in a directory per backup:
+
+    <spool directory>/<backup id>/<backup file>
+    <spool directory>/<backup id>/<backup file>.manifest.json
+    <spool directory>/<backup id>/<backup file>.spool.json
+
+The drainer uploads them, oldest first and drain_parallel at a time, then
+applies the retention of their backup. A host that cannot be reached is skipped
+until the next round. The spool stays under max_size_mb by evicting its oldest
+files.
+"""
+
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from config import Backup, Spool
+from data.BackupData import BackupData
+from worker import metrics
+from worker.history import mark_uploaded
+from worker.transfer_client.transfer_manager import remove_old_backups, upload_backup
+from worker.utils import format_bytes
+
+METADATA_SUFFIX = ".spool.json"
+
+
+class UploadSpool:
+    def __init__(self, settings: Spool, backups: List[Backup]):
+        self.settings = settings
+        self.directory = settings.directory
+        self.max_size = settings.max_size_mb * 1_000_000
+        self._backups: Dict[str, Backup] = {backup.id: backup for backup in backups}
+        self._lock = threading.Lock()
+        # backup files being uploaded, never evicted
+        self._draining = set()
+        self._stop = threading.Event()
+        self._drainer = None
+        os.makedirs(self.directory, exist_ok=True)
+        self._report_depth()
+
+    def get_entries(self) -> List[dict]:
+        """
+        Returns the metadata of the spooled backup files, oldest first.
+        """
+        entries = []
+        for backup_id in sorted(os.listdir(self.directory)):
+            backup_dir = os.path.join(self.directory, backup_id)
+            if not os.path.isdir(backup_dir):
+                continue
+            for filename in os.listdir(backup_dir):
+                if not filename.endswith(METADATA_SUFFIX):
+                    continue
+                try:
+                    with open(os.path.join(backup_dir, filename)) as metadata_file:
+                        entry = json.load(metadata_file)
+                except (OSError, ValueError) as e:
+                    logger.warning(f"Invalid spool metadata {filename}: {e}")
+                    continue
+                entry["dir"] = backup_dir
+                entries.append(entry)
+        return sorted(entries, key=lambda entry: entry["spooled_at"])
+
+    def _get_files(self, entry: dict) -> List[str]:
+        return [
+            os.path.join(entry["dir"], filename)
+            for filename in (
+                entry["artifact"],
+                *entry["sidecars"],
+                entry["artifact"] + METADATA_SUFFIX,
+            )
+        ]
+
+    def _remove(self, entry: dict):
+        for filepath in self._get_files(entry):
+            if os.path.exists(filepath):
+                os.remove(filepath)
+
+    def _report_depth(self):
+        entries = self.get_entries()
+        metrics.set_spool_depth(len(entries), sum(entry["size"] for entry in entries))
+
+    def add(
+        self,
+        backup: Backup,
+        backup_data: BackupData,
+        filepath: str,
+        prefix: str,
+        sidecar_filepaths: List[str] = (),
+        error: str = None,
+    ) -> bool:
+        """
+        Moves a backup file that could not be uploaded, and its sidecar files, to
+        the spool, evicting the oldest spooled files if it would not fit.
+
+        :param prefix: The prefix of the backup files, for the retention.
+        :return: Whether the file was spooled, False if it is larger than the spool.
+        """
+        size = sum(os.path.getsize(path) for path in (filepath, *sidecar_filepaths))
+        if size > self.max_size:
+            logger.error(
+                f"[{backup.id}] {os.path.basename(filepath)} ({format_bytes(size)})"
+                f" is larger than the spool ({format_bytes(self.max_size)})"
+            )
+            return False
+
+        with self._lock:
+            entries = self.get_entries()
+            used = sum(entry["size"] for entry in entries)
+            for entry in entries:
+                if used + size <= self.max_size:
+                    break
+                if entry["artifact"] in self._draining:
+                    continue
+                self._remove(entry)
+                used -= entry["size"]
+                logger.warning(
+                    f"[{entry['backup_id']}] Evicted {entry['artifact']} from the"
+                    " spool, it was never uploaded"
+                )
+
+            backup_dir = os.path.join(self.directory, backup.id)
+            os.makedirs(backup_dir, exist_ok=True)
+            for path in (filepath, *sidecar_filepaths):
+                shutil.move(path, os.path.join(backup_dir, os.path.basename(path)))
+            artifact = os.path.basename(filepath)
+            metadata = {
+                "backup_id": backup.id,
+                "artifact": artifact,
+                "sidecars": [os.path.basename(path) for path in sidecar_filepaths],
+                "size": size,
+                "prefix": prefix,
+                "start_time": backup_data.start_time.isoformat(),
+                "spooled_at": datetime.now().isoformat(),
+                "error": error,
+            }
+            with open(
+                os.path.join(backup_dir, artifact + METADATA_SUFFIX), "w"
+            ) as metadata_file:
+                json.dump(metadata, metadata_file, indent=2)
+        logger.warning(
+            f"[{backup.id}] {artifact} spooled in {backup_dir}, it will be uploaded"
+            " when the host can be reached"
+        )
+        self._report_depth()
+        return True
+
+    def _forward(self, entry: dict, unreachable: set):
+        backup = self._backups.get(entry["backup_id"])
+        if not backup:
+            logger.warning(
+                f"Spooled {entry['artifact']} belongs to the unknown backup"
+                f" '{entry['backup_id']}', kept"
+            )
+            return
+        host_key = "local" if backup.local else backup.host_id
+        protocol = backup.host_obj.protocol if not backup.local else "local"
+        if host_key in unreachable:
+            return
+        artifact_path, *sidecar_paths, _metadata_path = self._get_files(entry)
+        try:
+            upload_backup(
+                protocol,
+                artifact_path,
+                backup.path,
+                backup.host_obj,
+                sidecar_filepaths=sidecar_paths,
+            )
+        except Exception as e:
+            unreachable.add(host_key)
+            logger.warning(
+                f"[{backup.id}] Spooled {entry['artifact']} not uploaded, the host"
+                f" is still unreachable: {e}"
+            )
+            return
+
+        with self._lock:
+            self._remove(entry)
+        mark_uploaded(backup.id, entry["artifact"])
+        logger.success(f"[{backup.id}] Spooled {entry['artifact']} uploaded")
+        if backup.lifecycle:
+            # moved by the lifecycle of the backup
+            return
+        try:
+            remove_old_backups(
+                protocol,
+                backup.path,
+                entry["prefix"],
+                backup.date_format,
+                backup.max_backup_files,
+                backup.host_obj,
+            )
+        except Exception as e:
+            logger.warning(
+                f"[{backup.id}] Retention after the spool upload failed: {e}"
+            )
+
+    def drain(self) -> int:
+        """
+        Uploads the spooled backup files, oldest first.
+
+        :return: The number of backup files left in the spool.
+        """
+        entries = self.get_entries()
+        if not entries:
+            return 0
+        logger.info(f"Uploading {len(entries)} spooled backup file(s)...")
+        unreachable = set()
+        with self._lock:
+            self._draining = {entry["artifact"] for entry in entries}
+        try:
+            with ThreadPoolExecutor(
+                max_workers=self.settings.drain_parallel
+            ) as executor:
+                # map submits in order, so the oldest files are uploaded first
+                list(
+                    executor.map(
+                        lambda entry: self._forward(entry, unreachable), entries
+                    )
+                )
+        finally:
+            with self._lock:
+                self._draining = set()
+        self._report_depth()
+        return len(self.get_entries())
+
+    def start_drainer(self):
+        """
+        Drains the spool every drain_interval seconds in a background thread.
+        """
+
+        def drain_loop():
+            while not self._stop.wait(self.settings.drain_interval):
+                try:
+                    self.drain()
+                except Exception as e:
+                    logger.error(f"Failed to drain the spool: {e}")
+
+        self._drainer = threading.Thread(
+            target=drain_loop, name="spool-drainer", daemon=True
+        )
+        self._drainer.start()
+
+    def stop_drainer(self):
+        self._stop.set()
+        if self._drainer:
+            self._drainer.join()
+            self._drainer = None
+
+
+_spool: Optional[UploadSpool] = None
+
+
+def init_spool(settings: Spool, backups: List[Backup]) -> Optional[UploadSpool]:
+    global _spool
+    try:
+        _spool = UploadSpool(settings, backups)
+    except Exception as e:
+        logger.error(f"Failed to open the spool '{settings.directory}': {e}")
+        _spool = None
+    return _spool
+
+
+def get_spool() -> Optional[UploadSpool]:
+    return _spool
@@ -1,87 +1,691 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import List
+
 from loguru import logger
 
 from config import Backup
-from worker.transfer_client.transfer_manager import remove_old_backups, upload_backup
-from worker.compression import compress_file
-from worker.db import dump_db
-from worker.file import delete_file, get_backup_file
-from worker.notification import send_notifications
-from worker.security import encrypt_file
+from worker.transfer_client.transfer_manager import (
+    get_client,
+    remove_old_backups,
+    upload_backup,
+)
+from worker.compression import (
+    CODECS,
+    DEFAULT_CODEC,
+    choose_codec,
+    compress_file,
+    has_codec,
+)
+from worker.admission import has_load_thresholds, wait_for_quiet_database
+from worker.databases import (
+    dump_databases,
+    get_databases_size,
+    is_multi_database,
+    resolve_databases,
+)
+from worker.engines import get_engine
+from worker.file import ARCHIVE_SUFFIX, delete_file, get_backup_file
+from worker import metrics
+from worker.history import get_store, record_backup
+from worker.manifest import write_manifest
+from worker.profiling import get_run_report_dir, profile_stage
+from worker.progress import format_duration, track_progress
+from worker.spool import get_spool
+from worker.utils import format_bytes
 from data import BackupData
 
 
-def backup_task(backup: Backup):
+def _log_stages(backup_data: BackupData.BackupData):
+    for stage in backup_data.stages:
+        logger.info(f"[{backup_data.id}] {stage}")
+
+
+@contextmanager
+def _stage(backup_data: BackupData.BackupData, name: str, profile_dir: str = None):
+    with backup_data.stage(name) as stage, profile_stage(
+        backup_data.id, name, profile_dir
+    ):
+        yield stage
+
+
+def _retry(backup: Backup, stage, function, protocol: str = None, retries: int = None):
+    """
+    Runs function, and runs it again up to stage_retries times if it raises, after
+    stage_retry_delay seconds doubled at each attempt. The stage measures the
+    last attempt and counts them.
+
+    :param protocol: The protocol of a transfer stage, to count its retries.
+    :param retries: The number of retries, instead of stage_retries.
+    :return: What function returned.
+    """
+    retries = (backup.stage_retries if retries is None else retries) or 0
+    delay = backup.stage_retry_delay or 0
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            if stage.attempts > retries:
+                raise
+            logger.warning(
+                f"[{backup.id}] {stage.name} attempt {stage.attempts}/{retries + 1}"
+                f" failed: {e}, retrying in {delay:g}s"
+            )
+            if protocol:
+                metrics.inc_transfer_retries(backup.id, protocol)
+            time.sleep(delay)
+            delay *= 2
+            stage.attempts += 1
+            stage.start()
+
+
+def _spool_artifact(
+    backup: Backup,
+    backup_data: BackupData.BackupData,
+    file_to_send: str,
+    manifest_file: str,
+    prefix: str,
+    error: Exception,
+) -> bool:
+    """
+    Moves a backup file that could not be uploaded to the spool, if enabled.
+
+    :return: Whether the file was spooled.
+    """
+    spool = get_spool()
+    if not spool:
+        return False
+    try:
+        backup_data.spooled = spool.add(
+            backup, backup_data, file_to_send, prefix, [manifest_file], str(error)
+        )
+    except Exception as e:
+        logger.error(f"[{backup.id}] Failed to spool {backup_data.artifact}: {e}")
+        return False
+    return backup_data.spooled
+
+
+def _estimate_dump_size(backup: Backup, engine, databases: List[str] = None):
+    """
+    Estimates the size of the dump from the previous run, or from the size of the
+    databases for the first run.
+    """
+    store = get_store()
+    last_run = store.get_last_run(backup.id) if store else None
+    if last_run:
+        dump_stage = next(
+            (stage for stage in last_run["stages"] if stage["name"] == "dump"), None
+        )
+        if dump_stage and dump_stage["bytes_out"]:
+            return dump_stage["bytes_out"]
+    if databases:
+        return get_databases_size(engine, backup.db_connection_obj, databases)
+    return engine.get_database_size(backup.db_connection_obj)
+
+
+def _get_codec(backup: Backup, backup_data: BackupData.BackupData, dump_file: str):
+    """
+    Returns the codec and level to compress a dump with. The auto mode picks them
+    from a sample of the dump and the upload bandwidth measured by the previous
+    runs to the same host, within the time budget of the backup if any.
+    """
+    codec = backup.compression_codec.value
+    if codec != "auto":
+        if not has_codec(codec):
+            raise ValueError(f"The {codec} codec needs the zstandard package")
+        return codec, backup.compression_level or CODECS[codec][1]
+
+    store = get_store()
+    bandwidth = (
+        store.get_upload_bandwidth(backup_data.host, backup_data.protocol)
+        if store
+        else None
+    )
+    if not bandwidth:
+        logger.info(
+            f"[{backup.id}] No upload to {backup_data.host} measured yet,"
+            f" compressing with {DEFAULT_CODEC}"
+        )
+        return DEFAULT_CODEC, CODECS[DEFAULT_CODEC][1]
+
+    time_budget = None
+    if backup.time_budget_seconds:
+        elapsed = (datetime.now() - backup_data.start_time).total_seconds()
+        time_budget = max(backup.time_budget_seconds - elapsed, 0)
+    choice = choose_codec(dump_file, bandwidth, time_budget)
+    backup_data.codec_choice = choice
+    logger.info(
+        f"[{backup.id}] Compressing with {choice['codec']} level {choice['level']}"
+        f" for an upload bandwidth of {format_bytes(bandwidth)}/s"
+    )
+    return choice["codec"], choice["level"]
+
+
+def _get_dictionary(
+    backup: Backup, backup_data: BackupData.BackupData, dump_file: str, level: int
+):
+    """
+    Returns the zstd dictionary of the database of a backup, trained from the dump
+    and uploaded next to the backup files when there is none yet or it is too old.
+    """
+    from worker.dictionary import get_dictionary_key, get_dictionary_store
+
+    protocol = backup.host_obj.protocol if not backup.local else "local"
+    client = get_client(protocol, backup.host_obj)
+    client.connect()
+    try:
+        name, dictionary = get_dictionary_store(client, backup).get_latest(
+            get_dictionary_key(backup),
+            dump_file,
+            level,
+            backup.dictionary_max_age_days,
+        )
+    finally:
+        client.disconnect()
+    backup_data.dictionary = name
+    return dictionary
+
+
+def _send_notifications(backup: Backup, backup_data: BackupData.BackupData):
+    if not backup.notification_objs:
+        return
+    # requests/smtplib are only loaded for jobs that actually notify
+    from worker.notification import send_notifications
+
+    send_notifications(
+        backup_data=backup_data,
+        notifications=backup.notification_objs,
+        notify_on_fail=backup.notify_on_fail,
+        notify_on_success=backup.notify_on_success,
+    )
+
+
+def _store_in_repository(
+    backup: Backup,
+    backup_data: BackupData.BackupData,
+    dump_file: str,
+    backup_file_prefix: str,
+    profile_dir: str = None,
+):
+    """
+    Stores a dump in the deduplicated repository of the backup, then deletes the
+    old recipes and the chunks they alone referenced.
+    """
+    from worker.repository import Repository, get_recipe_name
+
+    protocol = backup.host_obj.protocol if not backup.local else "local"
+    client = get_client(protocol, backup.host_obj)
+    client.connect()
+    repository = Repository(client, backup)
+    try:
+        # the garbage collection must not run while another run stores chunks
+        with repository.lock():
+            repository.open(create=True)
+            recipe_name = get_recipe_name(os.path.basename(dump_file))
+            dump_stage = backup_data.stages[-1]
+            with _stage(backup_data, "store", profile_dir) as stage:
+                stage.bytes_in = dump_stage.bytes_out
+
+                def store():
+                    # the chunks stored by a failed attempt are not uploaded again
+                    with track_progress(backup.id, "store", stage.bytes_in) as progress:
+                        return repository.store(
+                            dump_file,
+                            recipe_name,
+                            {
+                                "backup_id": backup.id,
+                                "created": backup_data.start_time.isoformat(),
+                                "database": backup_data.database,
+                                "size": dump_stage.bytes_out,
+                                "sha256": dump_stage.sha256,
+                                "row_counts": backup_data.row_counts or {},
+                            },
+                            progress,
+                        )
+
+                stats = _retry(backup, stage, store, protocol)
+                stage.bytes_out = stats["uploaded_bytes"]
+            logger.info(
+                f"[{backup.id}] {stats['new_chunks']} new chunk(s) of {stats['chunks']}"
+                f" uploaded ({format_bytes(stats['uploaded_bytes'])})"
+            )
+            backup_data.artifact = recipe_name
+            # what a restore downloads
+            backup_data.artifact_size = stats["size"]
+            backup_data.checksum = stats["recipe_sha256"]
+            backup_data.dictionary = stats["dictionary"]
+
+            with _stage(backup_data, "retention", profile_dir) as stage:
+                _retry(
+                    backup,
+                    stage,
+                    lambda: repository.remove_old_recipes(
+                        backup_file_prefix, backup.date_format, backup.max_backup_files
+                    ),
+                    protocol,
+                )
+    finally:
+        client.disconnect()
+
+
+def backup_task(backup: Backup, profile: bool = None) -> BackupData.BackupData:
+    """
+    Runs a backup: dump, compression, encryption, upload and retention, or dump
+    and store in a deduplicated repository.
+
+    :param backup: The backup to run.
+    :param profile: Profile each stage, overrides the profile option of the backup.
+    :return: The BackupData of the run.
+    """
     logger.info(f"[{backup.id}] Starting backup task...")
 
     dump_file = None
     compressed_dump_file = None
     encrypted_dump_file = None
+    manifest_file = None
     protocol = backup.host_obj.protocol if not backup.local else "local"
     host = backup.host_obj.hostname if not backup.local else "local"
 
     backup_data = BackupData.BackupData(
         backup.id,
-        backup.db_connection_obj.database,
+        (
+            ", ".join(backup.databases)
+            if backup.databases
+            else backup.db_connection_obj.database
+        ),
         host,
         protocol,
         backup.compression_enabled,
         backup.encryption_enabled,
     )
 
+    profile_dir = None
+    if backup.profile if profile is None else profile:
+        profile_dir = get_run_report_dir(backup.id)
+        logger.info(f"[{backup.id}] Profiling enabled, reports in {profile_dir}")
+
     try:
+        engine = get_engine(backup)
+        backup_data.engine = engine.name
+        multi_database = is_multi_database(backup)
         backup_file_prefix, backup_filename, backup_filepath = get_backup_file(
-            backup.id, backup.filename, backup.date_format
+            backup.id,
+            backup.filename,
+            backup.date_format,
+            engine.extension + (ARCHIVE_SUFFIX if multi_database else ""),
         )
-        dump_file = dump_db(backup, backup_filepath)
+        source, backup_data.source, backup_data.source_lag = engine.choose_source(
+            backup.db_connection_obj
+        )
+        databases = None
+        if multi_database:
+            databases = resolve_databases(backup, engine, source)
+            logger.info(
+                f"[{backup.id}] Dumping {len(databases)} database(s),"
+                f" {backup.database_parallel} at a time: {', '.join(databases)}"
+            )
+        if has_load_thresholds(backup):
+            with _stage(backup_data, "admission"), track_progress(
+                backup.id, "admission"
+            ):
+                backup_data.admission = wait_for_quiet_database(
+                    backup, source, replica=backup_data.source != "primary"
+                )
+            backup_data.deferred_seconds = backup_data.admission["deferred_seconds"]
+        with _stage(backup_data, "dump", profile_dir) as stage:
+            estimated_size = _estimate_dump_size(backup, engine, databases)
 
-        if backup.compression_enabled:
-            compressed_dump_file = compress_file(dump_file)
+            def dump():
+                # a retried dump starts over, into the same file
+                digest = hashlib.sha256()
+                with track_progress(backup.id, "dump", estimated_size) as progress:
+                    # row counts are checked by the restore drills
+                    if databases:
+                        backup_data.row_counts, backup_data.databases = dump_databases(
+                            backup,
+                            engine,
+                            databases,
+                            backup_filepath,
+                            progress,
+                            digest,
+                            source,
+                        )
+                    else:
+                        backup_data.row_counts = engine.dump(
+                            backup, backup_filepath, progress, digest, source
+                        )
+                return digest
 
-        if backup.encryption_enabled:
-            file_to_encrypt = compressed_dump_file or dump_file
-            encrypted_dump_file = encrypt_file(
-                file_to_encrypt, backup.encryption_password
+            try:
+                # only retried on request, it hits the database again
+                digest = _retry(backup, stage, dump, retries=backup.dump_retries)
+            finally:
+                if os.path.exists(backup_filepath):
+                    dump_file = backup_filepath
+            stage.bytes_out = os.path.getsize(dump_file)
+            stage.sha256 = digest.hexdigest()
+
+        if backup.repository:
+            _store_in_repository(
+                backup, backup_data, dump_file, backup_file_prefix, profile_dir
             )
+        else:
+            if backup.compression_enabled:
+                with _stage(backup_data, "compression", profile_dir) as stage:
+                    stage.bytes_in = os.path.getsize(dump_file)
+                    codec, level = _get_codec(backup, backup_data, dump_file)
+                    dictionary = None
+                    if codec == "zstd" and backup.compression_dictionary:
+                        dictionary = _get_dictionary(
+                            backup, backup_data, dump_file, level
+                        )
+                    with track_progress(
+                        backup.id, "compression", stage.bytes_in
+                    ) as progress:
+                        digest = hashlib.sha256()
+                        compressed_dump_file = compress_file(
+                            dump_file, progress, digest, codec, level, dictionary
+                        )
+                    stage.bytes_out = os.path.getsize(compressed_dump_file)
+                    stage.sha256 = digest.hexdigest()
+                    backup_data.codec, backup_data.codec_level = codec, level
 
-        file_to_send = encrypted_dump_file or compressed_dump_file or dump_file
+            if backup.encryption_enabled:
+                from worker.security import encrypt_file
 
-        upload_backup(
-            protocol,
-            file_to_send,
-            backup.path,
-            backup.host_obj,
-        )
-        remove_old_backups(
-            protocol,
-            backup.path,
-            backup_file_prefix,
-            backup.date_format,
-            backup.max_backup_files,
-            backup.host_obj,
-        )
+                with _stage(backup_data, "encryption", profile_dir) as stage:
+                    file_to_encrypt = compressed_dump_file or dump_file
+                    stage.bytes_in = os.path.getsize(file_to_encrypt)
+                    with track_progress(
+                        backup.id, "encryption", stage.bytes_in
+                    ) as progress:
+                        digest = hashlib.sha256()
+                        encrypted_dump_file = encrypt_file(
+                            file_to_encrypt,
+                            backup.encryption_password,
+                            progress,
+                            digest,
+                        )
+                    stage.bytes_out = os.path.getsize(encrypted_dump_file)
+                    stage.sha256 = digest.hexdigest()
+
+            file_to_send = encrypted_dump_file or compressed_dump_file or dump_file
+            backup_data.artifact = os.path.basename(file_to_send)
+            backup_data.artifact_size = os.path.getsize(file_to_send)
+            # the last stage hashed the artifact while writing it
+            backup_data.checksum = backup_data.stages[-1].sha256
+            manifest_file = write_manifest(backup_data, os.path.dirname(file_to_send))
+
+            try:
+                with _stage(backup_data, "upload", profile_dir) as stage:
+                    stage.bytes_in = stage.bytes_out = backup_data.artifact_size
+
+                    def upload():
+                        # sends the local artifact again, nothing is dumped again
+                        with track_progress(
+                            backup.id, "upload", stage.bytes_in
+                        ) as progress:
+                            upload_backup(
+                                protocol,
+                                file_to_send,
+                                backup.path,
+                                backup.host_obj,
+                                progress,
+                                sidecar_filepaths=[manifest_file],
+                            )
+
+                    _retry(backup, stage, upload, protocol)
+            except Exception as e:
+                if not _spool_artifact(
+                    backup,
+                    backup_data,
+                    file_to_send,
+                    manifest_file,
+                    backup_file_prefix,
+                    e,
+                ):
+                    raise
+                # the spool owns the files now
+                dump_file, compressed_dump_file, encrypted_dump_file = [
+                    None if path == file_to_send else path
+                    for path in (dump_file, compressed_dump_file, encrypted_dump_file)
+                ]
+                manifest_file = None
+                raise Exception(
+                    f"Upload failed, {backup_data.artifact} is spooled to be"
+                    f" uploaded later: {e}"
+                ) from e
+
+            # with a lifecycle, the files over max_backup_files are moved instead
+            if not backup.lifecycle:
+                with _stage(backup_data, "retention", profile_dir) as stage:
+                    _retry(
+                        backup,
+                        stage,
+                        lambda: remove_old_backups(
+                            protocol,
+                            backup.path,
+                            backup_file_prefix,
+                            backup.date_format,
+                            backup.max_backup_files,
+                            backup.host_obj,
+                        ),
+                        protocol,
+                    )
 
         backup_data.set_status(success=True)
         logger.success(backup_data.status_short)
-        send_notifications(
-            backup_data=backup_data,
-            notifications=backup.notification_objs,
-            notify_on_fail=backup.notify_on_fail,
-            notify_on_success=backup.notify_on_success,
-        )
+        _log_stages(backup_data)
+        _send_notifications(backup, backup_data)
 
     except Exception as e:
         backup_data.set_status(success=False, error=str(e))
         logger.error(backup_data.status_short)
-        send_notifications(
-            backup_data=backup_data,
-            notifications=backup.notification_objs,
-            notify_on_fail=backup.notify_on_fail,
-            notify_on_success=backup.notify_on_success,
-        )
+        _log_stages(backup_data)
+        _send_notifications(backup, backup_data)
     finally:
+        record_backup(backup_data)
         if dump_file:
             delete_file(dump_file)
         if compressed_dump_file:
             delete_file(compressed_dump_file)
         if encrypted_dump_file:
             delete_file(encrypted_dump_file)
+        if manifest_file:
+            delete_file(manifest_file)
+
+    return backup_data
+
+
+def _compare_row_counts(expected: dict, actual: dict) -> list:
+    differences = []
+    for table, count in sorted(expected.items()):
+        if table not in actual:
+            differences.append(f"{table}: missing")
+        elif actual[table] != count:
+            differences.append(f"{table}: {actual[table]} rows instead of {count}")
+    return differences
+
+
+def _physical_drill(
+    backup: Backup, backup_data: BackupData.BackupData, parallel: int
+) -> BackupData.BackupData:
+    """
+    Extracts and prepares the latest physical backup in a temporary directory,
+    without a server: a successful prepare is the check.
+    """
+    from worker.engines.physical import restore_physical_backup
+
+    target_dir = tempfile.mkdtemp(prefix=f"dbackup-drill-{backup.id}-")
+    try:
+        with backup_data.stage("restore") as restore_stage:
+            stats = restore_physical_backup(backup, target_dir, parallel=parallel)
+            restore_stage.bytes_in = stats["downloaded_bytes"]
+            restore_stage.bytes_out = stats["restored_bytes"]
+        backup_data.artifact = stats["file"]
+        backup_data.artifact_size = stats["downloaded_bytes"]
+
+        if backup.rto_seconds and restore_stage.wall_time > backup.rto_seconds:
+            raise ValueError(
+                f"Restore took {format_duration(restore_stage.wall_time)},"
+                f" over the RTO budget of {format_duration(backup.rto_seconds)}"
+            )
+
+        backup_data.set_status(success=True)
+        logger.success(backup_data.status_short)
+        _log_stages(backup_data)
+        _send_notifications(backup, backup_data)
+
+    except Exception as e:
+        backup_data.set_status(success=False, error=str(e))
+        logger.error(f"{backup_data.status_short}: {e}")
+        _log_stages(backup_data)
+        _send_notifications(backup, backup_data)
+    finally:
+        record_backup(backup_data)
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+    return backup_data
+
+
+def _drop_scratch_databases(backup: Backup, engine, scratch):
+    """
+    Drops the scratch database, or the scratch databases of a backup of several
+    databases: the ones named <scratch database>_<database>.
+    """
+    if not is_multi_database(backup):
+        engine.drop_database(scratch, scratch.database)
+        return
+    for database in engine.list_databases(scratch):
+        if database.startswith(f"{scratch.database}_"):
+            engine.drop_database(scratch, database)
+
+
+def drill_task(backup: Backup, parallel: int = 1) -> BackupData.BackupData:
+    """
+    Runs a restore drill: restores the latest backup file into the scratch
+    database, checks its row counts against the ones counted during the dump,
+    and checks the restore time against the RTO budget. The databases of a
+    multi-database backup are restored into <scratch database>_<database>, and
+    physical backups are prepared in a temporary directory instead.
+
+    :param backup: The backup to restore.
+    :param parallel: Number of tables restored at the same time.
+    :return: The BackupData of the drill, recorded in the history as a "drill".
+    """
+    logger.info(f"[{backup.id}] Starting restore drill...")
+
+    scratch = backup.verify_db_connection_obj
+    protocol = backup.host_obj.protocol if not backup.local else "local"
+    host = backup.host_obj.hostname if not backup.local else "local"
+    backup_data = BackupData.BackupData(
+        backup.id,
+        scratch.database if scratch else None,
+        host,
+        protocol,
+        backup.compression_enabled,
+        backup.encryption_enabled,
+        kind="drill",
+    )
+
+    engine = None
+    try:
+        engine = get_engine(backup)
+        if not engine.logical:
+            return _physical_drill(backup, backup_data, parallel)
+        multi_database = is_multi_database(backup)
+
+        if not scratch:
+            raise ValueError("No verify_db_connection_id is configured")
+        # also checked by the config, for the Backups built without it
+        if set(scratch.servers) & set(backup.db_connection_obj.servers):
+            raise ValueError(
+                "The scratch server is the backed up server or one of its replicas"
+            )
+
+        from worker.restore import restore_backup
+
+        _drop_scratch_databases(backup, engine, scratch)
+        with backup_data.stage("restore") as restore_stage:
+            if multi_database:
+                # each database into <scratch database>_<database>
+                stats = restore_backup(
+                    backup,
+                    parallel=parallel,
+                    db_connection=scratch,
+                    prefix=f"{scratch.database}_",
+                )
+            else:
+                stats = restore_backup(
+                    backup,
+                    database=scratch.database,
+                    parallel=parallel,
+                    db_connection=scratch,
+                )
+            restore_stage.bytes_in = stats["downloaded_bytes"]
+            restore_stage.bytes_out = stats["restored_bytes"]
+        backup_data.artifact = stats["file"]
+        backup_data.artifact_size = stats["downloaded_bytes"]
+
+        with backup_data.stage("check"):
+            if multi_database:
+                backup_data.row_counts = {
+                    f"{database}.{table}": count
+                    for database, target in stats["databases"].items()
+                    for table, count in engine.get_row_counts(scratch, target).items()
+                }
+            else:
+                backup_data.row_counts = engine.get_row_counts(
+                    scratch, scratch.database
+                )
+            store = get_store()
+            backup_run = (
+                store.get_artifact_run(backup.id, stats["file"]) if store else None
+            )
+            expected = backup_run.get("row_counts") if backup_run else None
+            if expected:
+                differences = _compare_row_counts(expected, backup_data.row_counts)
+                if differences:
+                    raise ValueError(
+                        f"Row counts differ from the dump: {', '.join(differences)}"
+                    )
+            else:
+                logger.warning(
+                    f"[{backup.id}] No row counts recorded for {stats['file']},"
+                    " only the restore was checked"
+                )
+
+        if backup.rto_seconds and restore_stage.wall_time > backup.rto_seconds:
+            raise ValueError(
+                f"Restore took {format_duration(restore_stage.wall_time)},"
+                f" over the RTO budget of {format_duration(backup.rto_seconds)}"
+            )
+
+        backup_data.set_status(success=True)
+        logger.success(backup_data.status_short)
+        _log_stages(backup_data)
+        _send_notifications(backup, backup_data)
+
+    except Exception as e:
+        backup_data.set_status(success=False, error=str(e))
+        logger.error(f"{backup_data.status_short}: {e}")
+        _log_stages(backup_data)
+        _send_notifications(backup, backup_data)
+    finally:
+        # physical drills are recorded by _physical_drill
+        if not engine or engine.logical:
+            record_backup(backup_data)
+        if scratch and engine and engine.logical and backup_data.stages:
+            try:
+                _drop_scratch_databases(backup, engine, scratch)
+            except Exception as e:
+                logger.warning(
+                    f"[{backup.id}] Failed to drop the scratch database: {e}"
+                )
+
+    return backup_data
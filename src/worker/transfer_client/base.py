@@ -1,6 +1,23 @@
+import errno
+import ftplib
 from abc import ABC, abstractmethod
 
 
+def is_not_found_error(error: Exception) -> bool:
+    """
+    Returns whether an error of a transfer client means that the remote path
+    does not exist, rather than that the host could not be reached or read.
+    """
+    if isinstance(error, ftplib.error_perm):
+        return str(error).startswith("550")
+    return (
+        isinstance(error, FileNotFoundError)
+        or (isinstance(error, OSError) and error.errno == errno.ENOENT)
+        # the error of a remote command, such as ls over SSH
+        or "No such file or directory" in str(error)
+    )
+
+
 class TransferClient(ABC):
     DEFAULT_TIMEOUT_IN_SECONDS = 10
 
@@ -13,9 +30,39 @@ class TransferClient(ABC):
         pass
 
     @abstractmethod
-    def upload_file(self, local_path, remote_path):
+    def upload_file(self, local_path, remote_path, callback=None):
+        """
+        Uploads a file, callback is called with the number of bytes sent so far.
+        """
+        pass
+
+    @abstractmethod
+    def upload_fileobj(self, file, remote_path):
+        """
+        Uploads the content of a binary file object, in an existing directory.
+        """
         pass
 
+    @abstractmethod
+    def open_file(self, remote_path):
+        """
+        Opens a remote file for streaming reads, returns a binary file object.
+        """
+        pass
+
+    def get_size(self, remote_path):
+        """
+        Returns the size of a remote file, or None if the protocol cannot tell.
+        """
+        return None
+
+    def get_sha256(self, remote_path):
+        """
+        Returns the SHA-256 of a remote file computed without downloading it, or
+        None if the protocol cannot do it.
+        """
+        return None
+
     @abstractmethod
     def mkdir(self, path):
         pass
@@ -4,7 +4,34 @@ from ftplib import FTP, error_perm
 from worker.transfer_client.base import TransferClient
 
 
+class _DataConnectionFile:
+    """
+    Data connection of a RETR command, the transfer is completed on close.
+    """
+
+    def __init__(self, ftp, connection):
+        self.ftp = ftp
+        self.connection = connection
+        self.file = connection.makefile("rb")
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+        self.connection.close()
+        self.ftp.voidresp()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 class FTPTransferClient(TransferClient):
+    BLOCK_SIZE = 1024 * 1024
+
     def __init__(self, host):
         self.host = host
         self.ftp = None
@@ -23,12 +50,44 @@ class FTPTransferClient(TransferClient):
             self.ftp.quit()
             self.ftp = None
 
-    def upload_file(self, local_path, remote_path):
+    def upload_file(self, local_path, remote_path, callback=None):
         remote_dir, remote_filename = os.path.split(remote_path)
         self.mkdir(remote_dir)
         self.chdir(remote_dir)
+        sent = 0
+
+        def _on_block(block):
+            nonlocal sent
+            sent += len(block)
+            callback(sent)
+
         with open(local_path, "rb") as file:
-            self.ftp.storbinary(f"STOR {remote_filename}", file)
+            self.ftp.storbinary(
+                f"STOR {remote_filename}",
+                file,
+                blocksize=self.BLOCK_SIZE,
+                callback=_on_block if callback else None,
+            )
+
+    def upload_fileobj(self, file, remote_path):
+        self.ftp.storbinary(f"STOR {remote_path}", file, blocksize=self.BLOCK_SIZE)
+
+    def open_file(self, remote_path):
+        self.ftp.voidcmd("TYPE I")
+        connection = self.ftp.transfercmd(f"RETR {remote_path}")
+        return _DataConnectionFile(self.ftp, connection)
+
+    def get_size(self, remote_path):
+        self.ftp.voidcmd("TYPE I")
+        return self.ftp.size(remote_path)
+
+    def get_sha256(self, remote_path):
+        # non standard command of some servers (e.g. ProFTPD mod_digest)
+        try:
+            response = self.ftp.sendcmd(f"XSHA256 {remote_path}")
+        except error_perm:
+            return None
+        return response.split()[-1].lower()
 
     def mkdir(self, path):
         dirs = path.strip("/").split("/")
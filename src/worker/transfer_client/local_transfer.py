@@ -1,3 +1,4 @@
+import hashlib
 import os
 import shutil
 
@@ -5,6 +6,8 @@ from worker.transfer_client.base import TransferClient
 
 
 class LocalTransferClient(TransferClient):
+    CHUNK_SIZE = 1024 * 1024
+
     def __init__(self):
         self.current_dir = os.getcwd()
 
@@ -14,10 +17,36 @@ class LocalTransferClient(TransferClient):
     def disconnect(self):
         pass
 
-    def upload_file(self, local_path, remote_path):
+    def upload_file(self, local_path, remote_path, callback=None):
         remote_dir, _remote_filename = os.path.split(remote_path)
         self.mkdir(remote_dir)
-        shutil.copy2(local_path, remote_path)
+        if not callback:
+            shutil.copy2(local_path, remote_path)
+            return
+        sent = 0
+        with open(local_path, "rb") as source, open(remote_path, "wb") as target:
+            while chunk := source.read(self.CHUNK_SIZE):
+                target.write(chunk)
+                sent += len(chunk)
+                callback(sent)
+        shutil.copystat(local_path, remote_path)
+
+    def upload_fileobj(self, file, remote_path):
+        with open(remote_path, "wb") as target:
+            shutil.copyfileobj(file, target, self.CHUNK_SIZE)
+
+    def open_file(self, remote_path):
+        return open(remote_path, "rb")
+
+    def get_size(self, remote_path):
+        return os.path.getsize(remote_path)
+
+    def get_sha256(self, remote_path):
+        digest = hashlib.sha256()
+        with open(remote_path, "rb") as file:
+            while chunk := file.read(self.CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
 
     def mkdir(self, path):
         os.makedirs(path, exist_ok=True)
@@ -2,6 +2,31 @@ import paramiko
 from scp import SCPClient as scp_SCPClient
 
 from worker.transfer_client.base import TransferClient
+from worker.transfer_client.ssh_command import get_sha256, run_command
+
+
+class _CommandOutput:
+    """
+    Stdout of a remote command, raises on close if the command failed.
+    """
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def read(self, size=-1):
+        return self.stdout.read(size)
+
+    def close(self):
+        exit_status = self.stdout.channel.recv_exit_status()
+        self.stdout.close()
+        if exit_status != 0:
+            raise IOError(f"Remote command failed with exit status {exit_status}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 class SCPTransferClient(TransferClient):
@@ -35,10 +60,27 @@ class SCPTransferClient(TransferClient):
             self.ssh.close()
             self.ssh = None
 
-    def upload_file(self, local_path, remote_path):
-        with scp_SCPClient(self.ssh.get_transport()) as scp:
+    def upload_file(self, local_path, remote_path, callback=None):
+        progress = (lambda _name, _size, sent: callback(sent)) if callback else None
+        with scp_SCPClient(self.ssh.get_transport(), progress=progress) as scp:
             scp.put(local_path, remote_path)
 
+    def upload_fileobj(self, file, remote_path):
+        with scp_SCPClient(self.ssh.get_transport()) as scp:
+            scp.putfo(file, remote_path)
+
+    def open_file(self, remote_path):
+        # scp has no streaming download, read the file through a remote cat instead
+        _stdin, stdout, _stderr = self.ssh.exec_command(f"cat '{remote_path}'")
+        return _CommandOutput(stdout)
+
+    def get_size(self, remote_path):
+        output = run_command(self.ssh, f"stat -c %s '{remote_path}'")
+        return int(output) if output else None
+
+    def get_sha256(self, remote_path):
+        return get_sha256(self.ssh, remote_path)
+
     def mkdir(self, path):
         _stdin, stdout, _stderr = self.ssh.exec_command(f"mkdir -p '{path}'")
         stdout.channel.recv_exit_status()
@@ -51,6 +93,13 @@ class SCPTransferClient(TransferClient):
         stdout.channel.recv_exit_status()
 
     def list_files(self, path):
-        _stdin, stdout, _stderr = self.ssh.exec_command(f"ls -1 '{path}'")
-        stdout.channel.recv_exit_status()
-        return stdout.read().decode().splitlines()
+        _stdin, stdout, stderr = self.ssh.exec_command(f"ls -1 '{path}'")
+        output = stdout.read().decode()
+        exit_status = stdout.channel.recv_exit_status()
+        if exit_status != 0:
+            # a failed listing is not an empty directory
+            error = stderr.read().decode().strip()
+            raise IOError(
+                f"Cannot list {path}: {error or f'exit status {exit_status}'}"
+            )
+        return output.splitlines()
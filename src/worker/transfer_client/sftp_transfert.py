@@ -1,6 +1,7 @@
 import paramiko
 
 from worker.transfer_client.base import TransferClient
+from worker.transfer_client.ssh_command import get_sha256
 
 
 class SFTPTransferClient(TransferClient):
@@ -40,8 +41,29 @@ class SFTPTransferClient(TransferClient):
             self.ssh.close()
             self.ssh = None
 
-    def upload_file(self, local_path, remote_path):
-        self.sftp.put(local_path, remote_path)
+    def upload_file(self, local_path, remote_path, callback=None):
+        self.sftp.put(
+            local_path,
+            remote_path,
+            callback=(lambda sent, _total: callback(sent)) if callback else None,
+        )
+
+    def upload_fileobj(self, file, remote_path):
+        # skip the stat round trip after the upload, small files are the common case
+        self.sftp.putfo(file, remote_path, confirm=False)
+
+    def open_file(self, remote_path):
+        file = self.sftp.open(remote_path, "rb")
+        # request the whole file ahead instead of one round trip per read
+        file.prefetch()
+        return file
+
+    def get_size(self, remote_path):
+        return self.sftp.stat(remote_path).st_size
+
+    def get_sha256(self, remote_path):
+        # SFTP has no standard hash request, use the shell when the host allows it
+        return get_sha256(self.ssh, remote_path)
 
     def mkdir(self, path):
         try:
@@ -0,0 +1,42 @@
+from typing import Optional
+
+import paramiko
+
+from worker.transfer_client.base import TransferClient
+
+
+def connect(host) -> paramiko.SSHClient:
+    """
+    Opens an SSH connection to a Host, with its password or SSH key.
+    """
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(
+        hostname=host.hostname,
+        port=host.port,
+        username=host.username,
+        password=host.password,
+        key_filename=host.ssh_key,
+        timeout=TransferClient.DEFAULT_TIMEOUT_IN_SECONDS,
+    )
+    return ssh
+
+
+def run_command(ssh, command: str) -> Optional[str]:
+    """
+    Runs a command over an SSH connection and returns its output, or None if it
+    failed (e.g. no shell access on the host).
+    """
+    try:
+        _stdin, stdout, _stderr = ssh.exec_command(command)
+    except Exception:
+        return None
+    output = stdout.read().decode()
+    if stdout.channel.recv_exit_status() != 0:
+        return None
+    return output
+
+
+def get_sha256(ssh, path: str) -> Optional[str]:
+    output = run_command(ssh, f"sha256sum '{path}'")
+    return output.split()[0] if output else None
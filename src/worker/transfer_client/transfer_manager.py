@@ -2,21 +2,31 @@ import os
 
 from loguru import logger
 
-from worker.file import get_backups_to_delete, get_filename_from_path
-from worker.transfer_client.scp_transfer import SCPTransferClient
-from worker.transfer_client.sftp_transfert import SFTPTransferClient
-from worker.transfer_client.ftp_transfer import FTPTransferClient
-from worker.transfer_client.local_transfer import LocalTransferClient
+from worker.file import (
+    MANIFEST_SUFFIX,
+    get_backups_to_delete,
+    get_filename_from_path,
+)
 
 
 def get_client(client_type: str, host=None):
+    # protocol modules are imported on demand so that local jobs never pay
+    # for loading paramiko/scp at startup
     if client_type == "scp":
+        from worker.transfer_client.scp_transfer import SCPTransferClient
+
         return SCPTransferClient(host)
     elif client_type == "sftp":
+        from worker.transfer_client.sftp_transfert import SFTPTransferClient
+
         return SFTPTransferClient(host)
     elif client_type == "ftp":
+        from worker.transfer_client.ftp_transfer import FTPTransferClient
+
         return FTPTransferClient(host)
     elif client_type == "local":
+        from worker.transfer_client.local_transfer import LocalTransferClient
+
         return LocalTransferClient()
     else:
         raise ValueError(f"Unknown client_type: {client_type}")
@@ -27,14 +37,29 @@ def upload_backup(
     local_filepath: str,
     remote_dir_path: str,
     host,
+    progress=None,
+    sidecar_filepaths=(),
 ):
+    """
+    Uploads a backup file, then its sidecar files (e.g. its manifest), so that a
+    sidecar never describes a file that is missing.
+    """
     client = get_client(client_type, host)
     client.connect()
     try:
         client.mkdir(remote_dir_path)
         remote_filename = get_filename_from_path(local_filepath)
         remote_filepath = os.path.join(remote_dir_path, remote_filename)
-        client.upload_file(local_filepath, remote_filepath)
+        client.upload_file(
+            local_filepath,
+            remote_filepath,
+            callback=progress.set_bytes_done if progress else None,
+        )
+        for sidecar_filepath in sidecar_filepaths:
+            client.upload_file(
+                sidecar_filepath,
+                os.path.join(remote_dir_path, get_filename_from_path(sidecar_filepath)),
+            )
     except Exception as e:
         logger.error(f"Failed to send file: {e}")
         raise
@@ -63,6 +88,8 @@ def remove_old_backups(
             remote_file_path = os.path.join(remote_dir_path, file)
             client.delete_file(remote_file_path)
             logger.info(f"Deleted old backup file: {remote_file_path}")
+            if file + MANIFEST_SUFFIX in files:
+                client.delete_file(remote_file_path + MANIFEST_SUFFIX)
     except Exception as e:
         logger.error(f"Failed to remove old backups: {e}")
         raise
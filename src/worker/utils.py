@@ -1,3 +1,5 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 
 
@@ -7,3 +9,25 @@ def split_and_trim(s: str, sep: str = ",") -> List[str]:
     if sep not in s:
         return [s.strip()]
     return [x.strip() for x in s.split(sep) if x.strip()]
+
+
+def format_bytes(size: float) -> str:
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(size) < 1000 or unit == "TB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.2f} {unit}"
+        size /= 1000
+
+
+def map_ordered(function, items, workers):
+    """
+    Like map(), with up to workers calls running in threads and a bounded
+    number of results waiting to be consumed.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(function, item))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,71 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from config import Backup, DBConnection
+
+# stand-in of mysqldump dumping one table, counting its runs in $DUMP_LOG if set
+MYSQLDUMP = """#!/bin/sh
+[ -n "$DUMP_LOG" ] && echo dump >> "$DUMP_LOG"
+echo "-- Dumping data for table \\`t\\`"
+echo "INSERT INTO \\`t\\` VALUES (1),(2);"
+"""
+
+
+@pytest.fixture
+def fake_tools(tmp_path, monkeypatch):
+    """
+    Returns a function installing shell scripts, by name, in a directory put
+    first in PATH, standing in for the database tools.
+    """
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+
+    def install(**scripts):
+        for name, script in scripts.items():
+            (bin_dir / name).write_text(script)
+            (bin_dir / name).chmod(0o755)
+
+    return install
+
+
+@pytest.fixture
+def mysqldump(fake_tools):
+    fake_tools(mysqldump=MYSQLDUMP)
+
+
+@pytest.fixture
+def make_backup(tmp_path):
+    """
+    Returns a function building a local, uncompressed and unencrypted Backup of
+    a MySQL database, with its DB connection, from the fields to override.
+    """
+
+    def make(database: str = "app", **fields) -> Backup:
+        backup = Backup(
+            **{
+                "id": "app",
+                "db_connection_id": "db",
+                "local": True,
+                "path": str(tmp_path / "backups"),
+                "compression_enabled": False,
+                "encryption_enabled": False,
+                "date_format": "%Y-%m-%d_%H-%M-%S",
+                "max_backup_files": 2,
+                **fields,
+            }
+        )
+        backup.db_connection_obj = DBConnection(
+            id="db",
+            hostname="localhost",
+            username="root",
+            password="secret",
+            database=database,
+        )
+        return backup
+
+    return make
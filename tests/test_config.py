@@ -6,7 +6,7 @@ import pytest
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
 
-from config import get_config
+from config import Config, get_config
 
 EXAMPLES_DIR = os.path.join(os.path.dirname(__file__), "..", "examples")
 print(EXAMPLES_DIR)
@@ -25,3 +25,63 @@ def test_configs():
             assert config is not None, f"Config is None for file {config_file}"
         except Exception as e:
             pytest.fail(f"Validation failed for valid config file {config_file}: {e}")
+
+
+def test_scratch_server_is_not_the_backed_up_server():
+    """
+    Refuses a drill whose scratch database is on the backed up server or on one
+    of its replicas, where it could drop live databases.
+    """
+    db = {"hostname": "10.0.0.5", "username": "root", "password": "secret"}
+    for scratch_hostname in ("10.0.0.5", "10.0.0.6"):
+        with pytest.raises(ValueError, match="must not be the backed up server"):
+            Config(
+                global_config={},
+                db_connections=[
+                    {
+                        "id": "live",
+                        "databases": ["*"],
+                        "replicas": [{"hostname": "10.0.0.6"}],
+                        **db,
+                    },
+                    {
+                        "id": "scratch",
+                        "database": "app",
+                        **db,
+                        "hostname": scratch_hostname,
+                    },
+                ],
+                backups=[
+                    {
+                        "id": "live-backup",
+                        "db_connection_id": "live",
+                        "local": True,
+                        "path": "/backups",
+                        "verify_db_connection_id": "scratch",
+                    }
+                ],
+            )
+
+
+def test_repository_backups_do_not_share_a_path():
+    """
+    Refuses two repository backups in the same destination, whose garbage
+    collections would delete the chunks of each other.
+    """
+    with pytest.raises(ValueError, match="is already used by backup 'first'"):
+        Config(
+            global_config={"repository": True},
+            db_connections=[
+                {
+                    "id": "db",
+                    "hostname": "localhost",
+                    "username": "root",
+                    "password": "secret",
+                    "database": "app",
+                }
+            ],
+            backups=[
+                {"id": id, "db_connection_id": "db", "local": True, "path": path}
+                for id, path in (("first", "/backups"), ("second", "/backups/"))
+            ],
+        )
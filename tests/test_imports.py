@@ -0,0 +1,98 @@
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../src"))
+
+# modules that must only be loaded when a job needs them
+LAZY_MODULES = ["paramiko", "scp", "cryptography", "requests", "smtplib"]
+
+# generous upper bound for importing the entrypoint and the backup task, in seconds
+COLD_START_BUDGET = 1.5
+
+
+def _run_python(code, *flags):
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code],
+        cwd=SRC_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def test_lazy_imports():
+    """
+    Importing the entrypoint and the backup task must not load protocol,
+    crypto or notification libraries.
+    """
+    result = _run_python(
+        "import json, sys, main, worker.tasks; "
+        f"print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    )
+    assert json.loads(result.stdout) == []
+
+
+def test_lazy_imports_with_notifications(tmp_path):
+    """
+    Commands that send no notification must not load the notification
+    libraries, even when notifications are configured.
+    """
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text(
+        json.dumps(
+            {
+                "global_config": {},
+                "db_connections": [
+                    {
+                        "id": "db",
+                        "hostname": "localhost",
+                        "username": "root",
+                        "password": "secret",
+                        "database": "app",
+                    }
+                ],
+                "notifications": [
+                    {
+                        "id": "discord",
+                        "method": "discord",
+                        "discord_webhook_url": "http://127.0.0.1/webhook",
+                    }
+                ],
+                "backups": [
+                    {
+                        "id": "app",
+                        "db_connection_id": "db",
+                        "local": True,
+                        "path": str(tmp_path / "backups"),
+                        "notification_ids": ["discord"],
+                    }
+                ],
+                "log": {"filename": str(tmp_path / "dbackup.log")},
+                "history": {"filename": str(tmp_path / "history.db")},
+            }
+        )
+    )
+    result = _run_python(
+        "import json, sys, main; "
+        f"main.main(['--config', {str(config_file)!r}, 'history']); "
+        f"print(json.dumps([m for m in {LAZY_MODULES!r} if m in sys.modules]))"
+    )
+    assert json.loads(result.stdout.splitlines()[-1]) == []
+
+
+def test_cold_start_import_time():
+    """
+    Measure the cumulative import time of the entrypoint with -X importtime.
+    """
+    result = _run_python("import main, worker.tasks", "-X", "importtime")
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        # format: "import time: self [us] | cumulative | imported package"
+        parts = line.split("|")
+        if len(parts) != 3 or parts[2].strip() not in ("main", "worker.tasks"):
+            continue
+        cumulative_us += int(parts[1].strip())
+    assert cumulative_us > 0
+    assert cumulative_us / 1_000_000 < COLD_START_BUDGET
@@ -0,0 +1,70 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+from config import LifecycleRule
+
+DATE_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+
+def _write_backup_file(directory, days, corrupt=False):
+    date = datetime.now() - timedelta(days=days)
+    filename = f"tiered_{date.strftime(DATE_FORMAT)}.sql"
+    data = f"-- backup of {days} days\n".encode()
+    (directory / filename).write_bytes(b"corrupt" if corrupt else data)
+    manifest = {"size": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+    (directory / f"{filename}.manifest.json").write_text(json.dumps(manifest))
+    return filename
+
+
+def test_aging_backup_files_move_through_the_tiers(tmp_path, make_backup):
+    """
+    Moves the files older than 3 days, with their manifests, to the second tier
+    and deletes the ones older than 90 days there, while a file that does not
+    match its manifest stays where it is. Restores find the moved files, and verify checks the files of every tier.
+    """
+    from worker.engines import get_engine
+    from worker.lifecycle import apply_lifecycle
+    from worker.manifest import verify_backup
+    from worker.restore import connect_backup_file
+
+    fast, slow = tmp_path / "fast", tmp_path / "slow"
+    fast.mkdir()
+    slow.mkdir()
+    backup = make_backup(
+        id="tiered",
+        path=str(fast),
+        date_format=DATE_FORMAT,
+        max_backup_files=10,
+        lifecycle=[
+            LifecycleRule(after_days=3, local=True, path=str(slow)),
+            LifecycleRule(after_days=90),
+        ],
+    )
+    recent = _write_backup_file(fast, 1)
+    aging = _write_backup_file(fast, 5)
+    corrupt = _write_backup_file(fast, 7, corrupt=True)
+    _write_backup_file(slow, 100)
+
+    stats = apply_lifecycle(backup)
+    assert stats == {"moved": 1, "deleted": 1, "failed": 1}
+    assert sorted(os.listdir(fast)) == sorted(
+        name
+        for filename in (recent, corrupt)
+        for name in (filename, filename + ".manifest.json")
+    )
+    assert sorted(os.listdir(slow)) == [aging, aging + ".manifest.json"]
+
+    tier, client, filename = connect_backup_file(backup, get_engine(backup), aging)
+    client.disconnect()
+    assert (tier.path, filename) == (str(slow), aging)
+
+    results = verify_backup(backup, all_files=True)
+    assert [(result["tier"], result["file"]) for result in results] == [
+        (f"local:{slow}", aging),
+        (f"local:{fast}", corrupt),
+        (f"local:{fast}", recent),
+    ]
+    assert [bool(result["errors"]) for result in results] == [False, True, False]
+    assert verify_backup(backup, aging)[0]["tier"] == f"local:{slow}"
@@ -0,0 +1,129 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from config import Notification, NotificationDelivery
+from data.BackupData import BackupData
+
+
+class _Webhook(BaseHTTPRequestHandler):
+    # keep-alive, so that reused sessions show up as one connection
+    protocol_version = "HTTP/1.1"
+    requests = []
+    connections = set()
+    rate_limited = True
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.connections.add(self.client_address)
+        self.requests.append(body)
+        time.sleep(0.2)
+        if self.rate_limited and len(self.requests) == 1:
+            # the first message hits the rate limit of the webhook
+            self._respond(429, json.dumps({"retry_after": 0.3}).encode())
+        else:
+            self._respond(204)
+
+    def _respond(self, status: int, body: bytes = b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_notifications_are_sent_in_the_background():
+    """
+    Queues Discord notifications without waiting for the webhook, retries the
+    rate limited one after the asked delay, and reuses the HTTP session.
+    """
+    from worker.notification import (
+        send_notifications,
+        start_dispatcher,
+        stop_dispatcher,
+    )
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Webhook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    notification = Notification(
+        id="discord",
+        method="discord",
+        discord_webhook_url=f"http://127.0.0.1:{server.server_port}/webhook",
+    )
+    start_dispatcher(NotificationDelivery(workers=1, retry_delay=0.1))
+    try:
+        start_time = time.monotonic()
+        for index in range(2):
+            backup_data = BackupData(
+                f"backup-{index}", "app", "localhost", "local", True, False
+            )
+            backup_data.success = True
+            send_notifications(backup_data, [notification], True, True)
+        assert time.monotonic() - start_time < 0.2
+    finally:
+        stop_dispatcher()
+        server.shutdown()
+
+    assert len(_Webhook.requests) == 3
+    assert _Webhook.requests[0] == _Webhook.requests[1]
+    assert len(_Webhook.connections) == 1
+
+
+class _DigestWebhook(_Webhook):
+    requests = []
+    connections = set()
+    rate_limited = False
+
+
+def test_notification_digest():
+    """
+    Collects the runs of a digest notification into one message, while failures
+    are also sent right away. The runs filtered out by notify_on_success are
+    counted but not listed.
+    """
+    from worker.notification import (
+        send_notifications,
+        start_dispatcher,
+        stop_dispatcher,
+    )
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _DigestWebhook)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    notification = Notification(
+        id="digest",
+        method="discord",
+        discord_webhook_url=f"http://127.0.0.1:{server.server_port}/webhook",
+        digest=True,
+        digest_window=1,
+    )
+    start_dispatcher(NotificationDelivery())
+    try:
+        for index in range(5):
+            backup_data = BackupData(
+                f"backup-{index}", "app", "localhost", "local", True, False
+            )
+            backup_data.artifact_size = 1000
+            backup_data.set_status(index != 3, "dump failed" if index == 3 else None)
+            send_notifications(backup_data, [notification], index != 0, True)
+        time.sleep(1.5)
+        assert len(_DigestWebhook.requests) == 2
+    finally:
+        stop_dispatcher()
+        server.shutdown()
+
+    failure, digest = _DigestWebhook.requests
+    assert failure["embeds"][0]["title"] == "❌ Backup [backup-3] failed ❌"
+    embed = digest["embeds"][0]
+    assert embed["title"] == "❌ dbackup digest: 5 run(s), 1 failed ❌"
+    lines = embed["description"].splitlines()
+    assert len(lines) == 4
+    assert not any("[backup-0]" in line for line in lines)
+    assert lines[0] == "❌ [backup-3] backup failed: dump failed"
+    assert "total size 5.00 KB" in embed["fields"][0]["value"]
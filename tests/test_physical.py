@@ -0,0 +1,84 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from config import Backup, DBConnection
+
+# tar stands in for the xbstream format of the MariaDB tools
+MARIABACKUP = """#!/bin/sh
+for arg; do
+  case "$arg" in
+    --defaults-extra-file=*) cnf="${arg#*=}" ;;
+    --target-dir=*) target="${arg#*=}" ;;
+    --datadir=*) datadir="${arg#*=}" ;;
+  esac
+done
+case " $* " in
+  *" --backup "*) grep -q "^password=secret$" "$cnf" || exit 3
+    echo "[00] Streaming ./ibdata1" >&2; tar -cf - -C "$DATADIR" . ;;
+  *" --prepare "*) touch "$target/prepared" ;;
+  *" --copy-back "*) cp -R "$target/." "$datadir" ;;
+esac
+"""
+MBSTREAM = """#!/bin/sh
+[ "$1" = "-x" ] && [ "$2" = "-C" ] && exec tar -xf - -C "$3"
+exit 1
+"""
+
+
+def test_physical_backup_and_restore(tmp_path, monkeypatch):
+    """
+    Streams a physical backup of a data directory through the compression,
+    encryption and upload stages, then restores, prepares and copies it back.
+    """
+    from worker.engines.physical import restore_physical_backup
+    from worker.tasks import backup_task
+
+    for name, script in (("mariabackup", MARIABACKUP), ("mbstream", MBSTREAM)):
+        (tmp_path / name).write_text(script)
+        (tmp_path / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    server_datadir = tmp_path / "server"
+    (server_datadir / "app").mkdir(parents=True)
+    (server_datadir / "ibdata1").write_bytes(os.urandom(1024) * 1024)
+    (server_datadir / "app" / "t.ibd").write_bytes(b"page" * 100_000)
+    monkeypatch.setenv("DATADIR", str(server_datadir))
+
+    backup = Backup(
+        id="physical",
+        db_connection_id="db",
+        local=True,
+        path=str(tmp_path / "backups"),
+        engine="mariabackup",
+        dump_parallel=2,
+        compression_enabled=True,
+        compression_codec="zstd",
+        encryption_enabled=True,
+        encryption_password="secret",
+        date_format="%Y-%m-%d_%H-%M-%S",
+        max_backup_files=2,
+    )
+    backup.db_connection_obj = DBConnection(
+        id="db", hostname="localhost", username="root", password="secret", database=""
+    )
+    backup_data = backup_task(backup)
+    assert backup_data.success, backup_data.error
+    assert backup_data.artifact.endswith(".xbstream.zst.enc")
+    assert [stage.name for stage in backup_data.stages][:4] == [
+        "dump",
+        "compression",
+        "encryption",
+        "upload",
+    ]
+
+    datadir = tmp_path / "restored"
+    datadir.mkdir()
+    stats = restore_physical_backup(
+        backup, str(tmp_path / "prepared"), datadir=str(datadir), parallel=2
+    )
+    assert stats["file"] == backup_data.artifact
+    assert stats["restored_bytes"] == 1024 * 1024 + 400_000
+    assert (datadir / "prepared").exists()
+    for path in ("ibdata1", "app/t.ibd"):
+        assert (datadir / path).read_bytes() == (server_datadir / path).read_bytes()
@@ -0,0 +1,91 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from config import Backup, DBConnection
+
+# stand-ins of the PostgreSQL tools, the dumps are copies of $PG_SOURCE
+PG_DUMP = """#!/bin/sh
+grep -q ":secret$" "$PGPASSFILE" || exit 3
+for arg; do
+  case "$arg" in
+    --file=*) dir="${arg#*=}" ;;
+    --jobs=*) echo "$arg" > "$PG_LOG" ;;
+  esac
+done
+cp -R "$PG_SOURCE" "$dir"
+"""
+PG_RESTORE = """#!/bin/sh
+grep -q ":secret$" "$PGPASSFILE" || exit 3
+for arg; do
+  case "$arg" in
+    --dbname=*) database="${arg#*=}" ;;
+    --jobs=*) echo "$arg" >> "$PG_LOG" ;;
+  esac
+  dir="$arg"
+done
+cp -R "$dir" "$PG_RESTORED/$database"
+"""
+PSQL = """#!/bin/sh
+exit 0
+"""
+
+
+def test_postgres_backup_and_restore(tmp_path, monkeypatch):
+    """
+    Dumps a PostgreSQL database in the directory format with parallel jobs,
+    packs it through the compression stage and restores it with pg_restore.
+    """
+    from worker.restore import restore_backup
+    from worker.tasks import backup_task
+
+    for name, script in (
+        ("pg_dump", PG_DUMP),
+        ("pg_restore", PG_RESTORE),
+        ("psql", PSQL),
+    ):
+        (tmp_path / name).write_text(script)
+        (tmp_path / name).chmod(0o755)
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "toc.dat").write_bytes(b"toc" * 1000)
+    (source / "3456.dat").write_bytes(b"1\tone\n2\ttwo\n" * 50_000)
+    (tmp_path / "restored").mkdir()
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+    monkeypatch.setenv("PG_SOURCE", str(source))
+    monkeypatch.setenv("PG_RESTORED", str(tmp_path / "restored"))
+    monkeypatch.setenv("PG_LOG", str(tmp_path / "jobs.log"))
+
+    backup = Backup(
+        id="pg",
+        db_connection_id="db",
+        local=True,
+        path=str(tmp_path / "backups"),
+        dump_parallel=3,
+        compression_enabled=True,
+        compression_codec="zstd",
+        encryption_enabled=False,
+        date_format="%Y-%m-%d_%H-%M-%S",
+        max_backup_files=2,
+    )
+    backup.db_connection_obj = DBConnection(
+        id="db",
+        type="postgresql",
+        hostname="localhost",
+        username="postgres",
+        password="secret",
+        database="app",
+    )
+    assert backup.db_connection_obj.port == 5432
+    backup_data = backup_task(backup)
+    assert backup_data.success, backup_data.error
+    assert backup_data.engine == "pg_dump"
+    assert backup_data.artifact.endswith(".pgdump.zst")
+
+    stats = restore_backup(backup, database="copy", parallel=2)
+    assert stats["file"] == backup_data.artifact
+    for name in ("toc.dat", "3456.dat"):
+        restored = tmp_path / "restored" / "copy" / name
+        assert restored.read_bytes() == (source / name).read_bytes()
+    assert (tmp_path / "jobs.log").read_text().split() == ["--jobs=3", "--jobs=2"]
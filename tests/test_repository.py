@@ -0,0 +1,106 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+from config import Backup, DBConnection
+from worker.repository import Chunker, Repository, open_repository, unwrap
+from worker.transfer_client.transfer_manager import get_client
+
+
+def _dump(rows) -> bytes:
+    lines = [b"-- MySQL dump\n"]
+    for start in range(0, len(rows), 5000):
+        values = b",".join(rows[start : start + 5000])
+        lines.append(b"INSERT INTO `t` VALUES " + values + b";\n")
+    return b"".join(lines)
+
+
+def _chunks(data: bytes) -> list:
+    chunker = Chunker()
+    chunks = []
+    for offset in range(0, len(data), 1024 * 1024):
+        chunks += chunker.update(data[offset : offset + 1024 * 1024])
+    return chunks + chunker.finish()
+
+
+def test_chunker_resynchronizes():
+    """
+    Inserting a row shifts the wrapping of the INSERT lines after it, only the
+    chunks around the row change.
+    """
+    rows = [b"(%d,'row %d of the table')" % (i, i * 7919) for i in range(200_000)]
+    dump = _dump(rows)
+    chunks = _chunks(dump)
+    assert b"".join(unwrap(chunk, wraps) for chunk, wraps in chunks) == dump
+    assert len(chunks) > 10
+
+    rows.insert(1000, b"(-1,'new row')")
+    new_chunks = _chunks(_dump(rows))
+    changed = {chunk for chunk, _wraps in new_chunks} - {
+        chunk for chunk, _wraps in chunks
+    }
+    assert len(changed) <= 2
+
+
+def test_repository_store_and_gc(tmp_path):
+    """
+    Stores dumps in a local encrypted repository with a zstd dictionary, restores
+    one and checks that retention deletes the chunks no recipe references anymore.
+    """
+    backup = Backup(
+        id="repo",
+        db_connection_id="db",
+        local=True,
+        path=str(tmp_path / "backups"),
+        compression_enabled=True,
+        compression_codec="zstd",
+        compression_dictionary=True,
+        encryption_enabled=True,
+        encryption_password="secret",
+        date_format="%Y-%m-%d",
+    )
+    backup.db_connection_obj = DBConnection(
+        id="db", hostname="localhost", username="root", password="", database="app"
+    )
+    dumps = [
+        _dump([b"(%d,'version %d')" % (i, v) for i in range(100_000)]) for v in range(2)
+    ]
+    client = get_client("local", None)
+    for day, dump in enumerate([dumps[0], dumps[0], dumps[1]], 1):
+        dump_file = tmp_path / "dump.sql"
+        dump_file.write_bytes(dump)
+        repository = Repository(client, backup)
+        with repository.lock():
+            repository.open(create=True)
+            stats = repository.store(
+                str(dump_file), f"repo_2024-01-0{day}.sql.recipe", {"size": len(dump)}
+            )
+            if day == 2:
+                assert stats["new_chunks"] == 0
+            # a second run cannot take the lock meanwhile
+            with pytest.raises(RuntimeError, match="is locked by"):
+                with Repository(client, backup).lock():
+                    pass
+            repository.remove_old_recipes("repo_", backup.date_format, 1)
+
+    repository = open_repository(client, backup)
+    assert repository.list_recipes("repo_", backup.date_format) == [
+        "repo_2024-01-03.sql.recipe"
+    ]
+    recipe = repository.read_recipe("repo_2024-01-03.sql.recipe")
+    assert recipe["dictionary"].startswith("db-app.")
+    assert b"".join(repository.iter_chunks(recipe, workers=2)) == dumps[1]
+    assert "lock" not in os.listdir(repository.path)
+    stored = set(os.listdir(repository.chunks_path))
+    assert stored == {chunk_id.hex() for chunk_id in recipe["chunk_ids"]}
+
+    # an unreachable host is not an empty repository, created again
+    class Unreachable(type(client)):
+        def list_files(self, path):
+            raise ConnectionResetError("Connection reset by peer")
+
+    with pytest.raises(ConnectionResetError):
+        open_repository(Unreachable(), backup, create=True)
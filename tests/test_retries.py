@@ -0,0 +1,41 @@
+import os
+
+
+def test_failed_upload_is_retried_without_dumping_again(
+    tmp_path, monkeypatch, mysqldump, make_backup
+):
+    """
+    Retries a failed upload with the local artifact, the database is dumped once.
+    """
+    from worker import tasks
+
+    monkeypatch.setenv("DUMP_LOG", str(tmp_path / "dumps.log"))
+
+    uploads = []
+
+    def flaky_upload(*args, **kwargs):
+        uploads.append(os.path.exists(args[1]))
+        if len(uploads) == 1:
+            raise ConnectionResetError("Connection reset by peer")
+        return upload_backup(*args, **kwargs)
+
+    upload_backup = tasks.upload_backup
+    monkeypatch.setattr(tasks, "upload_backup", flaky_upload)
+
+    backup = make_backup(
+        id="retried",
+        compression_enabled=True,
+        compression_codec="gzip",
+        stage_retries=2,
+        stage_retry_delay=0.01,
+    )
+    backup_data = tasks.backup_task(backup)
+    assert backup_data.success, backup_data.error
+    assert uploads == [True, True]
+    assert (tmp_path / "dumps.log").read_text() == "dump\n"
+    assert backup_data.get_stage("upload").attempts == 2
+    assert backup_data.get_stage("dump").attempts == 1
+    assert sorted(os.listdir(tmp_path / "backups")) == [
+        backup_data.artifact,
+        backup_data.artifact + ".manifest.json",
+    ]
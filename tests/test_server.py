@@ -0,0 +1,57 @@
+import json
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from config import HttpServer
+
+
+def _request(server, path, method="GET", token=None):
+    request = Request(f"http://127.0.0.1:{server.server_port}{path}", method=method)
+    if token:
+        request.add_header("Authorization", f"Bearer {token}")
+    try:
+        with urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except HTTPError as error:
+        return error.code, json.loads(error.read())
+
+
+def test_manual_runs_need_the_token():
+    """
+    Refuses POST /run without the configured token and reports a backup that is
+    already running.
+    """
+    from server import start_http_server
+
+    statuses = {"app": "queued", "busy": "running"}
+    server = start_http_server(
+        HttpServer(port=0, token="secret"),
+        lambda backup_id, profile=None: statuses.get(backup_id, "unknown"),
+    )
+    try:
+        assert _request(server, "/run/app", "POST")[0] == 401
+        assert _request(server, "/run/app", "POST", token="wrong")[0] == 401
+        assert _request(server, "/run/app", "POST", token="secret") == (
+            202,
+            {"backup_id": "app", "profile": False},
+        )
+        assert _request(server, "/run/busy", "POST", token="secret")[0] == 409
+        assert _request(server, "/run/other", "POST", token="secret")[0] == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_bad_history_parameters_are_rejected(tmp_path, monkeypatch):
+    from server import start_http_server
+    from worker import history
+
+    monkeypatch.setattr(history, "_store", history.HistoryStore(str(tmp_path / "h.db")))
+    server = start_http_server(HttpServer(port=0))
+    try:
+        assert _request(server, "/history?days=abc")[0] == 400
+        assert _request(server, "/history/runs?limit=-1")[0] == 400
+        assert _request(server, "/history/runs?limit=5") == (200, [])
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,54 @@
+import os
+
+from config import Spool
+
+
+def test_unreachable_destination_spools_the_backup(
+    tmp_path, monkeypatch, mysqldump, make_backup
+):
+    """
+    Keeps the backup file of a failed upload in the spool, uploads it once the
+    destination can be reached, and evicts the oldest files over the quota.
+    """
+    from worker import spool, tasks
+
+    def unreachable(*args, **kwargs):
+        raise ConnectionRefusedError("Connection refused")
+
+    monkeypatch.setattr(tasks, "upload_backup", unreachable)
+
+    backup = make_backup(
+        id="spooled", date_format="%Y-%m-%d_%H-%M-%S-%f", max_backup_files=5
+    )
+    upload_spool = spool.init_spool(
+        Spool(enabled=True, directory=str(tmp_path / "spool")), [backup]
+    )
+    try:
+        results = [tasks.backup_task(backup) for _ in range(3)]
+        assert not any(backup_data.success for backup_data in results)
+        assert all(backup_data.spooled for backup_data in results)
+        assert "spooled" in results[0].error
+        entries = upload_spool.get_entries()
+        assert [entry["artifact"] for entry in entries] == [
+            backup_data.artifact for backup_data in results
+        ]
+
+        # room for two of them: the oldest is evicted
+        upload_spool.max_size = entries[0]["size"] * 2
+        results.append(tasks.backup_task(backup))
+        entries = upload_spool.get_entries()
+        assert [entry["artifact"] for entry in entries] == [
+            backup_data.artifact for backup_data in results[2:]
+        ]
+
+        assert upload_spool.drain() == 0
+    finally:
+        spool._spool = None
+
+    assert upload_spool.get_entries() == []
+    assert os.listdir(tmp_path / "spool" / "spooled") == []
+    assert sorted(os.listdir(tmp_path / "backups")) == sorted(
+        name
+        for backup_data in results[2:]
+        for name in (backup_data.artifact, backup_data.artifact + ".manifest.json")
+    )
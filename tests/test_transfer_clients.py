@@ -0,0 +1,135 @@
+import hashlib
+import importlib.util
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../benchmarks"))
+)
+
+from bench_transfer import get_host, get_remote_dir, start_servers
+from worker.transfer_client.base import is_not_found_error
+from worker.transfer_client.transfer_manager import get_client
+
+HAS_PYFTPDLIB = importlib.util.find_spec("pyftpdlib") is not None
+
+
+@pytest.fixture(scope="module")
+def servers(tmp_path_factory):
+    root_dir = str(tmp_path_factory.mktemp("remote"))
+    protocols = ["scp", "sftp"] + (["ftp"] if HAS_PYFTPDLIB else [])
+    ports, running = start_servers(protocols, root_dir, latency=0, bandwidth=None)
+    yield root_dir, ports
+    for server in running:
+        server.stop()
+
+
+@pytest.mark.parametrize(
+    "protocol",
+    [
+        "local",
+        "scp",
+        "sftp",
+        pytest.param(
+            "ftp",
+            marks=pytest.mark.skipif(not HAS_PYFTPDLIB, reason="needs pyftpdlib"),
+        ),
+    ],
+)
+def test_transfer_client(servers, tmp_path, protocol):
+    """
+    Upload, download, list and delete files with each client against the
+    in-process servers.
+    """
+    root_dir, ports = servers
+    local_file = tmp_path / "backup_2024-01-01_00-00-00.sql"
+    local_file.write_bytes(os.urandom(3 * 1024 * 1024 + 7))
+    host = get_host(protocol, ports[protocol]) if protocol != "local" else None
+    remote_dir = get_remote_dir(protocol, root_dir) + "/nested"
+    remote_path = f"{remote_dir}/{local_file.name}"
+
+    client = get_client(protocol, host)
+    client.connect()
+    try:
+        client.mkdir(get_remote_dir(protocol, root_dir))
+        client.mkdir(remote_dir)
+        sent = []
+        client.upload_file(str(local_file), remote_path, callback=sent.append)
+        assert sent and sent[-1] == local_file.stat().st_size
+        assert client.list_files(remote_dir) == [local_file.name]
+
+        downloaded = bytearray()
+        with client.open_file(remote_path) as remote_file:
+            while chunk := remote_file.read(1024 * 1024):
+                downloaded.extend(chunk)
+        assert downloaded == local_file.read_bytes()
+
+        assert client.get_size(remote_path) == local_file.stat().st_size
+        sha256 = client.get_sha256(remote_path)
+        # FTP servers without XSHA256 cannot hash remotely
+        assert sha256 in (None, hashlib.sha256(downloaded).hexdigest())
+        assert sha256 is not None or protocol == "ftp"
+
+        client.upload_fileobj(io.BytesIO(b"sidecar"), remote_path + ".json")
+        with client.open_file(remote_path + ".json") as remote_file:
+            assert remote_file.read() == b"sidecar"
+        client.delete_file(remote_path + ".json")
+
+        # a missing directory is told apart from the other listing errors
+        with pytest.raises(Exception) as error:
+            client.list_files(remote_dir + "/missing")
+        assert is_not_found_error(error.value)
+
+        client.delete_file(remote_path)
+        assert client.list_files(remote_dir) == []
+    finally:
+        client.disconnect()
+
+    real_remote_dir = os.path.join(root_dir, protocol, "nested")
+    assert os.listdir(real_remote_dir) == []
+
+
+def test_dump_over_ssh(servers, tmp_path, monkeypatch):
+    """
+    Runs mysqldump on the SSH host and checks that the dump is written
+    decompressed, and that its errors are reported.
+    """
+    from config import Backup, DBConnection
+    from worker.db import dump_db
+
+    _root_dir, ports = servers
+    dump = b"INSERT INTO `t` VALUES (1,'a'),(2,'b');\n" * 10_000
+    (tmp_path / "dump.sql").write_bytes(dump)
+    mysqldump = tmp_path / "mysqldump"
+    mysqldump.write_text(
+        "#!/bin/sh\n"
+        'grep -q "^password=secret$" "${1#--defaults-extra-file=}" || exit 3\n'
+        '[ -n "$FAIL" ] && echo "Access denied" >&2 && exit 2\n'
+        f"cat '{tmp_path / 'dump.sql'}'\n"
+    )
+    mysqldump.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}:{os.environ['PATH']}")
+
+    db_connection = DBConnection(
+        id="db",
+        hostname="127.0.0.1",
+        username="root",
+        password="secret",
+        database="app",
+        ssh_host_id="ssh",
+    )
+    db_connection.ssh_host_obj = get_host("sftp", ports["sftp"])
+    backup = Backup(id="dump", db_connection_id="db", path=str(tmp_path))
+    backup.db_connection_obj = db_connection
+    dump_file = str(tmp_path / "out.sql")
+    assert open(dump_db(backup, dump_file), "rb").read() == dump
+
+    monkeypatch.setenv("FAIL", "1")
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        dump_db(backup, dump_file)
+    assert error.value.stderr == "Access denied"